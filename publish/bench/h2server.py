@@ -0,0 +1,227 @@
+"""
+The stand-in Publish API of publish.bench.server, served over HTTP/2, for
+testing and benchmarking publish.client.http2.HTTP2Transport.
+
+With certfile it serves HTTPS, negotiating h2 with ALPN; without, it speaks
+HTTP/2 directly on plain TCP (h2c with prior knowledge), so the client's
+transport needs prior_knowledge=True:
+
+    server = H2StandInServer(latency=0.02).start()
+    transport = HTTP2Transport(prior_knowledge=True)
+    client = Client(config=server.client_config(), transport=transport)
+
+Each request is answered on a thread of its own once its body has arrived,
+and responses are sent as the client's flow control windows allow.
+
+    python -m publish.bench.h2server --port 8443 --certfile server.pem
+
+Requires the h2 package.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import socket
+import sys
+import threading
+import publish.client.http2 as http2
+import server as bench_server
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+class _H2ServerConnection:
+    """
+    One client connection: collects each stream's request and answers it.
+    """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.channel = http2.H2Channel(sock, False)
+        self.requests = {}  # stream id -> (headers, [ body chunks ])
+
+    # ----------------------------------------------------------------------------
+
+    def run(self):
+        self.channel.start()
+        self.channel.receive_loop(self.__handle)
+
+    # ----------------------------------------------------------------------------
+
+    def __handle(self, event):
+        events = http2.h2.events
+        if isinstance(event, events.RequestReceived):
+            self.requests[event.stream_id] = (event.headers, [])
+        elif isinstance(event, events.DataReceived):
+            if self.requests.has_key(event.stream_id):
+                self.requests[event.stream_id][1].append(event.data)
+            # the whole request is buffered, so its window is reopened at once
+            self.channel.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            self.channel.flush()
+        elif isinstance(event, events.StreamEnded):
+            request = self.requests.pop(event.stream_id, None)
+            if request is not None:
+                worker = threading.Thread(target=self.__respond, args=(event.stream_id,) + request)
+                worker.setDaemon(True)
+                worker.start()
+        elif isinstance(event, events.StreamReset):
+            self.requests.pop(event.stream_id, None)
+
+    # ----------------------------------------------------------------------------
+
+    def __respond(self, stream_id, headers, chunks):
+        pseudo = {}
+        request_headers = {}
+        for (name, value) in headers:
+            if name.startswith(":"):
+                pseudo[name] = value
+            else:
+                request_headers[name] = value
+        body = None
+        if pseudo.get(":method") != "GET":
+            body = "".join(chunks)
+        (status, response_headers, response_body) = self.server.app.handle(
+            pseudo.get(":method"), pseudo.get(":path", "/"), request_headers, body)
+        h2_headers = [ (":status", str(status)) ]
+        for (name, value) in response_headers:
+            h2_headers.append((name.lower(), value))
+        try:
+            self.channel.send_headers(stream_id, h2_headers)
+            throttle = bench_server.Throttle(self.server.bandwidth)
+            if type(response_body) == type(""):
+                response_body = [ response_body ]
+            for data in response_body:
+                self.channel.send_data(stream_id, data)
+                throttle.spend(len(data))
+            self.channel.send_data(stream_id, "", end_stream=True)
+        except (http2.HTTP2Error, http2.h2.exceptions.ProtocolError):
+            # the client reset the stream or went away
+            pass
+
+class H2StandInServer:
+    """
+    Serves a StandInApp over HTTP/2, on a background thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, bandwidth=None,
+                 error_rate=0.0, app_error_rate=0.0, file_size=1048576, certfile=None, seed=None):
+        """
+        The arguments are those of publish.bench.server.StandInServer.
+        """
+        if not http2.available():
+            raise Exception("H2StandInServer requires the h2 package")
+        self.bandwidth = bandwidth
+        self.context = None
+        self.scheme = "http"
+        if certfile is not None:
+            if ssl is None or not getattr(ssl, "HAS_ALPN", False):
+                raise Exception("serving HTTP/2 over TLS needs an ssl module with ALPN")
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.context.load_cert_chain(certfile)
+            self.context.set_alpn_protocols([ "h2" ])
+            self.scheme = "https"
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.address = "%s:%s" % self.sock.getsockname()[:2]
+        self.app = bench_server.StandInApp(latency, jitter, error_rate, app_error_rate, file_size, seed,
+                                           "%s://%s" % (self.scheme, self.address))
+        self.connections = []
+        self.running = False
+        self.thread = None
+
+    # ----------------------------------------------------------------------------
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    # ----------------------------------------------------------------------------
+
+    def serve_forever(self):
+        while self.running:
+            try:
+                (sock, address) = self.sock.accept()
+            except socket.error:
+                if not self.running:
+                    return
+                continue
+            worker = threading.Thread(target=self.__serve, args=(sock,))
+            worker.setDaemon(True)
+            worker.start()
+
+    # ----------------------------------------------------------------------------
+
+    def __serve(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.context is not None:
+            try:
+                sock = self.context.wrap_socket(sock, server_side=True)
+            except (socket.error, ssl.SSLError):
+                sock.close()
+                return
+        connection = _H2ServerConnection(self, sock)
+        self.connections.append(connection)
+        try:
+            connection.run()
+        finally:
+            self.connections.remove(connection)
+
+    # ----------------------------------------------------------------------------
+
+    def stop(self):
+        self.running = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for connection in list(self.connections):
+            connection.channel.close()
+
+    # ----------------------------------------------------------------------------
+
+    def client_config(self, user="bench@example.org", key="bench"):
+        """
+        A publish.client.config.Config pointing at this server.
+        """
+        return self.app.client_config(user, key)
+
+    # ----------------------------------------------------------------------------
+
+    def add_projects(self, count, template):
+        return self.app.add_projects(count, template)
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        return self.app.snapshot()
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    (options, args) = bench_server.build_parser().parse_args(argv)
+    server = H2StandInServer(options.host, options.port, options.latency, options.jitter, options.bandwidth,
+                             options.error_rate, options.app_error_rate, options.file_size, options.certfile)
+    print "%s://%s" % (server.scheme, server.address)
+    sys.stdout.flush()
+    try:
+        server.running = True
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
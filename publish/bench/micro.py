@@ -0,0 +1,260 @@
+"""
+Microbenchmarks of publish.common.baseobj, the CPU cost of building,
+reading, writing and comparing projects, with no network involved.
+
+Each benchmark runs one operation on generated Project payloads of a given
+size, repeating it for at least --seconds, and reports operations per
+second, microseconds per operation and objects per operation:
+
+    construct   Project(datastruct)
+    from_json   Project().from_json(text)
+    to_json     project.to_json()
+    to_ds       project.to_datastruct()
+    flatten     project.to_flattened_datastruct()
+    diff        project.diff(other), other differing in a few fields
+
+Sizes go from a small book (one author, a price, a file) to large catalog
+entries with dozens of authors and hundreds of keywords; see SIZES.
+
+"objects" is the number of objects tracked by the garbage collector
+(instances, lists, dicts holding containers) still alive after one
+operation, that is the size of what it built, and "garbage" the number of
+those only freed by the cyclic garbage collector once the result is
+dropped.  Both are counted with the collector off.
+
+--profile also turns on baseobj's CoercionProfiler while the construct and
+from_json benchmarks run, and prints the coercions by field type; their
+timings then include the profiler's own overhead:
+
+    python -m publish.bench.micro [--sizes small,large] [--seconds 2] [--profile] [BENCHMARK ...]
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import gc
+import optparse
+import random
+import sys
+import time
+import simplejson
+import publish.common.baseobj as baseobj
+import publish.common.project as cproject
+
+# size name -> (authors, keywords, pricing entries, file details per list)
+SIZES = [
+    ("small",  (1, 3, 1, 1)),
+    ("medium", (5, 20, 4, 2)),
+    ("large",  (40, 200, 16, 8)),
+]
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi").split()
+
+def _words(rng, count):
+    return " ".join([ rng.choice(WORDS) for i in range(count) ])
+
+def make_payload(authors, keywords, prices, files, seed=0):
+    """
+    The datastruct of a Project with the given numbers of authors, keywords,
+    pricing entries and cover and contents files, filled in like a real one.
+    """
+    rng = random.Random(seed)
+    return {
+        "content_id"    : rng.randint(1000000, 9999999),
+        "project_type"  : rng.choice([ "softcover", "hardcover", "ebook" ]),
+        "access"        : rng.choice([ "private", "public" ]),
+        "program_code"  : "BENCH",
+        "allow_ratings" : True,
+        "drm"           : False,
+        "distribution"  : [ "lulu_marketplace" ],
+        "bibliography"  : {
+            "title"              : _words(rng, 6).title(),
+            "authors"            : [ { "first_name": rng.choice(WORDS).title(), "last_name": rng.choice(WORDS).title() }
+                                     for i in range(authors) ],
+            "category"           : rng.randint(1, 40),
+            "copyright_year"     : rng.randint(1900, 2010),
+            "description"        : _words(rng, 120),
+            "keywords"           : [ _words(rng, 2) for i in range(keywords) ],
+            "license"            : "Standard Copyright License",
+            "copyright_citation" : "Copyright (c) 2010 %s" % rng.choice(WORDS).title(),
+            "publisher"          : "Lulu Enterprises",
+            "edition"            : "First",
+            "language"           : "EN",
+            "country_code"       : "US",
+        },
+        "isbn" : {
+            "intent"       : "provided",
+            "number"       : "978%010d" % rng.randint(0, 9999999999),
+            "publisher"    : "Lulu Enterprises",
+            "contact_info" : {
+                "name": "Bench Mark", "street1": "3101 Hillsborough St", "street2": "",
+                "city": "Raleigh", "state": "NC", "postal_code": "27607", "country": "US",
+                "phone": "919-459-5858",
+            },
+        },
+        "physical_attributes" : {
+            "binding_type" : rng.choice([ "perfect", "coil", "casewrap-hardcover" ]),
+            "trim_size"    : rng.choice([ "US_TRADE", "US_LETTER", "A5", "DIGEST" ]),
+            "paper_type"   : "regular",
+            "color"        : rng.choice([ True, False ]),
+        },
+        "pricing" : [ { "product"       : rng.choice([ "print", "download" ]),
+                        "currency_code" : rng.choice([ "USD", "GBP", "EUR", "CAD" ]),
+                        "total_price"   : "%d.%02d" % (rng.randint(5, 90), rng.randint(0, 99)),
+                        "royalty"       : "%d.%02d" % (rng.randint(0, 20), rng.randint(0, 99)) }
+                      for i in range(prices) ],
+        "file_info" : {
+            "cover"    : [ { "mimetype": "application/pdf", "filename": "cover-%d.pdf" % i } for i in range(files) ],
+            "contents" : [ { "mimetype": "application/pdf", "filename": "chapter-%02d.pdf" % i } for i in range(files) ],
+        },
+    }
+
+def _changed(datastruct):
+    """
+    A copy of datastruct with a few fields changed, for diff.
+    """
+    other = simplejson.loads(simplejson.dumps(datastruct))
+    other["bibliography"]["title"] = other["bibliography"]["title"] + " (Second Edition)"
+    other["bibliography"]["keywords"] = other["bibliography"]["keywords"][1:]
+    other["physical_attributes"]["color"] = not other["physical_attributes"]["color"]
+    return other
+
+def benchmarks(datastruct):
+    """
+    [ (name, fn) ] of the benchmarks of a payload, each fn doing one operation.
+    """
+    text = simplejson.dumps(datastruct)
+    project = cproject.Project(datastruct)
+    other = cproject.Project(_changed(datastruct))
+    return [
+        ("construct", lambda: cproject.Project(datastruct)),
+        ("from_json", lambda: cproject.Project().from_json(text)),
+        ("to_json",   project.to_json),
+        ("to_ds",     project.to_datastruct),
+        ("flatten",   project.to_flattened_datastruct),
+        ("diff",      lambda: project.diff(other)),
+    ]
+
+NAMES = [ "construct", "from_json", "to_json", "to_ds", "flatten", "diff" ]
+
+# benchmarks that coerce, and so are profiled with --profile
+PROFILED = [ "construct", "from_json" ]
+
+def count_objects(fn):
+    """
+    (objects, garbage): the container objects alive after one call of fn,
+    and how many of those the cyclic collector frees once its result is dropped.
+    """
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        result = fn()
+        objects = len(gc.get_objects()) - before
+        del result
+        garbage = gc.collect()
+    finally:
+        if enabled:
+            gc.enable()
+    return (objects, garbage)
+
+def time_it(fn, seconds):
+    """
+    (operations, elapsed): fn called in growing batches until seconds have passed.
+    """
+    (count, batch, elapsed) = (0, 1, 0.0)
+    while elapsed < seconds:
+        started = time.time()
+        for i in xrange(batch):
+            fn()
+        elapsed = elapsed + time.time() - started
+        count = count + batch
+        batch = batch * 2
+    return (count, elapsed)
+
+def run(names, sizes, seconds, profiler=None):
+    """
+    Run the named benchmarks on payloads of the named sizes, returning a
+    result dict for each.
+    """
+    results = []
+    for (size, counts) in SIZES:
+        if size not in sizes:
+            continue
+        datastruct = make_payload(*counts)
+        for (name, fn) in benchmarks(datastruct):
+            if name not in names:
+                continue
+            (objects, garbage) = count_objects(fn)
+            if profiler is not None and name in PROFILED:
+                baseobj.set_profiler(profiler)
+            try:
+                (count, elapsed) = time_it(fn, seconds)
+            finally:
+                baseobj.set_profiler(None)
+            results.append({
+                "benchmark"   : name,
+                "size"        : size,
+                "bytes"       : len(simplejson.dumps(datastruct)),
+                "operations"  : count,
+                "ops_per_sec" : count / elapsed,
+                "us_per_op"   : elapsed * 1000000 / count,
+                "objects"     : objects,
+                "garbage"     : garbage,
+            })
+    return results
+
+def format_result(result):
+    return "%-10s %-7s %7d bytes %10.1f ops/s %10.1f us/op %7d objects %5d garbage" % (
+        result["benchmark"], result["size"], result["bytes"], result["ops_per_sec"], result["us_per_op"],
+        result["objects"], result["garbage"])
+
+def build_parser():
+    parser = optparse.OptionParser(usage="%prog [options] [BENCHMARK ...]")
+    parser.add_option("--sizes", default=",".join([ name for (name, counts) in SIZES ]),
+                      help="comma separated payload sizes to run")
+    parser.add_option("--seconds", type="float", default=1.0, help="minimum time per benchmark")
+    parser.add_option("--profile", action="store_true", default=False,
+                      help="count and time coercions per field type")
+    parser.add_option("--json", action="store_true", default=False, help="print the results as JSON")
+    return parser
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    (options, args) = parser.parse_args(argv)
+    for name in args:
+        if name not in NAMES:
+            parser.error("unknown benchmark: %s" % name)
+    sizes = [ s.strip() for s in options.sizes.split(",") if s.strip() ]
+    for size in sizes:
+        if size not in [ name for (name, counts) in SIZES ]:
+            parser.error("unknown size: %s" % size)
+    profiler = None
+    if options.profile:
+        profiler = baseobj.CoercionProfiler()
+    results = run(args or NAMES, sizes, options.seconds, profiler)
+    if options.json:
+        saved = { "results": results }
+        if profiler is not None:
+            saved["profile"] = profiler.snapshot()
+        print simplejson.dumps(saved, sort_keys=True, indent=4)
+        return 0
+    for result in results:
+        print format_result(result)
+    if profiler is not None:
+        print
+        for line in profiler.format():
+            print line
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
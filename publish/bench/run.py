@@ -0,0 +1,252 @@
+"""
+Runs the benchmark scenarios against a stand-in Publish API server and
+reports, for each, requests/s, MB/s, client CPU time and call latency
+percentiles.
+
+    python -m publish.bench.run [options] [SCENARIO ...]
+
+By default a publish.bench.server is started in a separate process, so that
+the CPU time reported is the client's alone; --server uses one already
+running instead.  --latency, --bandwidth, --error-rate and so on are passed
+to that server.  --transport picks the client transport: urllib (the
+default), pooled, inprocess, which calls the stand-in app directly with
+no sockets, to measure the client's own overhead, or h2, which runs the
+HTTP/2 stand-in of publish.bench.h2server and uses HTTP2Transport (the h2
+package is needed).
+
+--record FILE saves every exchange of the run with
+publish.client.record.RecordingTransport; --replay FILE then runs the same
+scenarios (with the same options) against that recording, with no server,
+at full speed or, with --replay-latency 1, taking the recorded time:
+
+    python -m publish.bench.run --record bench.rec.gz bulk_read
+    python -m publish.bench.run --replay bench.rec.gz bulk_read
+
+With --save DIR, results are written to DIR as JSON, named by time and
+--label, along with the client version (git describe) and the options
+used.  --compare FILE prints the change from an earlier saved run:
+
+    python -m publish.bench.run --save bench-results --label before
+    ... change the client ...
+    python -m publish.bench.run --compare bench-results/20100601-120000-before.json
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+import simplejson
+import publish.client.bulk as bulk
+import publish.client.client as pclient
+import publish.client.transport as ctransport
+import publish.client.http2 as http2
+import publish.client.record as record
+import server as bench_server
+import scenarios
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# result fields compared between runs, and whether higher is better
+COMPARED = [
+    ("requests_per_sec", True),
+    ("mb_per_sec", True),
+    ("cpu_seconds", False),
+    ("p50", False),
+    ("p99", False),
+]
+
+def build_parser():
+    names = ", ".join([ name for (name, fn) in scenarios.SCENARIOS ])
+    parser = optparse.OptionParser(usage="python -m publish.bench.run [options] [SCENARIO ...]\n\nscenarios: %s" % names)
+    parser.add_option("-n", "--count", type="int", default=500, help="projects per bulk scenario")
+    parser.add_option("-w", "--workers", type="int", default=8, help="threads (or connections per file)")
+    parser.add_option("--repeat", type="int", default=3, help="transfers per upload/download scenario")
+    parser.add_option("--upload-size", type="int", default=32 * 1048576, help="bytes per upload")
+    parser.add_option("--file-size", type="int", default=32 * 1048576, help="bytes per download")
+    parser.add_option("--segment-size", type="int", default=4 * 1048576, help="bytes per segmented download range")
+    parser.add_option("--retries", type="int", default=1, help="attempts per call, counting the first")
+    parser.add_option("--latency", type="float", default=0.0, help="server seconds added per response")
+    parser.add_option("--jitter", type="float", default=0.0, help="server random extra seconds per response")
+    parser.add_option("--bandwidth", type="float", default=None, help="server bytes per second per transfer")
+    parser.add_option("--error-rate", type="float", default=0.0, help="fraction of requests failing with 503")
+    parser.add_option("--certfile", default=None, help="serve HTTPS with this PEM certificate and key")
+    parser.add_option("--server", default=None, help="URL of a stand-in server already running")
+    parser.add_option("--transport", default="urllib", choices=[ "urllib", "pooled", "inprocess", "h2" ],
+                      help="client transport: urllib, pooled, inprocess or h2")
+    parser.add_option("--record", metavar="FILE", default=None, help="record every exchange to FILE")
+    parser.add_option("--replay", metavar="FILE", default=None, help="replay a recording instead of using a server")
+    parser.add_option("--replay-latency", type="float", default=0.0,
+                      help="fraction of recorded latency to reproduce when replaying")
+    parser.add_option("--save", metavar="DIR", default=None, help="save results as JSON in DIR")
+    parser.add_option("--label", default="run", help="name for the saved results")
+    parser.add_option("--compare", metavar="FILE", default=None, help="compare with results saved earlier")
+    return parser
+
+def start_server(options, module="publish.bench.server"):
+    """
+    Start a stand-in server process, returning (process, url).
+    """
+    argv = [ sys.executable, "-m", module,
+             "--latency", str(options.latency), "--jitter", str(options.jitter),
+             "--error-rate", str(options.error_rate), "--file-size", str(options.file_size) ]
+    if options.bandwidth:
+        argv.extend([ "--bandwidth", str(options.bandwidth) ])
+    if options.certfile:
+        argv.extend([ "--certfile", options.certfile ])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ ROOT ] + [ p for p in [ env.get("PYTHONPATH") ] if p ])
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, env=env)
+    url = process.stdout.readline().strip()
+    if not url:
+        raise Exception("the stand-in server failed to start")
+    return (process, url)
+
+def version():
+    """
+    The client version being measured, from git if possible.
+    """
+    try:
+        process = subprocess.Popen([ "git", "describe", "--always", "--dirty" ], cwd=ROOT,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0].strip()
+        if process.returncode == 0 and output:
+            return output
+    except OSError:
+        pass
+    return "unknown"
+
+def run_scenarios(names, url, options, transport):
+    """
+    Run the named scenarios against the server at url, returning their results.
+    """
+    retry = None
+    if options.retries > 1:
+        retry = bulk.RetryPolicy(attempts=options.retries)
+    results = []
+    for (name, fn) in scenarios.SCENARIOS:
+        if name not in names:
+            continue
+        client = pclient.Client(config=bench_server.client_config_for(url), transport=transport)
+        client.login()
+        measure = scenarios.Measurement(name, client, retry)
+        fn(client, options, measure)
+        result = measure.result()
+        results.append(result)
+        print format_result(result)
+        sys.stdout.flush()
+    return results
+
+def format_result(result):
+    latency = result["latency_ms"]
+    return "%-20s %8d req %8.1f req/s %8.2f MB/s %7.2fs cpu  p50 %s p90 %s p99 %s ms  %d errors" % (
+        result["scenario"], result["requests"], result["requests_per_sec"], result["mb_per_sec"],
+        result["cpu_seconds"], latency["p50"], latency["p90"], latency["p99"], result["errors"])
+
+def _value(result, field):
+    if result["latency_ms"].has_key(field):
+        return result["latency_ms"][field]
+    return result.get(field)
+
+def compare(results, earlier):
+    """
+    Lines describing the change of each result from the same scenario in earlier.
+    """
+    before = dict([ (r["scenario"], r) for r in earlier["results"] ])
+    lines = [ "compared with %s (%s, %s):" % (earlier.get("label"), earlier.get("version"), earlier.get("started")) ]
+    for result in results:
+        old = before.get(result["scenario"])
+        if old is None:
+            continue
+        changes = []
+        for (field, higher_is_better) in COMPARED:
+            (a, b) = (_value(old, field), _value(result, field))
+            if not a or b is None:
+                continue
+            change = (b - a) * 100.0 / a
+            better = (change > 0) == higher_is_better
+            changes.append("%s %+.1f%%%s" % (field, change, (better and " " or "!")))
+        lines.append("  %-20s %s" % (result["scenario"], "  ".join(changes)))
+    return lines
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    (options, args) = parser.parse_args(argv)
+    known = [ name for (name, fn) in scenarios.SCENARIOS ]
+    for name in args:
+        if name not in known:
+            parser.error("unknown scenario: %s" % name)
+    names = args or known
+
+    process = None
+    url = options.server
+    if options.replay:
+        # recordings are matched on path only, so any URL will do
+        (url, transport) = ("http://replay.invalid", record.ReplayTransport(options.replay, options.replay_latency))
+    elif options.transport == "inprocess":
+        app = bench_server.StandInApp(options.latency, options.jitter, options.error_rate,
+                                      file_size=options.file_size)
+        (url, transport) = (app.url, app.transport())
+    else:
+        if url is None and options.transport == "h2":
+            (process, url) = start_server(options, "publish.bench.h2server")
+        elif url is None:
+            (process, url) = start_server(options)
+        if options.transport == "h2":
+            transport = http2.HTTP2Transport(prior_knowledge=True)
+        elif options.transport == "pooled":
+            transport = ctransport.PooledTransport(max_idle=options.workers)
+        else:
+            transport = ctransport.UrllibTransport()
+    if options.record:
+        transport = record.RecordingTransport(transport, options.record)
+    try:
+        started = time.strftime("%Y-%m-%d %H:%M:%S")
+        results = run_scenarios(names, url, options, transport)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if options.record:
+            transport.close()
+
+    saved = {
+        "label"   : options.label,
+        "version" : version(),
+        "python"  : sys.version.split()[0],
+        "started" : started,
+        "options" : options.__dict__,
+        "results" : results,
+    }
+    if options.compare:
+        fd = open(options.compare)
+        try:
+            earlier = simplejson.load(fd)
+        finally:
+            fd.close()
+        for line in compare(results, earlier):
+            print line
+    if options.save:
+        if not os.path.isdir(options.save):
+            os.makedirs(options.save)
+        path = os.path.join(options.save, "%s-%s.json" % (time.strftime("%Y%m%d-%H%M%S"), options.label))
+        fd = open(path, "w")
+        try:
+            simplejson.dump(saved, fd, sort_keys=True, indent=4)
+        finally:
+            fd.close()
+        print "saved %s" % path
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
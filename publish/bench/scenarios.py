@@ -0,0 +1,262 @@
+"""
+Benchmark scenarios: timed, repeatable workloads run through a Client.
+
+Each scenario takes a logged in client, the benchmark options (see
+publish.bench.run) and a Measurement.  It does any setup it needs first,
+then times only its workload between measure.start() and measure.stop(),
+making its API calls through measure.client so that every call's latency
+is recorded.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import publish.common.project as cproject
+import publish.client.bulk as bulk
+import publish.client.download as download
+
+# the project created by the benchmarks
+PROJECT_TEMPLATE = {
+    "project_type" : "softcover",
+    "access"       : "private",
+    "bibliography" : {
+        "title"          : "Benchmark Book",
+        "authors"        : [ { "first_name": "Bench", "last_name": "Mark" } ],
+        "category"       : 1,
+        "description"    : "A book created by the benchmark suite.",
+        "keywords"       : [ "benchmark" ],
+        "license"        : "Public Domain",
+        "copyright_year" : 2010,
+        "language"       : "EN",
+        "country_code"   : "US",
+    },
+    "physical_attributes" : {
+        "binding_type" : "perfect",
+        "trim_size"    : "US_TRADE",
+        "paper_type"   : "regular",
+        "color"        : False,
+    },
+    "pricing" : [ { "product": "print", "currency_code": "USD", "total_price": "19.95" } ],
+}
+
+def _cpu_time():
+    (user, system) = os.times()[:2]
+    return user + system
+
+class Measurement:
+    """
+    Wall clock and CPU time of a workload, with per-call latencies and bytes
+    kept in a publish.client.bulk.Stats.
+    """
+
+    def __init__(self, name, client, retry=None):
+        self.name = name
+        self.stats = bulk.Stats()
+        self.client = bulk.ThrottledClient(client, retry=retry, stats=self.stats)
+        self.started = None
+        self.stopped = None
+        self.cpu_started = None
+        self.cpu_stopped = None
+
+    def start(self):
+        self.stats = bulk.Stats()
+        self.client.stats = self.stats
+        self.cpu_started = _cpu_time()
+        self.started = time.time()
+
+    def stop(self):
+        self.stopped = time.time()
+        self.cpu_stopped = _cpu_time()
+
+    def record(self, result, nbytes=0):
+        """
+        Count one finished item, a publish.client.bulk.BulkResult.
+        """
+        self.stats.record_item(result.error, nbytes)
+
+    def result(self):
+        """
+        The measurement as a hash, suitable for saving as JSON.
+        """
+        stats = self.stats
+        seconds = max(self.stopped - self.started, 1e-6)
+        latency = {}
+        for (name, p) in [ ("p50", 50), ("p90", 90), ("p99", 99), ("max", 100) ]:
+            value = stats.percentile(p)
+            if value is not None:
+                value = round(value * 1000, 3)
+            latency[name] = value
+        return {
+            "scenario"         : self.name,
+            "requests"         : len(stats.latencies),
+            "items"            : stats.items,
+            "errors"           : stats.errors,
+            "retries"          : stats.retries,
+            "bytes"            : stats.bytes,
+            "seconds"          : round(seconds, 4),
+            "cpu_seconds"      : round(self.cpu_stopped - self.cpu_started, 4),
+            "requests_per_sec" : round(len(stats.latencies) / seconds, 2),
+            "mb_per_sec"       : round(stats.bytes / seconds / 1048576.0, 3),
+            "latency_ms"       : latency,
+        }
+
+def _create_projects(client, count, workers):
+    """
+    Setup for scenarios that need existing projects: create count of them.
+    Pass measure.client, so that the setup is retried like the workload.
+    """
+    ids = []
+    for result in bulk.run_parallel(lambda i: client.create(cproject.Project(PROJECT_TEMPLATE)),
+                                    range(count), workers=workers):
+        if result.error is not None:
+            raise result.error
+        ids.append(result.value["content_id"])
+    return ids
+
+def _run(measure, fn, items, workers):
+    for result in bulk.run_parallel(fn, items, workers=workers):
+        measure.record(result)
+
+def bulk_read(client, options, measure):
+    """
+    Read options.count projects with options.workers threads.
+    """
+    ids = _create_projects(measure.client, options.count, options.workers)
+    measure.start()
+    _run(measure, measure.client.read, ids, options.workers)
+    measure.stop()
+
+def bulk_create(client, options, measure):
+    """
+    Build and create options.count projects with options.workers threads.
+    """
+    def create(i):
+        return measure.client.create(cproject.Project(PROJECT_TEMPLATE))
+    measure.start()
+    _run(measure, create, range(options.count), options.workers)
+    measure.stop()
+
+def large_upload(client, options, measure):
+    """
+    Upload a file of options.upload_size bytes options.repeat times.
+    """
+    directory = tempfile.mkdtemp(prefix="publish-bench-")
+    try:
+        path = os.path.join(directory, "contents.pdf")
+        fd = open(path, "wb")
+        block = "%PDF-1.4\n" + "x" * 65527
+        remaining = options.upload_size
+        while remaining > 0:
+            fd.write(block[:min(remaining, len(block))])
+            remaining = remaining - len(block)
+        fd.close()
+        measure.start()
+        for i in range(options.repeat):
+            try:
+                token = measure.client.request_upload_token()["token"]
+                measure.client.upload(path, token)
+                measure.record(bulk.BulkResult(i, path), options.upload_size)
+            except Exception, e:
+                measure.record(bulk.BulkResult(i, path, error=e))
+        measure.stop()
+    finally:
+        shutil.rmtree(directory, True)
+
+def large_download(client, options, measure):
+    """
+    Download a contents file options.repeat times with download_file.
+    """
+    (content_id,) = _create_projects(measure.client, 1, 1)
+    directory = tempfile.mkdtemp(prefix="publish-bench-")
+    try:
+        path = os.path.join(directory, "contents.pdf")
+        measure.start()
+        for i in range(options.repeat):
+            try:
+                measure.client.download_file(content_id, "contents", path)
+                measure.record(bulk.BulkResult(i, path), os.path.getsize(path))
+            except Exception, e:
+                measure.record(bulk.BulkResult(i, path, error=e))
+        measure.stop()
+    finally:
+        shutil.rmtree(directory, True)
+
+class _TimedTransport:
+    """
+    Records in measure's stats the latency of each request made through
+    transport, up to the end of its body, for requests such as
+    DownloadManager's segments that bypass the client's API methods.
+    """
+
+    def __init__(self, transport, measure):
+        self.transport = transport
+        self.measure = measure
+
+    def request(self, url, body=None, headers=None):
+        started = time.time()
+        try:
+            response = self.transport.request(url, body, headers)
+        except:
+            self.measure.stats.record_call(time.time() - started)
+            raise
+        return _TimedResponse(response, self.measure, started)
+
+class _TimedResponse:
+    """
+    A response that records its latency once it is closed.
+    """
+
+    def __init__(self, response, measure, started):
+        self.response = response
+        self.measure = measure
+        self.started = started
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def close(self):
+        if self.started is not None:
+            self.measure.stats.record_call(time.time() - self.started)
+            self.started = None
+        self.response.close()
+
+def segmented_download(client, options, measure):
+    """
+    Download a contents file options.repeat times with DownloadManager,
+    recording each range request as a call.
+    """
+    (content_id,) = _create_projects(measure.client, 1, 1)
+    manager = download.DownloadManager(measure.client, segment_size=options.segment_size,
+                                       connections_per_file=options.workers)
+    manager.transport = _TimedTransport(manager.transport, measure)
+    directory = tempfile.mkdtemp(prefix="publish-bench-")
+    try:
+        path = os.path.join(directory, "contents.pdf")
+        measure.start()
+        for i in range(options.repeat):
+            try:
+                manager.download(content_id, "contents", path)
+                measure.record(bulk.BulkResult(i, path), os.path.getsize(path))
+            except Exception, e:
+                measure.record(bulk.BulkResult(i, path, error=e))
+        measure.stop()
+    finally:
+        shutil.rmtree(directory, True)
+
+# name -> scenario, in the order they run by default
+SCENARIOS = [
+    ("bulk_read", bulk_read),
+    ("bulk_create", bulk_create),
+    ("large_upload", large_upload),
+    ("large_download", large_download),
+    ("segmented_download", segmented_download),
+]
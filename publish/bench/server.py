@@ -0,0 +1,539 @@
+"""
+A local stand-in for the Lulu authentication and Publish API servers, for
+benchmarks and load tests.
+
+StandInApp implements every endpoint Client uses, keeping projects in
+memory, and serves output files of a fixed size for download (with byte
+range support, as used by publish.client.download).  Each response can be
+slowed by a fixed latency plus random jitter, and a fraction of requests can
+fail with 503 (transient) or 500 (an application error in the server's JSON
+error format).
+
+StandInServer serves a StandInApp over HTTP, optionally limiting each
+transfer to a bandwidth:
+
+    server = StandInServer(latency=0.02, bandwidth=2*1048576, error_rate=0.01).start()
+    client = Client(config=server.client_config())
+    client.login()
+    ...
+    server.stop()
+
+or from the command line, printing the address it listens on:
+
+    python -m publish.bench.server --port 8080 --latency 0.02
+
+With certfile (a PEM file holding a certificate and its key) it serves HTTPS;
+the client must then trust that certificate.
+
+A StandInApp can also be called in-process, with no sockets at all:
+
+    app = StandInApp()
+    client = Client(config=app.client_config(), transport=app.transport())
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import optparse
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+import simplejson
+import publish.client.config as client_config
+import publish.client.transport as ctransport
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+BLOCK_SIZE = 16384
+
+API_PREFIX = "/api/publish/v1/"
+AUTH_PATH = "/account/endpoints/authenticator.php"
+
+_RANGE = re.compile(r'bytes=(\d+)-(\d*)$')
+_FILE_PATH = re.compile(r'/files/(\d+)/(contents|cover)$')
+
+class Throttle:
+    """
+    Limits one transfer to bandwidth bytes per second (None for no limit).
+    """
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.started = time.time()
+        self.sent = 0
+
+    def spend(self, nbytes):
+        self.sent = self.sent + nbytes
+        if self.bandwidth:
+            ahead = self.sent / float(self.bandwidth) - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def client_config_for(url, user="bench@example.org", key="bench"):
+    """
+    A publish.client.config.Config pointing at the stand-in server at url, ex: http://127.0.0.1:8080
+    """
+    (scheme, address) = url.rstrip("/").split("://", 1)
+    return client_config.Config(overrides={
+        "auth_server"        : address,
+        "publish_api_server" : address,
+        "upload_server"      : address,
+        "scheme"             : scheme,
+        "user"               : user,
+        "key"                : key,
+        "api_key"            : "bench-api-key",
+    })
+
+class ApiError(Exception):
+    """
+    Raised by endpoint handlers; sent to the client as a 500 with a JSON body.
+    """
+
+    def __init__(self, error_type, error_value):
+        Exception.__init__(self, error_value)
+        self.error_type = error_type
+        self.error_value = error_value
+
+class StandInApp:
+    """
+    The in-memory Publish API.  handle() takes a request and returns the
+    response; it is safe to call from many threads.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, app_error_rate=0.0,
+                 file_size=1048576, seed=None, url="http://standin.invalid"):
+        """
+        latency:        seconds added before each response
+        jitter:         up to this many more seconds, at random
+        error_rate:     fraction of API requests answered with 503
+        app_error_rate: fraction of API requests answered with a 500 carrying a JSON error
+        file_size:      size in bytes of every contents and cover file served
+        url:            where the app is reached, for the file URLs returned by urls()
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.app_error_rate = app_error_rate
+        self.file_size = file_size
+        self.url = url
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.projects = {}   # content_id -> project hash
+        self.next_id = 1
+        self.tokens = {}     # auth token -> user
+        self.counts = {}     # endpoint -> requests
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.block = ("%s\n" % ("0123456789abcdef" * 63)) * (BLOCK_SIZE / 1024)
+
+    # ----------------------------------------------------------------------------
+
+    def client_config(self, user="bench@example.org", key="bench"):
+        """
+        A publish.client.config.Config pointing at this app.
+        """
+        return client_config_for(self.url, user, key)
+
+    # ----------------------------------------------------------------------------
+
+    def transport(self):
+        """
+        A publish.client.transport.InProcessTransport calling this app directly.
+        """
+        return ctransport.InProcessTransport(self.handle)
+
+    # ----------------------------------------------------------------------------
+
+    def add_projects(self, count, template):
+        """
+        Store count copies of the template project hash directly, returning their content_ids.
+        """
+        ids = []
+        self.lock.acquire()
+        try:
+            for i in range(count):
+                ds = simplejson.loads(simplejson.dumps(template))
+                ds["content_id"] = self.next_id
+                self.projects[self.next_id] = ds
+                ids.append(self.next_id)
+                self.next_id = self.next_id + 1
+        finally:
+            self.lock.release()
+        return ids
+
+    # ----------------------------------------------------------------------------
+
+    def count(self, endpoint, nbytes_in=0, nbytes_out=0):
+        self.lock.acquire()
+        try:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.bytes_in = self.bytes_in + nbytes_in
+            self.bytes_out = self.bytes_out + nbytes_out
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return {
+                "projects"  : len(self.projects),
+                "counts"    : dict(self.counts),
+                "bytes_in"  : self.bytes_in,
+                "bytes_out" : self.bytes_out,
+            }
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def handle(self, method, url, headers, body):
+        """
+        Answer one request.  url may be a full URL or just its path; body is a
+        string, or None for a GET.  Returns (status, headers, body), where body
+        is a string or an iterable of strings.
+        """
+        path = urlparse.urlsplit(url)[2]
+        body = body or ""
+        if method == "GET":
+            return self.__get_file(path, headers)
+        if path == AUTH_PATH:
+            self.__delay()
+            form = self.__form(body)
+            token = "token-%s" % self.random.random()
+            self.lock.acquire()
+            self.tokens[token] = form.get("username")
+            self.lock.release()
+            self.count("login", len(body))
+            return self.__json({ "authenticated": True, "authToken": token })
+        if not path.startswith(API_PREFIX):
+            return (404, [], "")
+        parts = path[len(API_PREFIX):].split("/")
+        api_method = parts[0]
+        options = dict(zip(parts[1::2], parts[2::2]))
+        if api_method == "upload":
+            form = {}
+        else:
+            form = self.__form(body)
+        self.count(api_method, len(body))
+        self.__delay()
+        roll = self.random.random()
+        if roll < self.error_rate:
+            return (503, [], "")
+        try:
+            if roll < self.error_rate + self.app_error_rate:
+                raise ApiError("ApiException", "injected failure")
+            if api_method != "upload" and not self.tokens.has_key(form.get("auth_token")):
+                return (401, [], "")
+            handler = getattr(self, "api_%s" % api_method, None)
+            if handler is None:
+                return (404, [], "")
+            result = handler(options, form)
+        except ApiError, e:
+            return self.__json({ "error_type": e.error_type, "error_value": e.error_value }, 500)
+        if type(result) == type(()):
+            return result
+        return self.__json(result)
+
+    # ----------------------------------------------------------------------------
+
+    def __get_file(self, path, headers):
+        # direct file URLs, as returned by urls()
+        if _FILE_PATH.match(path) is None:
+            return (404, [], "")
+        self.__delay()
+        size = self.file_size
+        (start, end) = (0, size - 1)
+        status = 200
+        header = None
+        for (name, value) in headers.items():
+            if name.lower() == "range":
+                header = value
+        if header:
+            range_match = _RANGE.match(header)
+            if range_match:
+                start = int(range_match.group(1))
+                if range_match.group(2):
+                    end = min(int(range_match.group(2)), size - 1)
+                status = 206
+        if start > end:
+            return (416, [], "")
+        response_headers = [ ("Content-Type", "application/pdf"), ("Accept-Ranges", "bytes") ]
+        if status == 206:
+            response_headers.append(("Content-Range", "bytes %s-%s/%s" % (start, end, size)))
+        return self.__file(status, response_headers, end - start + 1)
+
+    # ----------------------------------------------------------------------------
+    # endpoints: each takes the URL options and form, and returns the JSON
+    # response, or a whole (status, headers, body) response as a tuple
+
+    def api_create(self, options, form):
+        ds = self.__project(form)
+        self.lock.acquire()
+        try:
+            ds["content_id"] = self.next_id
+            self.projects[self.next_id] = ds
+            self.next_id = self.next_id + 1
+        finally:
+            self.lock.release()
+        return { "content_id": ds["content_id"] }
+
+    def api_read(self, options, form):
+        return { "project": self.__existing(options.get("id")) }
+
+    def api_update(self, options, form):
+        delta = self.__project(form)
+        ds = self.__existing(delta.get("content_id"))
+        self.lock.acquire()
+        try:
+            ds.update(delta)
+        finally:
+            self.lock.release()
+        return { "content_id": ds["content_id"] }
+
+    def api_list(self, options, form):
+        self.lock.acquire()
+        try:
+            ids = sorted(self.projects.keys())
+        finally:
+            self.lock.release()
+        return { "content_ids": ids }
+
+    def api_urls(self, options, form):
+        ds = self.__existing(options.get("id"))
+        base = "%s/files/%s" % (self.url, ds["content_id"])
+        return { "contents": base + "/contents", "cover": base + "/cover" }
+
+    def api_delete(self, options, form):
+        ds = self.__existing(options.get("id"))
+        self.lock.acquire()
+        try:
+            self.projects.pop(ds["content_id"], None)
+        finally:
+            self.lock.release()
+        return { "content_id": ds["content_id"] }
+
+    def api_download(self, options, form):
+        self.__existing(options.get("id"))
+        if options.get("what") not in [ "contents", "cover" ]:
+            raise ApiError("ApiException", "what must be contents or cover")
+        return self.__file(200, [ ("Content-Type", "application/pdf") ], self.file_size)
+
+    def api_upload(self, options, form):
+        return { "uploaded": True }
+
+    def api_request_upload_token(self, options, form):
+        return { "token": "upload-%s" % self.random.random() }
+
+    def api_base_cost(self, options, form):
+        try:
+            page_count = int(form.get("page_count") or 0)
+        except ValueError:
+            raise ApiError("ApiException", "page_count must be an integer")
+        return { "currency_code": "USD", "total_cost": "%.2f" % (4.5 + 0.02 * page_count) }
+
+    # ----------------------------------------------------------------------------
+
+    def __form(self, body):
+        form = {}
+        for (k, v) in cgi.parse_qs(body, keep_blank_values=True).iteritems():
+            form[k] = v[0]
+        return form
+
+    def __project(self, form):
+        try:
+            ds = simplejson.loads(form.get("project") or "")
+        except ValueError:
+            raise ApiError("ApiException", "project must be a JSON object")
+        if type(ds) != type({}):
+            raise ApiError("ApiException", "project must be a JSON object")
+        return ds
+
+    def __existing(self, content_id):
+        try:
+            content_id = int(content_id)
+        except (TypeError, ValueError):
+            raise ApiError("ApiException", "content id must be a positive integer")
+        ds = self.projects.get(content_id)
+        if ds is None:
+            raise ApiError("NotFoundException", "no such project: %s" % content_id)
+        return ds
+
+    def __delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay = delay + self.random.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+
+    def __json(self, value, status=200):
+        data = simplejson.dumps(value)
+        self.count("response", 0, len(data))
+        return (status, [ ("Content-Type", "application/json"), ("Content-Length", str(len(data))) ], data)
+
+    def __file(self, status, headers, size):
+        self.count("file", 0, size)
+        return (status, headers + [ ("Content-Length", str(size)) ], self.__blocks(size))
+
+    def __blocks(self, size):
+        block = self.block
+        while size > 0:
+            data = block[:min(size, len(block))]
+            size = size - len(data)
+            yield data
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # buffer each response and send it without waiting on Nagle's algorithm,
+    # or keep-alive clients see delayed-ACK stalls of ~40ms per request
+    wbufsize = BLOCK_SIZE
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.__respond("POST", self.__read_body())
+
+    def do_GET(self):
+        self.__respond("GET", None)
+
+    def __respond(self, method, body):
+        headers = dict(self.headers.items())
+        (status, response_headers, response_body) = self.server.app.handle(method, self.path, headers, body)
+        if type(response_body) == type(""):
+            response_body = [ response_body ]
+        names = [ name.lower() for (name, value) in response_headers ]
+        self.send_response(status)
+        for (name, value) in response_headers:
+            self.send_header(name, value)
+        if "content-length" not in names:
+            # every body this app sends without a length is empty
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+        throttle = Throttle(self.server.bandwidth)
+        for data in response_body:
+            self.wfile.write(data)
+            throttle.spend(len(data))
+
+    def __read_body(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        throttle = Throttle(self.server.bandwidth)
+        chunks = []
+        while length > 0:
+            data = self.rfile.read(min(length, BLOCK_SIZE))
+            if data == "":
+                break
+            chunks.append(data)
+            length = length - len(data)
+            throttle.spend(len(data))
+        return "".join(chunks)
+
+class StandInServer:
+    """
+    Serves a StandInApp over HTTP(S), on a background thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, bandwidth=None,
+                 error_rate=0.0, app_error_rate=0.0, file_size=1048576, certfile=None, seed=None):
+        """
+        bandwidth:      bytes per second for each request and response body, None for no limit
+        certfile:       PEM certificate and key, to serve HTTPS
+        The other arguments are those of StandInApp.
+        """
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.bandwidth = bandwidth
+        self.scheme = "http"
+        if certfile is not None:
+            if ssl is None:
+                raise Exception("serving HTTPS needs the ssl module")
+            self.httpd.socket = ssl.wrap_socket(self.httpd.socket, certfile=certfile, server_side=True)
+            self.scheme = "https"
+        self.address = "%s:%s" % self.httpd.server_address[:2]
+        self.app = StandInApp(latency, jitter, error_rate, app_error_rate, file_size, seed,
+                              "%s://%s" % (self.scheme, self.address))
+        self.httpd.app = self.app
+        self.thread = None
+
+    # ----------------------------------------------------------------------------
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    # ----------------------------------------------------------------------------
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # ----------------------------------------------------------------------------
+
+    def client_config(self, user="bench@example.org", key="bench"):
+        """
+        A publish.client.config.Config pointing at this server.
+        """
+        return self.app.client_config(user, key)
+
+    # ----------------------------------------------------------------------------
+
+    def add_projects(self, count, template):
+        return self.app.add_projects(count, template)
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        return self.app.snapshot()
+
+def build_parser():
+    parser = optparse.OptionParser(usage="python -m publish.bench.server [options]")
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=0)
+    parser.add_option("--latency", type="float", default=0.0, help="seconds added to each response")
+    parser.add_option("--jitter", type="float", default=0.0, help="up to this many more seconds, at random")
+    parser.add_option("--bandwidth", type="float", default=None, help="bytes per second for each transfer")
+    parser.add_option("--error-rate", type="float", default=0.0, help="fraction of requests failing with 503")
+    parser.add_option("--app-error-rate", type="float", default=0.0, help="fraction of requests failing with 500")
+    parser.add_option("--file-size", type="int", default=1048576, help="size of downloadable files")
+    parser.add_option("--certfile", default=None, help="PEM certificate and key, to serve HTTPS")
+    return parser
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    (options, args) = build_parser().parse_args(argv)
+    server = StandInServer(options.host, options.port, options.latency, options.jitter, options.bandwidth,
+                           options.error_rate, options.app_error_rate, options.file_size, options.certfile)
+    print "%s://%s" % (server.scheme, server.address)
+    sys.stdout.flush()
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
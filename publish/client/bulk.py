@@ -0,0 +1,332 @@
+"""
+Helpers for running many API calls: rate limiting, retries, a bounded
+worker pool and throughput statistics.
+
+    stats = Stats()
+    client = ThrottledClient(client, RateLimiter(20), RetryPolicy(attempts=4), stats)
+    for result in run_parallel(client.delete, content_ids, workers=8):
+        if result.error is not None:
+            print result.item, result.error
+    print stats.summary()
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+import Queue
+import tracing
+
+# client methods that talk to the server, and so are throttled and retried
+API_METHODS = [ "login", "create", "update", "read", "urls", "list_projects", "delete",
+                "download_file", "upload", "request_upload_token", "get_base_cost" ]
+
+# API methods that can be called again without changing anything on the
+# server, and so are retried by default; a create retried after a timeout
+# may already have been done
+IDEMPOTENT_METHODS = [ "login", "read", "urls", "list_projects", "download_file", "get_base_cost" ]
+
+# the API endpoint behind each method whose name differs, as metrics name them
+METHOD_ENDPOINTS = { "list_projects": "list", "download_file": "download", "get_base_cost": "base_cost" }
+
+# HTTP codes worth retrying; 500 carries an application error, so it is not
+RETRY_HTTP_CODES = [ 502, 503, 504 ]
+
+class RateLimiter:
+    """
+    Token bucket limiting calls to rate per second, with bursts of up to burst calls.
+    Shared between threads.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1, int(rate))
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a call may be made.
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+class RetryPolicy:
+    """
+    Retries calls that fail with transient network errors or HTTP 502/503/504,
+    with exponential backoff and jitter.  attempts counts the first call.
+    ThrottledClient only retries the client methods listed in methods, by
+    default IDEMPOTENT_METHODS; pass others, ex: [ "create" ], to opt in to
+    retrying them, accepting that a call may then take effect twice.
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30, methods=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if methods is None:
+            methods = IDEMPOTENT_METHODS
+        self.methods = methods
+
+    def retries(self, name):
+        """
+        True if calls of the client method name are retried.
+        """
+        return name in self.methods
+
+    def is_transient(self, error):
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in RETRY_HTTP_CODES
+        return isinstance(error, (urllib2.URLError, socket.error, httplib.HTTPException))
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn, retrying transient failures.  on_retry, if passed as a keyword,
+        is called with the error before each retry.
+        """
+        on_retry = kwargs.pop("on_retry", None)
+        attempt = 1
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception, e:
+                if attempt >= self.attempts or not self.is_transient(e):
+                    raise
+                if on_retry is not None:
+                    on_retry(e)
+                delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+                time.sleep(delay * (0.5 + random.random() / 2))
+                attempt = attempt + 1
+
+class Stats:
+    """
+    Thread-safe counters of calls, items, bytes, errors and call latencies.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.items = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latencies = []
+
+    def record_call(self, latency):
+        self.lock.acquire()
+        try:
+            self.latencies.append(latency)
+        finally:
+            self.lock.release()
+
+    def record_item(self, error=None, nbytes=0):
+        self.lock.acquire()
+        try:
+            self.items = self.items + 1
+            self.bytes = self.bytes + nbytes
+            if error is not None:
+                self.errors = self.errors + 1
+        finally:
+            self.lock.release()
+
+    def record_retry(self, error=None):
+        self.lock.acquire()
+        try:
+            self.retries = self.retries + 1
+        finally:
+            self.lock.release()
+
+    def percentile(self, p):
+        """
+        The p-th percentile (0-100) of call latency in seconds, or None.
+        """
+        self.lock.acquire()
+        try:
+            values = sorted(self.latencies)
+        finally:
+            self.lock.release()
+        if len(values) == 0:
+            return None
+        index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+        return values[index]
+
+    def summary(self):
+        """
+        One line describing throughput and latency so far.
+        """
+        elapsed = max(time.time() - self.started, 1e-6)
+        p50 = self.percentile(50)
+        p99 = self.percentile(99)
+        if p50 is None:
+            latency = "no calls"
+        else:
+            latency = "latency p50 %.0fms p99 %.0fms" % (p50 * 1000, p99 * 1000)
+        return "%d items (%d errors, %d retries) in %.1fs: %.1f items/s, %.2f MB/s, %s" % (
+            self.items, self.errors, self.retries, elapsed, self.items / elapsed,
+            self.bytes / elapsed / 1048576.0, latency)
+
+class ThrottledClient:
+    """
+    Wraps a Client so that its API methods go through a rate limiter and retry
+    policy and have their latency recorded, for use with code that takes a
+    client, such as PublishPipeline.  Other attributes pass straight through.
+    """
+
+    def __init__(self, client, rate_limiter=None, retry=None, stats=None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.retry = retry
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in API_METHODS:
+            return attr
+        def wrapper(*args, **kwargs):
+            return self.__call(name, attr, args, kwargs)
+        return wrapper
+
+    def __call(self, name, fn, args, kwargs):
+        def attempt():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if self.stats is not None:
+                    self.stats.record_call(time.time() - start)
+        if self.retry is None or not self.retry.retries(name):
+            return attempt()
+        metrics = getattr(self.client, "metrics", None)
+        def on_retry(error):
+            if self.stats is not None:
+                self.stats.record_retry(error)
+            if metrics is not None:
+                metrics.record_retry(METHOD_ENDPOINTS.get(name, name), error)
+        return self.retry.call(attempt, on_retry=on_retry)
+
+class BulkResult:
+    """
+    The outcome of one item of run_parallel.  index is the item's position in
+    the input; value is what the call returned, or error the exception it raised.
+    skipped is True for items never attempted because an earlier one failed.
+    """
+
+    def __init__(self, index, item, value=None, error=None, skipped=False):
+        self.index = index
+        self.item = item
+        self.value = value
+        self.error = error
+        self.skipped = skipped
+
+    def ok(self):
+        return self.error is None and not self.skipped
+
+# marks the end of the input for one worker
+_DONE = object()
+
+def run_parallel(fn, items, workers=4, stop_on_error=False):
+    """
+    Call fn(item) for every item of the iterable using a pool of threads, yielding
+    a BulkResult for each as it completes.  items is consumed lazily.  With
+    stop_on_error, no new calls are started after the first failure; calls already
+    running still finish and are reported.
+    """
+    pending = Queue.Queue(2 * workers)
+    results = Queue.Queue()
+    stop = threading.Event()
+    feed_error = []
+
+    def feed():
+        try:
+            try:
+                for pair in enumerate(items):
+                    while not stop.isSet():
+                        try:
+                            pending.put(pair, True, 0.5)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stop.isSet():
+                        break
+            except Exception, e:
+                feed_error.append(e)
+        finally:
+            for i in range(workers):
+                pending.put(_DONE)
+
+    def work():
+        try:
+            while True:
+                pair = pending.get()
+                if pair is _DONE:
+                    return
+                if stop.isSet():
+                    continue
+                (index, item) = pair
+                try:
+                    result = BulkResult(index, item, value=fn(item))
+                except Exception, e:
+                    result = BulkResult(index, item, error=e)
+                    if stop_on_error:
+                        stop.set()
+                results.put(result)
+        finally:
+            results.put(_DONE)
+
+    work = tracing.wrap(work)
+    threads = [ threading.Thread(target=feed) ] + [ threading.Thread(target=work) for i in range(workers) ]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    running = workers
+    try:
+        while running > 0:
+            result = results.get()
+            if result is _DONE:
+                running = running - 1
+            else:
+                yield result
+    finally:
+        stop.set()
+    if feed_error:
+        raise feed_error[0]
+
+def run_ordered(fn, items, workers=4, stop_on_error=False):
+    """
+    Like run_parallel, but return a list of BulkResults in input order, with
+    skipped results for items not attempted after a stop_on_error failure.
+    """
+    items = list(items)
+    results = [ None ] * len(items)
+    for result in run_parallel(fn, items, workers, stop_on_error):
+        results[result.index] = result
+    for (index, result) in enumerate(results):
+        if result is None:
+            results[index] = BulkResult(index, items[index], skipped=True)
+    return results
@@ -0,0 +1,225 @@
+"""
+Command line runner for bulk operations against the Publish API.
+
+    python -m publish.client.cli COMMAND [options] ARGS
+
+Commands:
+
+    create SPECS       publish books described by a JSONL or CSV file of specs
+                       (see publish.client.pipeline for the spec format)
+    update SPECS       send each JSONL/CSV row, a project hash with a
+                       content_id, to update()
+    delete IDS         delete the content_ids listed in a JSONL/CSV file
+                       (bare ids, or rows with a content_id column)
+    export DIR         read every project of the account and write the catalog
+                       as columnar files (see publish.common.export)
+    download DIR       download the contents and cover files of every project
+
+In CSV files the header names dotted paths, ex: project.bibliography.title
+or files.cover for create, bibliography.title for update; cells holding
+JSON lists (ex: ["a", "b"]) are decoded.  update reads its file with
+publish.common.feed.FeedReader, so cells are converted to their field's
+type and rows that fail validation are reported and skipped.  Credentials come from
+~/.lulu_publish_api.conf.  A summary of throughput and latency is printed
+when the command finishes.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import csv
+import optparse
+import os
+import sys
+import simplejson
+import publish.common.export as cexport
+import publish.common.feed as cfeed
+import client as pclient
+import bulk
+import journal
+import pipeline
+
+COMMANDS = [ "create", "update", "delete", "export", "download" ]
+
+USAGE = """%prog COMMAND [options] ARG
+
+commands:
+  create SPECS    publish the books described in a JSONL or CSV file
+  update SPECS    update projects from a JSONL or CSV file
+  delete IDS      delete the content_ids listed in a JSONL or CSV file
+  export DIR      write the whole catalog as columnar files into DIR
+  download DIR    download contents and cover files of every project into DIR"""
+
+def read_rows(path):
+    """
+    Yield the rows of a JSONL file, or of a CSV file as nested hashes built
+    from dotted column names.  Empty CSV cells are left out.
+    """
+    fd = open(path, "rb")
+    try:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(fd):
+                yield cfeed.unflatten(row)
+        else:
+            for line in fd:
+                line = line.strip()
+                if line != "":
+                    yield simplejson.loads(line)
+    finally:
+        fd.close()
+
+def build_parser():
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-w", "--workers", type="int", default=4,
+                      help="concurrent requests (default %default)")
+    parser.add_option("-r", "--rate-limit", type="float", default=None,
+                      help="maximum API calls per second (default unlimited)")
+    parser.add_option("--retries", type="int", default=3,
+                      help="attempts per read-only call for transient errors (default %default)")
+    parser.add_option("--backoff", type="float", default=0.5,
+                      help="initial retry delay in seconds, doubled per retry (default %default)")
+    parser.add_option("--resume", metavar="JOURNAL", default=None,
+                      help="create: record progress in JOURNAL and resume from it")
+    parser.add_option("--format", default="csv", choices=[ "csv", "arrow" ],
+                      help="export: output format, csv or arrow (default %default)")
+    parser.add_option("--profile", default=None,
+                      help="credentials profile from the config file")
+    parser.add_option("--server", default=None,
+                      help="publish API server (default from the config file)")
+    parser.add_option("-v", "--verbose", action="store_true", default=False)
+    return parser
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 2 or args[0] not in COMMANDS:
+        parser.print_help()
+        return 2
+    (command, target) = args
+
+    stats = bulk.Stats()
+    real_client = pclient.Client(server=options.server, verbose=options.verbose, profile=options.profile)
+    rate_limiter = None
+    if options.rate_limit:
+        rate_limiter = bulk.RateLimiter(options.rate_limit)
+    retry = bulk.RetryPolicy(attempts=options.retries, backoff=options.backoff)
+    api = bulk.ThrottledClient(real_client, rate_limiter, retry, stats)
+    api.login()
+
+    try:
+        if command == "create":
+            do_create(api, target, options, stats)
+        elif command == "update":
+            do_update(api, target, options, stats)
+        elif command == "delete":
+            report(run(api.delete, [ _content_id(row) for row in read_rows(target) ], options, stats), options)
+        elif command == "export":
+            do_export(api, target, options, stats)
+        elif command == "download":
+            do_download(api, target, options, stats)
+    finally:
+        print >>sys.stderr, stats.summary()
+    if stats.errors > 0:
+        return 1
+    return 0
+
+def run(fn, items, options, stats, nbytes=None):
+    """
+    run_parallel over items, recording each result in stats.
+    """
+    for result in bulk.run_parallel(fn, items, workers=options.workers):
+        size = 0
+        if nbytes is not None and result.ok():
+            size = nbytes(result)
+        stats.record_item(result.error, size)
+        yield result
+
+def report(results, options):
+    for result in results:
+        if not result.ok():
+            print >>sys.stderr, "item %s failed: %s" % (result.index, result.error)
+        elif options.verbose:
+            print "item %s: %s" % (result.index, result.value)
+
+def _content_id(row):
+    if type(row) == type({}):
+        row = row["content_id"]
+    return int(row)
+
+def _spec_bytes(spec):
+    return sum([ os.path.getsize(f) for f in pipeline.spec_files(spec) ])
+
+def do_create(api, target, options, stats):
+    if options.resume:
+        jobs = journal.JobJournal(options.resume, max_attempts=options.retries)
+        jobs.add_many([ (spec.get("key", index), spec) for (index, spec) in enumerate(read_rows(target)) ])
+        before = jobs.counts().get(journal.DONE, 0)
+        counts = journal.JournalRunner(api, jobs, workers=options.workers).run()
+        for i in range(counts.get(journal.DONE, 0) - before):
+            stats.record_item()
+        for (job_id, state, error) in jobs.failures():
+            if state == journal.CREATING:
+                stats.record_item(error)
+                print >>sys.stderr, "job %s may have been created, check and resolve it: %s" % (job_id, error)
+            elif state != journal.DONE:
+                stats.record_item(error)
+                print >>sys.stderr, "job %s failed at %s: %s" % (job_id, state, error)
+        print "journal: %s" % counts
+        return
+    upload_workers = options.workers
+    create_workers = max(1, options.workers / 2)
+    for result in pipeline.PublishPipeline(api, upload_workers=upload_workers, create_workers=create_workers).run(read_rows(target)):
+        size = 0
+        if result.ok():
+            size = _spec_bytes(result.spec)
+            print "%s\t%s" % (result.key or result.index, result.content_id)
+        else:
+            print >>sys.stderr, "book %s failed at %s: %s" % (result.key or result.index, result.stage, result.error)
+        stats.record_item(result.error, size)
+
+def do_update(api, target, options, stats):
+    def rejected(error):
+        print >>sys.stderr, "rejected %s" % error
+    reader = cfeed.FeedReader(target, on_error=rejected)
+    report(run(api.update, reader.dicts(), options, stats), options)
+    for i in range(reader.rows_rejected):
+        stats.record_item("rejected")
+
+def do_export(api, target, options, stats):
+    if options.format == "arrow":
+        writer = cexport.ArrowWriter(target)
+    else:
+        writer = cexport.CSVWriter(target)
+    def projects():
+        for result in run(api.read, api.list_projects(lazy=True), options, stats):
+            if result.ok():
+                yield result.value
+            else:
+                print >>sys.stderr, "read %s failed: %s" % (result.item, result.error)
+    exporter = cexport.CatalogExporter()
+    counts = cexport.export(exporter, projects(), writer)
+    print "exported: %s" % counts
+    if exporter.invalid:
+        print >>sys.stderr, "values exported as missing, not of their column's type: %s" % exporter.invalid
+
+def do_download(api, target, options, stats):
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    def files():
+        for content_id in api.list_projects(lazy=True):
+            for what in [ "contents", "cover" ]:
+                yield (content_id, what)
+    def download(item):
+        (content_id, what) = item
+        return api.download_file(content_id, what, os.path.join(target, "%s-%s.pdf" % (content_id, what)))
+    report(run(download, files(), options, stats, nbytes=lambda r: os.path.getsize(r.value)), options)
+
+if __name__ == "__main__":
+    sys.exit(main())
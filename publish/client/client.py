@@ -13,6 +13,9 @@ Unless required by applicable law or agreed to in writing, software distributed
 
 import urllib2
 import urllib
+import httplib
+import socket
+import time
 import simplejson
 import os.path
 import config as client_config
@@ -20,8 +23,14 @@ import exceptions
 import traceback
 import sys
 import publish.common.project as cproject
+import publish.common.encode as cencode
+import jsonstream
+import transport as ctransport
+import quote as cquote
+import metrics as cmetrics
+import tracing
+import bulk
 import poster.encode as poster_encode
-import poster.streaminghttp as poster_streaming
 
 
 class Client:
@@ -34,15 +43,62 @@ class Client:
     the API functions.
     """
 
-    def __init__(self, server=None, verbose=False):
+    def __init__(self, server=None, verbose=False, skip_unchanged=False, streaming_json=False, limiter=None, hedging=None,
+                 quote_cache=None, profile=None, config=None, token_cache=None, transport=None, metrics=None,
+                 tracer=None):
         """
         Constructor.
         server:  the address/hostname of the lulu server, e.x. api1.lulu.com
         user:    username, ex: user@example.org
         key:     for now, the user's password
+        skip_unchanged: if True, update() will not contact the server when the
+                 project's fingerprint matches the last known server state
+                 (see note_server_state)
+        streaming_json: if True, decode JSON responses incrementally as they
+                 arrive rather than reading the whole body first
+        limiter: optional publish.client.limiter.AdaptiveLimiter (or any object
+                 with acquire(method)/release) bounding the requests this client, and
+                 any other sharing the limiter, have in flight
+        hedging: optional publish.client.hedge.HedgePolicy; idempotent calls
+                 (read, urls, ...) that are slow to answer are sent again and
+                 the first answer is used
+        quote_cache: optional publish.client.quote.QuoteCache for get_base_cost
+        profile: named credentials profile from the configuration file
+        config:  a publish.client.config.Config to use instead of one for profile
+        token_cache: optional publish.client.config.TokenCache; login() reuses a
+                 cached token for the same server, user and key, so clients for
+                 the same account log in only once
+        transport: how requests are sent, see publish.client.transport; by
+                 default urllib2, with a new connection per request
+        metrics: optional publish.client.metrics.Metrics recording each API
+                 method's requests, latency, bytes and errors, along with the
+                 counters of the transport, limiter, hedging and caches
+        tracer:  optional publish.client.tracing tracer for spans around login,
+                 API calls, uploads and downloads; by default the global tracer,
+                 which does nothing unless set with tracing.set_tracer
         """
         self.verbose = verbose
-        self.config = client_config.Config()
+        self.skip_unchanged = skip_unchanged
+        self.streaming_json = streaming_json
+        self.limiter = limiter
+        self.hedging = hedging
+        self.quote_cache = quote_cache
+        self.token_cache = token_cache
+        if transport is None:
+            transport = ctransport.UrllibTransport()
+        self.transport = transport
+        self.metrics = metrics
+        self.tracer = tracer
+        if metrics is not None:
+            for (name, part) in [ ("transport", transport), ("limiter", limiter), ("hedging", hedging),
+                                  ("quote_cache", quote_cache), ("token_cache", token_cache) ]:
+                if hasattr(part, "snapshot"):
+                    metrics.add_source(name, part)
+        self._server_fingerprints = {}  # content_id -> fingerprint
+        if config is None:
+            config = client_config.Config(profile=profile)
+        self.config = config
+        self.scheme = self.config.get_scheme()
 
         if server is None:
             self.server = self.config.get_publish_api_server()
@@ -54,17 +110,30 @@ class Client:
         self.api_key  = self.config.get_api_key()
         # FIXME: use Python standard logging
 
-    def login(self, user=None, key=None):
+    def login(self, user=None, key=None, refresh=False):
         """
         Login to the Lulu.com app and retrieve an auth_token that we will need
-        for all future requests.
+        for all future requests.  With a token_cache, a cached token is used
+        unless refresh is True.
         """
+        return self.__traced("login", None, self.__login, user, key, refresh)
+
+    def __login(self, user, key, refresh):
         if user is None:
             user = self.config.get_user()
         if key is None:
             key = self.config.get_key()
 
-        uri = "https://%s/account/endpoints/authenticator.php" % self.config.get_auth_server()
+        auth_server = self.config.get_auth_server()
+        if self.token_cache is not None and not refresh:
+            token = self.token_cache.get(auth_server, user, key)
+            tracing.current_span().set_attribute("token_cache.hit", token is not None)
+            if token is not None:
+                self.token = token
+                self.user  = user
+                return self.token
+
+        uri = "%s://%s/account/endpoints/authenticator.php" % (self.scheme, auth_server)
         post = {
            "username"     : user,
            "password"     : key,
@@ -72,9 +141,8 @@ class Client:
         }
 
         post = urllib.urlencode(post)
-        req = urllib2.Request(uri, post)
         try:
-            handle = urllib2.urlopen(req)
+            handle = self.__open("login", uri, post)
         except urllib2.URLError, ue:
             print sys.stderr, "failure to contact %s" % uri
             traceback.print_exc()
@@ -91,11 +159,14 @@ class Client:
         else:
             self.token = data.get("authToken",None)
             self.user  = user
+            if self.token_cache is not None:
+                self.token_cache.put(auth_server, user, key, self.token)
             return self.token
 
     def create(self, project):
         """
-        Create a new project.   Project is a publish.common.project.Project()
+        Create a new project.   Project is a publish.common.project.Project(),
+        or a publish.common.encode.EncodedProject already serialized.
         """
         self.__assert_project(project, "project must be a publish.common.Project instance")
         ds = project.to_json()
@@ -109,16 +180,67 @@ class Client:
         Update an existing project.   Metadata is as described in create
         but may contain omissions as only changes are needed.
         Files is a list of files to upload and their context (FIXME).
+        If the client was constructed with skip_unchanged=True and the project
+        matches the last known server state, nothing is sent and None is returned.
         """
         self.__assert_valid_for_update(project_or_dict, "expected project or dictionary with content_id, recieved: %s" % project_or_dict)
         if type(project_or_dict) == type({}):
             ds = simplejson.dumps(project_or_dict)
         else:
+            if self.skip_unchanged and self.is_unchanged(project_or_dict):
+                if self.verbose:
+                    print "skipping update of unchanged project %s" % project_or_dict.get("content_id")
+                return None
             ds = project_or_dict.to_json()
         form_data = { "project" : ds  }
         if self.verbose:
             print "updating with: %s" % ds
-        return self.__submit("update",None,form_data)
+        result = self.__submit("update",None,form_data)
+        if type(project_or_dict) == type({}):
+            # a partial update leaves the server in a state we can't fingerprint
+            self.forget_server_state(project_or_dict["content_id"])
+        elif self.skip_unchanged:
+            self.note_server_state(project_or_dict)
+        return result
+
+    def note_server_state(self, project):
+        """
+        Record project (a publish.common.project.Project with a content_id) as the
+        current server state, for use by update() when skip_unchanged is set.
+        Sync jobs can call this with states they have stored themselves.
+        """
+        self.__assert_project(project, "project must be a publish.common.Project instance")
+        self._server_fingerprints[project.get("content_id")] = project.fingerprint()
+
+    def forget_server_state(self, content_id):
+        """
+        Discard the last known server state for a project.
+        """
+        self._server_fingerprints.pop(content_id, None)
+
+    def is_unchanged(self, project):
+        """
+        True if project matches the last known server state for its content_id.
+        """
+        known = self._server_fingerprints.get(project.get("content_id"))
+        return known is not None and known == project.fingerprint()
+
+    def update_many(self, projects_or_dicts, workers=8, stop_on_error=False):
+        """
+        Update many projects concurrently (see update), using a pool of workers
+        threads.  Returns a list of publish.client.bulk.BulkResult in input order,
+        holding each update's response or the exception (usually a ClientException)
+        it raised.  With stop_on_error, no more updates are started after the first
+        failure and the rest are returned as skipped.
+        """
+        return bulk.run_ordered(self.update, projects_or_dicts, workers, stop_on_error)
+
+    def iter_update_many(self, projects_or_dicts, workers=8, stop_on_error=False):
+        """
+        Like update_many, but yield each BulkResult as soon as it completes.
+        The input is consumed lazily, so it may be a generator of any length.
+        """
+        return bulk.run_parallel(self.update, projects_or_dicts, workers, stop_on_error)
 
     def read(self, content_id, verbose=False):
         """
@@ -130,7 +252,10 @@ class Client:
             print "data read: ", simplejson.dumps(data, sort_keys=True, indent=4)
         assert type(data) == type({}), "expected the read call to return a dictionary: %s, got %s" % (data)
         assert data.has_key("project"), "expected the response to contain a project: %s" % data
-        return cproject.Project(data["project"])
+        project = cproject.Project(data["project"])
+        if self.skip_unchanged:
+            self.note_server_state(project)
+        return project
 
     def urls(self, content_id):
         """
@@ -144,10 +269,17 @@ class Client:
         self.__assert_positive_integer(content_id, "content id must be a positive integer")
         return self.__submit("urls", {"id": content_id}, None)
 
-    def list_projects(self):
+    def list_projects(self, lazy=False):
         """
         Get a list of content_ids suitable for use with the read or delete calls.
-        """
+        If lazy is True, return an iterator that yields each content_id as it is
+        decoded from the response, so that large accounts can be processed before
+        the response has finished arriving, in bounded memory.  It raises
+        ClientException, after the ids it found, if the response has no content_ids.
+        """
+        if lazy:
+            handle = self.__submit("list", None, None, stream=True)
+            return self.__iter_response(handle, "content_ids.item", "content IDs were not returned")
         results = self.__submit("list", None, None)
         assert results.has_key("content_ids"), "content IDs were not returned"
         return results["content_ids"]
@@ -157,19 +289,35 @@ class Client:
         Delete a project, permanently, no questions asked.
         """
         self.__assert_positive_integer(content_id, "content id must be a positive integer")
-        return self.__submit("delete", { "id" : content_id }, None)
+        result = self.__submit("delete", { "id" : content_id }, None)
+        self.forget_server_state(content_id)
+        return result
+
+    def delete_many(self, content_ids, workers=8, stop_on_error=False):
+        """
+        Delete many projects concurrently.  Results are as for update_many.
+        """
+        return bulk.run_ordered(self.delete, content_ids, workers, stop_on_error)
+
+    def iter_delete_many(self, content_ids, workers=8, stop_on_error=False):
+        """
+        Like delete_many, but yield each BulkResult as soon as it completes.
+        """
+        return bulk.run_parallel(self.delete, content_ids, workers, stop_on_error)
 
     def download_file(self, content_id, what_file, save_as):
         """
         Download a print or preview output file for a given project.  This is usable for API consumer
         testing in an automated context.  To share URLs with users on your web site, use the urls() function
         and link to those directly.   Note that this implementation currently does *not* stream downloads,
-        so if the document is expected to be very large, just use the urls() function.  The server itself
-        does in fact stream downloads, so this is only a limitation of the client implementation.
+        so if the document is expected to be very large, just use the urls() function, or
+        publish.client.download.DownloadManager, which fetches the urls() in parallel byte ranges.
+        The server itself does in fact stream downloads, so this is only a limitation of the client implementation.
         """
         self.__assert_positive_integer(content_id, "content id must be a positive integer")
         assert (what_file in ["contents", "cover"]), "file type must be 'contents' or 'cover'"
-        self.__submit("download", { "id": content_id, "what": what_file }, download=save_as)
+        self.__traced("download_file", { "content_id": content_id, "what": what_file }, self.__submit,
+                      "download", { "id": content_id, "what": what_file }, download=save_as)
         if self.verbose:
             print "downloaded %s as %s" % (what_file, save_as)
         return save_as
@@ -180,10 +328,12 @@ class Client:
         'files' is either a filename or an array of filenames.
         Upload must be called prior to creation.
         """
+        return self.__traced("upload", None, self.__upload, files, upload_token)
+
+    def __upload(self, files, upload_token):
         assert self.token is not None, "call login(username, key) to obtain a token"
         assert self.user is not None, "internal error, no user value"
   
-        poster_streaming.register_openers()
   
         # Start the multipart/form-data encoding of the files
         # headers contains the necessary Content-Type and Content-Length
@@ -198,17 +348,19 @@ class Client:
         input_hash["auth_token"] = self.token
         input_hash["auth_user"]  = self.user
         input_hash["upload_token"]  = upload_token
-        datagen, headers = poster_encode.multipart_encode(input_hash)
+        datagen, headers = self.__traced("multipart_encode", { "files": len(files) },
+                                         poster_encode.multipart_encode, input_hash)
+        tracing.current_span().set_attribute("http.request_content_length", headers.get("Content-Length"))
   
-        # Create the Request object
+        # the upload URL
   
-        request = urllib2.Request("https://%s/api/publish/v1/upload" % self.config.get_upload_server(), datagen, headers)
+        uri = "%s://%s/api/publish/v1/upload" % (self.scheme, self.config.get_upload_server())
   
         # Actually do the request, and get the response
         try:
-            response = urllib2.urlopen(request).read()
+            response = self.__open("upload", uri, datagen, headers).read()
         except urllib2.HTTPError, he:
-            self.__convert_error_to_exception(he)
+            self.__convert_error_to_exception("upload", he)
         print simplejson.loads(response)
         return simplejson.loads(response)
 
@@ -220,10 +372,45 @@ class Client:
 
     def get_base_cost(self, project, page_count=None):
         """
-        Get base cost for the given project properties.
-        """
-        form_data = { 'project': project, 'page_count': page_count }
-        return self.__submit("base_cost", None, form_data)
+        Get base cost for the given project properties.  If the client has a
+        quote_cache, answers for the same physical properties and page count
+        come from the cache until they expire.
+        """
+        if self.quote_cache is None:
+            form_data = { 'project': project, 'page_count': page_count }
+            return self.__submit("base_cost", None, form_data)
+        key = cquote.quote_key(project, page_count)
+        cost = self.quote_cache.get(key)
+        if cost is None:
+            form_data = { 'project': project, 'page_count': page_count }
+            cost = self.__submit("base_cost", None, form_data)
+            self.quote_cache.put(key, cost)
+        return cost
+
+    def get_base_costs(self, variants, workers=8):
+        """
+        Quote many (project, page_count) pairs concurrently, ex: the output of
+        publish.client.quote.variants().  Variants with the same physical
+        properties and page count are only quoted once.  Returns a list of rows,
+        in input order, with the project_type, physical attributes, page_count,
+        cost and error (None, or the exception raised) of each variant.
+        """
+        variants = list(variants)
+        unique = {}
+        for (project, page_count) in variants:
+            unique.setdefault(cquote.quote_key(project, page_count), (project, page_count))
+        keys = unique.keys()
+        answers = {}
+        def quote_one(key):
+            (project, page_count) = unique[key]
+            return self.get_base_cost(project, page_count)
+        for result in bulk.run_parallel(quote_one, keys, workers=workers):
+            answers[result.item] = result
+        table = []
+        for (project, page_count) in variants:
+            result = answers[cquote.quote_key(project, page_count)]
+            table.append(cquote.table_row(project, page_count, result.value, result.error))
+        return table
 
     def test_echo(self, parameters=None, form_data=None):
         """
@@ -241,18 +428,55 @@ class Client:
        """
        return self.__submit("test_error1")
 
-    def __submit(self, method, options=None, form_data=None, download=None):
+    def __iter_response(self, handle, prefix, missing):
+        """
+        Yield the values at prefix (see jsonstream) from an open response handle,
+        raising ClientException with the message missing if there is nothing there.
+        """
+        try:
+            try:
+                for item in jsonstream.items(handle, prefix, required=True):
+                    yield item
+            except KeyError:
+                raise ClientException(simplejson.dumps({ "error_type": "ClientException", "error_value": missing }))
+        finally:
+            handle.close()
+
+    def __traced(self, name, attributes, fn, *args, **kwargs):
+        """
+        Return fn(*args, **kwargs), called within a span, with any exception
+        it raises recorded on the span.
+        """
+        if self.tracer is None:
+            span = tracing.start_span(name, attributes)
+        else:
+            span = self.tracer.start_span(name, attributes)
+        try:
+            try:
+                return fn(*args, **kwargs)
+            except Exception, e:
+                (typ, val, tb) = sys.exc_info()
+                span.record_exception(e)
+                raise typ, val, tb
+        finally:
+            span.end()
+
+    def __submit(self, method, options=None, form_data=None, download=None, stream=False):
         """
         Carries out a request to the REST endpoint
         "method" is, for example create/update/delete/read, etc
         "options" is a hash and is added to the URL line, ex: { "id" : 42 }
         "form_data" is a hash and is added to form data
         "download" if not None, means save the result to the filename provided
+        "stream" if True, return the open response handle for the caller to read
         """
+        return self.__traced("api.%s" % method, options, self.__request, method, options, form_data, download, stream)
+
+    def __request(self, method, options, form_data, download, stream):
         assert self.token is not None, "call login(username, key) first to obtain a token"
         assert self.user is not None, "internal error, no user value"
         assert method is not None, "method is required"
-        uri = "https://%s/api/publish/v1/%s" % (self.server, method)
+        uri = "%s://%s/api/publish/v1/%s" % (self.scheme, self.server, method)
   
         # add object-addressible parameters to the URL line
         # in the example of __submit("read", { "id": 3 }) the URL end in /id/3
@@ -268,26 +492,25 @@ class Client:
         form_data["auth_user"]  = self.user
         form_data["api_key"]  = self.api_key
         form_data = urllib.urlencode(form_data)
-  
-        req = urllib2.Request(uri, form_data)
+
+        if download is None and not stream and self.hedging is not None and self.hedging.applies(method):
+            # each attempt is a separate request, and so on its own connection
+            return self.hedging.call(method, lambda: self.__fetch_json(method, uri, form_data))
   
         # by default, return the JSON value we get back from the server
         # unless a download location is specified 
-        if download is None:
+        if stream:
             try:
-                handle = urllib2.urlopen(req)
-                data = handle.read()
+                return self.__open(method, uri, form_data)
             except urllib2.HTTPError, he:
-                self.__convert_error_to_exception(he)
-            try:
-                return simplejson.loads(data)
-            except:
-                raise Exception("invalid JSON data returned from server: <<%s>>" % data)
+                self.__convert_error_to_exception(method, he)
+        elif download is None:
+            return self.__fetch_json(method, uri, form_data)
         else:
             try:
-                handle = urllib2.urlopen(req)
+                handle = self.__open(method, uri, form_data)
             except urllib2.HTTPError, he:
-                self.__convert_error_to_exception(he)
+                self.__convert_error_to_exception(method, he)
             fd = open(download, "w")
             while True:
                 data = handle.read(4092)
@@ -297,7 +520,81 @@ class Client:
             fd.close()
             return download
   
-    def __convert_error_to_exception(self, error):
+    def __fetch_json(self, method, uri, form_data):
+        """
+        Make the request and return the decoded JSON response.
+        """
+        if self.streaming_json:
+            try:
+                handle = self.__open(method, uri, form_data)
+            except urllib2.HTTPError, he:
+                self.__convert_error_to_exception(method, he)
+            try:
+                try:
+                    return self.__traced("decode", None, jsonstream.load, handle)
+                except ValueError, ve:
+                    raise Exception("invalid JSON data returned from server: %s" % ve)
+            finally:
+                handle.close()
+        try:
+            handle = self.__open(method, uri, form_data)
+            data = handle.read()
+        except urllib2.HTTPError, he:
+            self.__convert_error_to_exception(method, he)
+        try:
+            return self.__traced("decode", None, simplejson.loads, data)
+        except:
+            raise Exception("invalid JSON data returned from server: <<%s>>" % data)
+
+    def __open(self, method, uri, data=None, headers=None):
+        """
+        Send a request for an API method through the transport, recording it
+        in the metrics if there are any.
+        """
+        if self.metrics is None:
+            return self.__send(method, uri, data, headers)
+        if data is None or ctransport.is_streaming(data):
+            sent = int(dict([ (k.lower(), v) for (k, v) in (headers or {}).items() ]).get("content-length", 0))
+        else:
+            sent = len(data)
+        started = time.time()
+        try:
+            response = self.__send(method, uri, data, headers)
+        except urllib2.HTTPError, he:
+            self.metrics.record_request(method, time.time() - started, sent)
+            # a 500 carries the remote error type, recorded when it is converted
+            if he.code != 500:
+                self.metrics.record_error(method, "HTTP%d" % he.code)
+            raise
+        except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+            self.metrics.record_request(method, time.time() - started, sent)
+            self.metrics.record_error(method, e.__class__.__name__)
+            raise
+        return cmetrics.MeteredResponse(self.metrics, method, response, started, sent)
+
+    def __send(self, method, uri, data=None, headers=None):
+        """
+        Send a request through the transport, waiting for a slot from the
+        concurrency limiter if there is one and reporting back how the request went.
+        """
+        if self.limiter is None:
+            return self.transport.request(uri, data, headers)
+        token = self.limiter.acquire(method)
+        dropped = False
+        try:
+            try:
+                return self.transport.request(uri, data, headers)
+            except urllib2.HTTPError, he:
+                # 5xx and timeouts suggest an overloaded server, 4xx do not
+                dropped = he.code >= 500
+                raise
+            except (urllib2.URLError, socket.error, httplib.HTTPException):
+                dropped = True
+                raise
+        finally:
+            self.limiter.release(token, dropped=dropped)
+
+    def __convert_error_to_exception(self, method, error):
         """
         Given a remote exception, return a client exception that makes it appear local.
         The server may have returned formatted data about the reason behind the remote
@@ -311,7 +608,11 @@ class Client:
                 data = simplejson.loads(data)
             except:
                 # error data returned was not JSON, just raise a generic exception
+                if self.metrics is not None:
+                    self.metrics.record_error(method, "unknown")
                 raise Exception("Unexpected remote error: %s" % data)
+            if self.metrics is not None:
+                self.metrics.record_error(method, data.get("error_type", "unknown"))
             # add the error code into the packet and create the local exception 
             data["HTTPErrorCode"] = error.code
             data = simplejson.dumps(data)
@@ -329,9 +630,9 @@ class Client:
   
     def __assert_project(self, x, msg):
         """
-        Validate that x is a publish.common.Project
+        Validate that x is a publish.common.Project, or one already encoded
         """
-        assert (isinstance(x,cproject.Project)), msg
+        assert (isinstance(x,(cproject.Project,cencode.EncodedProject))), msg
   
     def __assert_valid_for_update(self, project_or_dict, msg):
         """
@@ -342,7 +643,7 @@ class Client:
         if type(project_or_dict) == type({}):
             assert project_or_dict.has_key("content_id"), msg
         else:
-            assert isinstance(project_or_dict, cproject.Project), msg
+            assert isinstance(project_or_dict, (cproject.Project, cencode.EncodedProject)), msg
 
 
 class ClientException(exceptions.Exception):
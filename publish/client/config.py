@@ -12,6 +12,27 @@ publish_api_server:  'api1.lulu.com'
 user: 'your-email@example.org'
 key: 'your-password-here'
 
+The file is read once per process by a shared ConfigProvider, and read again
+only when its modification time changes (checked at most every few seconds),
+so creating many Config or Client objects costs no disk I/O.
+
+Several accounts can be kept in one file as named profiles, whose values
+fall back to the [server] and [credentials] sections:
+
+[profile acme]
+user = books@acme.example.org
+key = acme-password
+api_key = acme-api-key
+
+    client = Client(profile="acme")
+
+Values are looked up, in order, in the overrides passed to Config(), those
+set with ConfigProvider.set_override(), the environment, the profile's
+section, and the [server] and [credentials] sections.  Environment variables
+are LULU_PUBLISH_API_ followed by the upper-cased option name, ex:
+LULU_PUBLISH_API_PUBLISH_API_SERVER.  Server options from the environment
+apply to every profile; credentials only to the default profile, which
+LULU_PUBLISH_API_PROFILE selects.
 
 Copyright 2010 Lulu Enterprises
 
@@ -19,15 +40,21 @@ Licensed under the Apache License, Version 2.0 (the "License"); you may not use
 
     http://www.apache.org/licenses/LICENSE-2.0
 
-Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License. 
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 """
 
 import ConfigParser
+import hashlib
 import os
 import sys
+import threading
+import time
 
 LOCAL_CONF = os.path.expanduser("~/.lulu_publish_api.conf")
 
+ENV_PREFIX = "LULU_PUBLISH_API_"
+PROFILE_ENV = "LULU_PUBLISH_API_PROFILE"
+
 # FIXME: for release, change these to api{1,2}.lulu.com
 CONFIG_DEFAULTS = """
 # Configuration file for Lulu Publication client library
@@ -42,51 +69,208 @@ key = password_here
 api_key = api_key_here
 """
 
+# option -> (section, default)
+OPTIONS = {
+    "auth_server"        : ("server", "127.0.0.1"),
+    "publish_api_server" : ("server", "127.0.0.1"),
+    "upload_server"      : ("server", "127.0.0.1"),
+    "scheme"             : ("server", "https"),
+    "user"               : ("credentials", None),
+    "key"                : ("credentials", None),
+    "api_key"            : ("credentials", None),
+}
+
+class ConfigProvider:
+    """
+    Process-wide, thread-safe cache of the configuration file.  Use
+    get_provider() for the shared instance.
+    """
+
+    def __init__(self, path=LOCAL_CONF, check_interval=2.0):
+        """
+        path:           the configuration file, created with placeholder values if missing
+        check_interval: seconds between checks of the file's modification time
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.sections = None  # section -> { option -> value }, replaced whole on reload
+        self.mtime = None
+        self.checked = 0
+        self.overrides = {}   # (profile, option) -> value
+
+    # ----------------------------------------------------------------------------
+
+    def __refresh(self):
+        now = time.time()
+        if self.sections is not None and now - self.checked < self.check_interval:
+            return
+        self.lock.acquire()
+        try:
+            if self.sections is not None and now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            if not os.path.exists(self.path):
+                # NOTE: this default config has various default values that are not usable
+                # so the get methods below will cause API failures further down the line once
+                # actually used.
+                fd = open(self.path, "w+")
+                fd.write(CONFIG_DEFAULTS)
+                fd.close()
+            mtime = os.stat(self.path).st_mtime
+            if self.sections is not None and mtime == self.mtime:
+                return
+            parser = ConfigParser.ConfigParser()
+            fp = open(self.path)
+            try:
+                parser.readfp(fp)
+            finally:
+                fp.close()
+            sections = {}
+            for section in parser.sections():
+                sections[section] = dict(parser.items(section, raw=True))
+            self.sections = sections
+            self.mtime = mtime
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def reload(self):
+        """
+        Read the file again on the next lookup, whether or not it has changed.
+        """
+        self.lock.acquire()
+        try:
+            self.checked = 0
+            self.mtime = None
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def profiles(self):
+        """
+        Names of the profiles defined in the file.
+        """
+        self.__refresh()
+        return [ s[len("profile "):].strip() for s in self.sections.keys() if s.startswith("profile ") ]
+
+    # ----------------------------------------------------------------------------
+
+    def set_override(self, option, value, profile=None):
+        """
+        Use value for option in profile (or the default profile), in place of
+        the file and environment.  A value of None removes the override.
+        """
+        assert OPTIONS.has_key(option), "unknown option: %s" % option
+        self.lock.acquire()
+        try:
+            if value is None:
+                self.overrides.pop((profile, option), None)
+            else:
+                self.overrides[(profile, option)] = value
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def get(self, option, profile=None):
+        """
+        The value of option for profile (None for the default profile).
+        """
+        (section, default) = OPTIONS[option]
+        value = self.overrides.get((profile, option))
+        if value is not None:
+            return value
+        if profile is None or section == "server":
+            value = os.environ.get(ENV_PREFIX + option.upper())
+            if value is not None:
+                return value
+        self.__refresh()
+        sections = self.sections
+        if profile is not None:
+            value = sections.get("profile %s" % profile, {}).get(option)
+            if value is not None:
+                return value
+        return sections.get(section, {}).get(option, default)
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_provider():
+    """
+    The shared ConfigProvider for LOCAL_CONF.
+    """
+    global _provider
+    if _provider is None:
+        _provider_lock.acquire()
+        try:
+            if _provider is None:
+                _provider = ConfigProvider()
+        finally:
+            _provider_lock.release()
+    return _provider
+
 class Config:
 
-    def __init__(self):
+    def __init__(self, profile=None, overrides=None, provider=None):
         """
         The configuration class will default to the values in ~/.lulu_publish_api.conf
         if it exists, if not, it will create the file.
+        profile:   named profile to use, default from LULU_PUBLISH_API_PROFILE
+        overrides: optional hash of option -> value taking precedence over everything else
+        provider:  ConfigProvider to read, default the shared one
         """
-        self.parser = ConfigParser.ConfigParser()
-        if os.path.exists(LOCAL_CONF):
-            fp = open(LOCAL_CONF)
-            self.parser.readfp(fp)
-            fp.close()
-        else:
-            # NOTE: this default config has various default values that are not usable
-            # so the get methods below will cause API failures further down the line once
-            # actually used.
-            fd = open(LOCAL_CONF, "w+")
-            fd.write(CONFIG_DEFAULTS)
-            fd.close()
+        if profile is None:
+            profile = os.environ.get(PROFILE_ENV) or None
+        if provider is None:
+            provider = get_provider()
+        self.profile = profile
+        self.overrides = overrides or {}
+        self.provider = provider
+
+    def __get(self, option):
+        if self.overrides.has_key(option):
+            return self.overrides[option]
+        return self.provider.get(option, self.profile)
+
+    def __where(self):
+        if self.profile is None:
+            return self.provider.path
+        return "profile %s of %s" % (self.profile, self.provider.path)
 
     def get_auth_server(self):
         """
         Connect to this server for all db requests
         """
-        return self.parser.get("server", "auth_server", "127.0.0.1")
+        return self.__get("auth_server")
 
     def get_publish_api_server(self):
         """
         Where is the PHP authentication endpoint?
         """
-        return self.parser.get("server", "publish_api_server", "127.0.0.1")
+        return self.__get("publish_api_server")
 
     def get_upload_server(self):
         """
         Where is the PHP authentication endpoint?
         """
-        return self.parser.get("server", "upload_server", "127.0.0.1")
+        return self.__get("upload_server")
+
+    def get_scheme(self):
+        """
+        'https', or 'http' for a local test server
+        """
+        return self.__get("scheme")
 
     def get_user(self):
         """
         Is the user password saved?
         """
-        user = self.parser.get("credentials", "user", None)
-        if user == "user@example.org":
-            raise Exception("User needs to be changed in %s" % LOCAL_CONF)
+        user = self.__get("user")
+        if user is None or user == "user@example.org":
+            raise Exception("User needs to be changed in %s" % self.__where())
         return user
 
 
@@ -94,17 +278,73 @@ class Config:
         """
         Is the key/password saved?
         """
-        key = self.parser.get("credentials", "key", None)
-        if key == "password_here":
-            raise Exception("Key needs to be changed in %s" % LOCAL_CONF)
+        key = self.__get("key")
+        if key is None or key == "password_here":
+            raise Exception("Key needs to be changed in %s" % self.__where())
         return key
 
     def get_api_key(self):
         """
         Is the api key saved?
         """
-        key = self.parser.get("credentials", "api_key", None)
-        if key == "api_key_here":
-            raise Exception("API key needs to be changed in %s" % LOCAL_CONF)
+        key = self.__get("api_key")
+        if key is None or key == "api_key_here":
+            raise Exception("API key needs to be changed in %s" % self.__where())
         return key
 
+class TokenCache:
+    """
+    Thread-safe cache of auth tokens by auth server, user and key, shared between
+    clients so that each account logs in once rather than once per client.
+    Tokens are kept for ttl seconds.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.tokens = {}  # (auth_server, user, key digest) -> (expires, token)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __key(self, auth_server, user, key):
+        # the password itself is not kept in memory longer than needed
+        return (auth_server, user, hashlib.sha1(key or "").hexdigest())
+
+    def get(self, auth_server, user, key):
+        """
+        The cached token, or None.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.tokens.get(self.__key(auth_server, user, key))
+            if entry is None or entry[0] < time.time():
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def put(self, auth_server, user, key, token):
+        self.lock.acquire()
+        try:
+            self.tokens[self.__key(auth_server, user, key)] = (time.time() + self.ttl, token)
+        finally:
+            self.lock.release()
+
+    def forget(self, auth_server, user, key):
+        self.lock.acquire()
+        try:
+            self.tokens.pop(self.__key(auth_server, user, key), None)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """
+        Cache counters as a hash, for metrics and logging.
+        """
+        self.lock.acquire()
+        try:
+            return { "tokens": len(self.tokens), "hits": self.hits, "misses": self.misses }
+        finally:
+            self.lock.release()
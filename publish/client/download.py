@@ -0,0 +1,211 @@
+"""
+Segmented parallel downloads of project output files.
+
+Client.download_file() fetches a file over one connection through the API.
+For large interior PDFs, DownloadManager instead resolves the file's direct
+URL with urls() and, when the server supports byte ranges, splits the file
+into segments fetched over several connections at once, each written in
+place into a preallocated file.  One TCP stream on a high-latency link is
+limited by its window; several streams are not.
+
+    manager = DownloadManager(client, connections_per_file=4, max_connections=16)
+    manager.download(content_id, "contents", "/tmp/interior.pdf")
+    for result in manager.download_many([ (cid, "contents", "/tmp/%s.pdf" % cid) for cid in ids ]):
+        print result.item, result.error
+
+max_connections caps the connections open across every file being fetched.
+Files are written to save_as + ".part" and renamed when complete.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os
+import re
+import threading
+import Queue
+import bulk
+import transport as ctransport
+import tracing
+
+BLOCK_SIZE = 65536
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+
+class DownloadError(Exception):
+    """
+    A download could not be completed, ex: the server sent fewer bytes than expected.
+    """
+    pass
+
+class DownloadManager:
+    """
+    Downloads contents and cover files through urls(), in parallel segments.
+    """
+
+    def __init__(self, client, segment_size=8*1048576, connections_per_file=4, max_connections=16,
+                 file_workers=4, retry=None):
+        """
+        client:               a logged in publish.client.client.Client
+        segment_size:         bytes per range request; files no larger are fetched whole
+        connections_per_file: connections used at once for one file
+        max_connections:      connections open at once across all downloads
+        file_workers:         files fetched at once by download_many
+        retry:                publish.client.bulk.RetryPolicy for each request
+        """
+        self.client = client
+        self.transport = getattr(client, "transport", None) or ctransport.UrllibTransport()
+        self.segment_size = segment_size
+        self.connections_per_file = connections_per_file
+        self.file_workers = file_workers
+        self.connections = threading.BoundedSemaphore(max_connections)
+        if retry is None:
+            retry = bulk.RetryPolicy()
+        self.retry = retry
+
+    # ----------------------------------------------------------------------------
+
+    def download(self, content_id, what_file, save_as):
+        """
+        Download the 'contents' or 'cover' file of a project to save_as, returning save_as.
+        """
+        assert what_file in [ "contents", "cover" ], "file type must be 'contents' or 'cover'"
+        url = self.client.urls(content_id)[what_file]
+        return self.download_url(url, save_as)
+
+    # ----------------------------------------------------------------------------
+
+    def download_many(self, items):
+        """
+        Download many (content_id, what_file, save_as) triples concurrently, yielding
+        a publish.client.bulk.BulkResult for each as it completes.
+        """
+        def one(item):
+            (content_id, what_file, save_as) = item
+            return self.download(content_id, what_file, save_as)
+        return bulk.run_parallel(one, items, workers=self.file_workers)
+
+    # ----------------------------------------------------------------------------
+
+    def download_url(self, url, save_as):
+        """
+        Download url to save_as, in segments if the server supports ranges.
+        """
+        partial = save_as + ".part"
+        try:
+            size = self.retry.call(self.__fetch_first, url, partial)
+            if size is not None:
+                segments = []
+                for start in range(self.segment_size, size, self.segment_size):
+                    segments.append((start, min(start + self.segment_size, size) - 1))
+                self.__fetch_segments(url, partial, segments)
+            os.rename(partial, save_as)
+        except:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return save_as
+
+    # ----------------------------------------------------------------------------
+
+    def __fetch_first(self, url, partial):
+        """
+        Fetch the first segment, learning the file size from the Content-Range.
+        Returns the size if the rest is to be fetched in segments, or None if the
+        server ignored the range and the whole file has been written.
+        """
+        self.connections.acquire()
+        try:
+            handle = self.transport.request(url, None, { "Range": "bytes=0-%s" % (self.segment_size - 1) })
+            try:
+                match = None
+                if handle.getcode() == 206:
+                    match = _CONTENT_RANGE.match(handle.info().getheader("Content-Range", ""))
+                fd = open(partial, "wb")
+                try:
+                    if match is None:
+                        # no range support: this is the whole file
+                        _copy(handle, fd, None)
+                        return None
+                    size = int(match.group(3))
+                    # preallocate, so segments can be written in place in any order
+                    fd.truncate(size)
+                    _copy(handle, fd, int(match.group(2)) + 1)
+                    return size
+                finally:
+                    fd.close()
+            finally:
+                handle.close()
+        finally:
+            self.connections.release()
+
+    # ----------------------------------------------------------------------------
+
+    def __fetch_segments(self, url, partial, segments):
+        """
+        Fetch byte ranges over up to connections_per_file connections.
+        """
+        if len(segments) == 0:
+            return
+        queue = Queue.Queue()
+        for segment in segments:
+            queue.put(segment)
+        errors = []
+        def work():
+            fd = open(partial, "r+b")
+            try:
+                while not errors:
+                    try:
+                        (start, end) = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self.retry.call(self.__fetch_segment, url, fd, start, end)
+                    except Exception, e:
+                        errors.append(e)
+            finally:
+                fd.close()
+        work = tracing.wrap(work)
+        threads = [ threading.Thread(target=work) for i in range(min(self.connections_per_file, len(segments))) ]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    # ----------------------------------------------------------------------------
+
+    def __fetch_segment(self, url, fd, start, end):
+        self.connections.acquire()
+        try:
+            handle = self.transport.request(url, None, { "Range": "bytes=%s-%s" % (start, end) })
+            try:
+                if handle.getcode() != 206:
+                    raise DownloadError("server ignored the range request for bytes %s-%s" % (start, end))
+                fd.seek(start)
+                _copy(handle, fd, end - start + 1)
+            finally:
+                handle.close()
+        finally:
+            self.connections.release()
+
+def _copy(handle, fd, expected):
+    """
+    Copy a response body into fd, checking its length if expected is not None.
+    """
+    copied = 0
+    while True:
+        data = handle.read(BLOCK_SIZE)
+        if data == "":
+            break
+        fd.write(data)
+        copied = copied + len(data)
+    if expected is not None and copied != expected:
+        raise DownloadError("expected %s bytes, received %s" % (expected, copied))
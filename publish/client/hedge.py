@@ -0,0 +1,205 @@
+"""
+Hedged requests for idempotent API calls.
+
+An occasional slow response dominates the tail latency of calls such as
+read and urls.  With a HedgePolicy, a call that has not answered within a
+chosen percentile of that method's recent latencies is sent a second time,
+on its own connection, and whichever answer arrives first is used.  Only
+methods that are safe to repeat are hedged, and a budget caps the extra
+requests as a fraction of all requests:
+
+    client = Client(hedging=HedgePolicy(percentile=95, budget=0.05))
+
+With the defaults at most about 5% more requests are sent, and only when a
+call is already slower than 95% of its recent peers.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import sys
+import threading
+import time
+import Queue
+import tracing
+
+# API methods whose repetition has no side effects
+IDEMPOTENT_METHODS = [ "read", "urls", "list", "base_cost" ]
+
+class LatencyTracker:
+    """
+    Keeps the most recent latencies of each method in a ring buffer.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.samples = {}
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def record(self, method, latency):
+        self.lock.acquire()
+        try:
+            samples = self.samples.setdefault(method, [])
+            if len(samples) < self.size:
+                samples.append(latency)
+            else:
+                position = self.positions.get(method, 0)
+                samples[position] = latency
+                self.positions[method] = (position + 1) % self.size
+        finally:
+            self.lock.release()
+
+    def count(self, method):
+        return len(self.samples.get(method, []))
+
+    def percentile(self, method, p):
+        """
+        The p-th percentile (0-100) of the recent latencies of method, or None.
+        """
+        self.lock.acquire()
+        try:
+            values = sorted(self.samples.get(method, []))
+        finally:
+            self.lock.release()
+        if len(values) == 0:
+            return None
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+class HedgePolicy:
+    """
+    Decides when to hedge and runs hedged calls.  Shared between threads.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, methods=IDEMPOTENT_METHODS,
+                 min_samples=20, min_delay=0.005, max_burst=10):
+        """
+        percentile:   hedge a call once it is slower than this percentile of its method
+        budget:       hedges allowed per request made, ex: 0.05 for 5% extra load
+        methods:      API methods that may be hedged
+        min_samples:  latencies needed for a method before it is hedged
+        min_delay:    never hedge sooner than this many seconds
+        max_burst:    unused budget that may accumulate, in hedges
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.methods = methods
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_burst = max_burst
+        self.tracker = LatencyTracker()
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    # ----------------------------------------------------------------------------
+
+    def applies(self, method):
+        return method in self.methods
+
+    # ----------------------------------------------------------------------------
+
+    def __take_token(self):
+        self.lock.acquire()
+        try:
+            if self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                self.hedges = self.hedges + 1
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def call(self, method, fn):
+        """
+        Return fn(), hedging with a second call to fn if the first is slow.
+        fn must be safe to run twice at once.  If every attempt fails, the
+        first failure is raised.
+        """
+        self.lock.acquire()
+        try:
+            self.requests = self.requests + 1
+            self.tokens = min(self.max_burst, self.tokens + self.budget)
+        finally:
+            self.lock.release()
+
+        delay = None
+        if self.tracker.count(method) >= self.min_samples:
+            delay = max(self.min_delay, self.tracker.percentile(method, self.percentile))
+
+        results = Queue.Queue()
+        def attempt(hedge):
+            start = time.time()
+            try:
+                value = fn()
+            except:
+                results.put((hedge, False, sys.exc_info()))
+                return
+            self.tracker.record(method, time.time() - start)
+            results.put((hedge, True, value))
+
+        if delay is None:
+            # not enough history to know what slow is; just make the call
+            start = time.time()
+            value = fn()
+            self.tracker.record(method, time.time() - start)
+            return value
+
+        self.__start(attempt, False)
+        outstanding = 1
+        try:
+            first = results.get(True, delay)
+        except Queue.Empty:
+            first = None
+            if self.__take_token():
+                self.__start(attempt, True)
+                outstanding = 2
+        errors = []
+        while True:
+            if first is None:
+                first = results.get()
+            (hedge, ok, value) = first
+            first = None
+            outstanding = outstanding - 1
+            if ok:
+                if hedge:
+                    self.lock.acquire()
+                    self.hedge_wins = self.hedge_wins + 1
+                    self.lock.release()
+                return value
+            errors.append(value)
+            if outstanding == 0:
+                (typ, val, tb) = errors[0]
+                raise typ, val, tb
+
+    # ----------------------------------------------------------------------------
+
+    def __start(self, attempt, hedge):
+        t = threading.Thread(target=tracing.wrap(attempt), args=(hedge,))
+        t.setDaemon(True)
+        t.start()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Counters and current hedge delays per method, as a hash.
+        """
+        delays = {}
+        for method in self.tracker.samples.keys():
+            delays[method] = self.tracker.percentile(method, self.percentile)
+        return {
+            "requests"   : self.requests,
+            "hedges"     : self.hedges,
+            "hedge_wins" : self.hedge_wins,
+            "delays"     : delays,
+        }
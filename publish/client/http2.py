@@ -0,0 +1,693 @@
+"""
+HTTP/2 transport: many concurrent API calls multiplexed over a few connections.
+
+With PooledTransport every request in flight holds a connection of its own.
+HTTP2Transport instead opens up to connections_per_host connections to each
+server and runs each request as a stream on one of them, so thousands of
+small read/urls/update calls share a handful of TCP and TLS sessions.
+
+Large bodies are flow controlled per stream: an upload is sent only as fast
+as the server opens its window, and a download's window is only reopened as
+the caller reads the response, so a slow reader does not buffer a whole file
+in memory.
+
+HTTP/2 is negotiated with ALPN.  A server that does not select "h2" is
+remembered and used over HTTP/1.1 through the fallback transport (by
+default a PooledTransport).  Plain http URLs also go over HTTP/1.1, unless
+prior_knowledge is set, in which case HTTP/2 is spoken directly (h2c), as
+to the stand-in server of publish.bench.h2server.
+
+    client = Client(transport=HTTP2Transport(connections_per_host=2))
+
+Requires the h2 package; the rest of the client does not.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import httplib
+import socket
+import threading
+import urlparse
+import Queue
+import transport as ctransport
+import tracing
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+# headers that describe an HTTP/1.1 connection and may not be sent over HTTP/2
+CONNECTION_HEADERS = [ "connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade", "host" ]
+
+READ_SIZE = 65536
+
+def available():
+    """
+    True if the h2 package is installed.
+    """
+    return h2 is not None
+
+class HTTP2Error(httplib.HTTPException):
+    """
+    A stream was reset or its connection lost.  Like other httplib errors,
+    publish.client.bulk.RetryPolicy treats it as transient.
+    """
+    pass
+
+class H2Channel:
+    """
+    One HTTP/2 connection over a socket, client or server side: the h2 state
+    machine, a writer thread, and flow-controlled sending.  All use of the h2
+    connection is under lock.  Bytes to send are queued to the writer thread,
+    so no thread ever blocks on the socket while holding the lock, and the
+    reader can always keep reading.
+    """
+
+    def __init__(self, sock, client_side=True, window_size=None):
+        self.sock = sock
+        config = h2.config.H2Configuration(client_side=client_side, header_encoding=None)
+        self.conn = h2.connection.H2Connection(config=config)
+        self.window_size = window_size
+        self.lock = threading.RLock()
+        self.window = threading.Condition(self.lock)  # notified when send windows may have opened
+        self.closed = False
+        self.outgoing = Queue.Queue()
+        self.writer = threading.Thread(target=self.__write)
+        self.writer.setDaemon(True)
+
+    # ----------------------------------------------------------------------------
+
+    def start(self):
+        self.writer.start()
+        self.lock.acquire()
+        try:
+            self.conn.initiate_connection()
+            if self.window_size:
+                self.conn.update_settings({ h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.window_size })
+                self.conn.increment_flow_control_window(self.window_size * 16)
+            self.flush()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def flush(self):
+        """
+        Queue whatever h2 has to send.  Call with lock held, so sends stay in order.
+        """
+        data = self.conn.data_to_send()
+        if data:
+            self.outgoing.put(data)
+
+    # ----------------------------------------------------------------------------
+
+    def __write(self):
+        try:
+            while True:
+                data = self.outgoing.get()
+                if data is None:
+                    return
+                self.sock.sendall(data)
+        except (socket.error, IOError):
+            self.close()
+
+    # ----------------------------------------------------------------------------
+
+    def send_headers(self, stream_id, headers, end_stream=False):
+        self.lock.acquire()
+        try:
+            self.conn.send_headers(stream_id, headers, end_stream=end_stream)
+            self.flush()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def send_data(self, stream_id, data, end_stream=False):
+        """
+        Send data on a stream as the peer's flow control windows allow,
+        waiting for them to open when they are exhausted.
+        """
+        offset = 0
+        while True:
+            self.lock.acquire()
+            try:
+                while True:
+                    if self.closed:
+                        raise HTTP2Error("connection closed")
+                    try:
+                        window = self.conn.local_flow_control_window(stream_id)
+                    except h2.exceptions.StreamClosedError:
+                        raise HTTP2Error("stream %s was closed by the peer" % stream_id)
+                    if window > 0 or offset == len(data):
+                        break
+                    self.window.wait()
+                size = min(window, self.conn.max_outbound_frame_size, len(data) - offset)
+                last = offset + size == len(data)
+                self.conn.send_data(stream_id, data[offset:offset + size], end_stream=(end_stream and last))
+                self.flush()
+                offset = offset + size
+            finally:
+                self.lock.release()
+            if offset == len(data):
+                return
+
+    # ----------------------------------------------------------------------------
+
+    def send_body(self, stream_id, body):
+        """
+        Send a whole request or response body and end the stream.  body is a
+        string, a file-like object or an iterable of strings.
+        """
+        if not ctransport.is_streaming(body):
+            return self.send_data(stream_id, body or "", end_stream=True)
+        if hasattr(body, "read"):
+            while True:
+                data = body.read(READ_SIZE)
+                if not data:
+                    break
+                self.send_data(stream_id, data)
+        else:
+            for data in body:
+                self.send_data(stream_id, data)
+        self.send_data(stream_id, "", end_stream=True)
+
+    # ----------------------------------------------------------------------------
+
+    def acknowledge(self, stream_id, nbytes):
+        """
+        Reopen the receive windows for nbytes the application has consumed.
+        """
+        if nbytes == 0:
+            return
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            try:
+                self.conn.acknowledge_received_data(nbytes, stream_id)
+            except h2.exceptions.StreamClosedError:
+                # the stream is gone, but the connection window still needs opening
+                self.conn.increment_flow_control_window(nbytes)
+            self.flush()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def reset(self, stream_id):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            try:
+                self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                self.flush()
+            except h2.exceptions.StreamClosedError:
+                pass
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def receive_loop(self, handle_event):
+        """
+        Read from the socket until it closes, passing each h2 event to
+        handle_event (called with lock held; it must not block).
+        """
+        try:
+            while True:
+                try:
+                    data = self.sock.recv(READ_SIZE)
+                except (socket.error, IOError):
+                    data = ""
+                if not data:
+                    return
+                self.lock.acquire()
+                try:
+                    try:
+                        events = self.conn.receive_data(data)
+                    except h2.exceptions.ProtocolError:
+                        self.flush()
+                        return
+                    self.flush()
+                    for event in events:
+                        if isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged,
+                                              h2.events.StreamReset)):
+                            self.window.notifyAll()
+                        handle_event(event)
+                        if isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                finally:
+                    self.lock.release()
+        finally:
+            self.close()
+
+    # ----------------------------------------------------------------------------
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.window.notifyAll()
+        finally:
+            self.lock.release()
+        self.outgoing.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, IOError):
+            pass
+        self.sock.close()
+
+class _H2Stream:
+    """
+    Events for one client stream, from the reader thread to the caller.
+    """
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.events = Queue.Queue()
+
+class _H2Body:
+    """
+    Reads a response body from its stream's events, acknowledging data as it
+    is consumed.  The stream's slot on the connection is given back once the
+    body ends or is closed.
+    """
+
+    def __init__(self, connection, stream, timeout):
+        self.connection = connection
+        self.stream = stream
+        self.timeout = timeout
+        self.buffer = ""
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or len(self.buffer) < size):
+            event = self.connection.next_event(self.stream, self.timeout)
+            if event[0] == "data":
+                self.buffer = self.buffer + event[1]
+                self.connection.channel.acknowledge(self.stream.stream_id, event[2])
+            elif event[0] == "end":
+                self.__finish(False)
+            elif event[0] == "error":
+                self.__finish(False)
+                raise event[1]
+        if size is None or size < 0:
+            (data, self.buffer) = (self.buffer, "")
+        else:
+            (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def close(self):
+        self.buffer = ""
+        if not self.done:
+            self.__finish(True)
+
+    def __finish(self, cancel):
+        self.done = True
+        if cancel:
+            self.connection.channel.reset(self.stream.stream_id)
+        self.connection.release(self.stream)
+
+class _H2ClientConnection:
+    """
+    A client HTTP/2 connection to one server, with a reader thread routing
+    events to the streams waiting for them.
+    """
+
+    def __init__(self, transport, key, sock):
+        self.transport = transport
+        self.key = key
+        self.channel = H2Channel(sock, True, transport.window_size)
+        self.streams = {}  # stream id -> _H2Stream
+        self.active = 0    # streams reserved or open, guarded by transport.cond
+        self.channel.start()
+        reader = threading.Thread(target=self.__read)
+        reader.setDaemon(True)
+        reader.start()
+
+    # ----------------------------------------------------------------------------
+
+    def is_open(self):
+        return not self.channel.closed
+
+    # ----------------------------------------------------------------------------
+
+    def max_streams(self):
+        limit = self.channel.conn.remote_settings.max_concurrent_streams
+        if self.transport.max_streams is not None:
+            limit = min(limit, self.transport.max_streams)
+        return limit
+
+    # ----------------------------------------------------------------------------
+
+    def __read(self):
+        try:
+            self.channel.receive_loop(self.__handle)
+        finally:
+            self.transport.cond.acquire()
+            try:
+                self.transport.cond.notifyAll()
+            finally:
+                self.transport.cond.release()
+            self.channel.lock.acquire()
+            try:
+                for stream in self.streams.values():
+                    stream.events.put(("error", HTTP2Error("connection to %s://%s lost" % self.key)))
+            finally:
+                self.channel.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def __handle(self, event):
+        stream = self.streams.get(getattr(event, "stream_id", None))
+        if isinstance(event, h2.events.ResponseReceived):
+            if stream is not None:
+                stream.events.put(("headers", event.headers))
+        elif isinstance(event, h2.events.DataReceived):
+            if stream is not None:
+                stream.events.put(("data", event.data, event.flow_controlled_length))
+            else:
+                self.channel.conn.increment_flow_control_window(event.flow_controlled_length)
+                self.channel.flush()
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.events.put(("end",))
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                stream.events.put(("error", HTTP2Error("stream reset by server, error code %s" % event.error_code)))
+
+    # ----------------------------------------------------------------------------
+
+    def next_event(self, stream, timeout):
+        try:
+            return stream.events.get(True, timeout)
+        except Queue.Empty:
+            self.channel.reset(stream.stream_id)
+            self.release(stream)
+            raise socket.timeout("timed out waiting for the server")
+
+    # ----------------------------------------------------------------------------
+
+    def release(self, stream):
+        """
+        Forget a finished stream and give its slot back.
+        """
+        self.channel.lock.acquire()
+        try:
+            if self.streams.pop(stream.stream_id, None) is None:
+                return
+        finally:
+            self.channel.lock.release()
+        self.transport.release_slot(self)
+
+    # ----------------------------------------------------------------------------
+
+    def request(self, url, method, selector, headers, body):
+        (scheme, netloc) = self.key
+        request_headers = [ (":method", method), (":path", selector), (":scheme", scheme), (":authority", netloc) ]
+        for (name, value) in headers.items():
+            if name.lower() not in CONNECTION_HEADERS:
+                request_headers.append((name.lower(), str(value)))
+        channel = self.channel
+        stream = None
+        try:
+            channel.lock.acquire()
+            try:
+                if channel.closed:
+                    raise HTTP2Error("connection to %s://%s lost" % self.key)
+                stream = _H2Stream(channel.conn.get_next_available_stream_id())
+                self.streams[stream.stream_id] = stream
+                channel.conn.send_headers(stream.stream_id, request_headers, end_stream=(body is None))
+                channel.flush()
+            finally:
+                channel.lock.release()
+            phase = tracing.start_span("write")
+            try:
+                if body is not None:
+                    channel.send_body(stream.stream_id, body)
+            finally:
+                phase.end()
+            phase = tracing.start_span("ttfb")
+            try:
+                event = self.next_event(stream, self.transport.timeout)
+            finally:
+                phase.end()
+            if event[0] == "error":
+                raise event[1]
+            if event[0] != "headers":
+                raise HTTP2Error("response without headers on stream %s" % stream.stream_id)
+        except:
+            # the slot was reserved for us before the stream existed
+            if stream is None:
+                self.transport.release_slot(self)
+            else:
+                self.release(stream)
+            raise
+        status = 0
+        response_headers = []
+        for (name, value) in event[1]:
+            if name == ":status":
+                status = int(value)
+            elif not name.startswith(":"):
+                response_headers.append((name, value))
+        return ctransport.Response(url, status, httplib.responses.get(status, ""),
+                                   _H2Body(self, stream, self.transport.timeout),
+                                   ctransport.make_headers(response_headers))
+
+class HTTP2Transport:
+    """
+    Requests as HTTP/2 streams, over at most connections_per_host connections
+    per scheme and host.  Thread-safe.
+    """
+
+    def __init__(self, connections_per_host=2, max_streams=None, window_size=1048576, timeout=None,
+                 prior_knowledge=False, ssl_context=None, fallback=None):
+        """
+        connections_per_host: HTTP/2 connections opened to each server
+        max_streams:     streams per connection, at most what the server allows
+        window_size:     receive window per stream, in bytes
+        timeout:         seconds to wait for connecting and for each response event
+        prior_knowledge: speak HTTP/2 to plain http URLs without negotiation
+        ssl_context:     ssl.SSLContext for https, ex: one trusting a test certificate
+        fallback:        transport for servers without HTTP/2, default a PooledTransport
+        """
+        if h2 is None:
+            raise Exception("HTTP2Transport requires the h2 package")
+        self.connections_per_host = connections_per_host
+        self.max_streams = max_streams
+        self.window_size = window_size
+        self.timeout = timeout
+        self.prior_knowledge = prior_knowledge
+        self.ssl_context = ssl_context
+        if fallback is None:
+            fallback = ctransport.PooledTransport(timeout=timeout)
+        self.fallback = fallback
+        self.http11 = {}       # (scheme, netloc) -> True, for servers that did not select h2
+        self.connections = {}  # (scheme, netloc) -> [ _H2ClientConnection ]
+        self.connecting = {}   # (scheme, netloc) -> connections being opened
+        self.cond = threading.Condition()
+        self.streams = 0
+
+    # ----------------------------------------------------------------------------
+
+    def request(self, url, body=None, headers=None):
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        key = (scheme, netloc)
+        if self.http11.has_key(key) or (scheme == "http" and not self.prior_knowledge):
+            return self.fallback.request(url, body, headers)
+        selector = path or "/"
+        if query:
+            selector = selector + "?" + query
+        headers = dict(headers or {})
+        method = "GET"
+        if body is not None:
+            method = "POST"
+            if not [ h for h in headers.keys() if h.lower() == "content-type" ]:
+                headers["Content-Type"] = ctransport.FORM_CONTENT_TYPE
+        span = ctransport.start_request_span(url, method)
+        connection = None
+        try:
+            connection = self.__reserve(key)
+            if connection is not None:
+                span.set_attribute("http.flavor", "2")
+                response = connection.request(url, method, selector, headers, body)
+        except Exception, e:
+            if connection is not None and not connection.is_open():
+                self.__forget(connection)
+            ctransport.end_request_span(span, e)
+            raise
+        if connection is None:
+            ctransport.end_request_span(span)
+            return self.fallback.request(url, body, headers)
+        span.set_attribute("http.status_code", response.getcode())
+        ctransport.end_request_span(span)
+        response = ctransport.traced_response(url, response, tracing.start_span("read", current=False))
+        return ctransport.check_status(url, response)
+
+    # ----------------------------------------------------------------------------
+
+    def __reserve(self, key):
+        """
+        A connection to key with a free stream, reserving the stream, or None
+        if the server turns out not to speak HTTP/2.
+        """
+        self.cond.acquire()
+        try:
+            while True:
+                connections = [ c for c in self.connections.get(key, []) if c.is_open() ]
+                self.connections[key] = connections
+                free = [ c for c in connections if c.active < c.max_streams() ]
+                if free:
+                    connection = min(free, key=lambda c: c.active)
+                    connection.active = connection.active + 1
+                    self.streams = self.streams + 1
+                    return connection
+                if self.http11.has_key(key):
+                    return None
+                if len(connections) + self.connecting.get(key, 0) < self.connections_per_host:
+                    self.connecting[key] = self.connecting.get(key, 0) + 1
+                    break
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        try:
+            connection = self.__connect(key)
+        except:
+            # a failed connect says nothing of the protocol the server speaks
+            self.cond.acquire()
+            try:
+                self.connecting[key] = self.connecting[key] - 1
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            raise
+        self.cond.acquire()
+        try:
+            self.connecting[key] = self.connecting[key] - 1
+            if connection is None:
+                self.http11[key] = True
+            else:
+                connection.active = 1
+                self.streams = self.streams + 1
+                self.connections.setdefault(key, []).append(connection)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        return connection
+
+    # ----------------------------------------------------------------------------
+
+    def __connect(self, key):
+        """
+        Open an HTTP/2 connection, or return None if ALPN does not select h2.
+        """
+        (scheme, netloc) = key
+        parts = netloc.rsplit(":", 1)
+        host = parts[0]
+        if len(parts) == 2 and parts[1].isdigit():
+            port = int(parts[1])
+        elif scheme == "https":
+            port = 443
+        else:
+            port = 80
+        if scheme == "https" and (ssl is None or not getattr(ssl, "HAS_ALPN", False)):
+            return None
+        phase = tracing.start_span("connect", { "net.peer.name": host })
+        try:
+            sock = socket.create_connection((host, port), self.timeout)
+        finally:
+            phase.end()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if scheme == "https":
+            context = self.ssl_context
+            if context is None:
+                context = ssl.create_default_context()
+            context.set_alpn_protocols([ "h2", "http/1.1" ])
+            phase = tracing.start_span("tls")
+            try:
+                sock = context.wrap_socket(sock, server_hostname=host)
+                phase.set_attribute("tls.alpn", sock.selected_alpn_protocol())
+            finally:
+                phase.end()
+            if sock.selected_alpn_protocol() != "h2":
+                sock.close()
+                return None
+        sock.settimeout(None)
+        return _H2ClientConnection(self, key, sock)
+
+    # ----------------------------------------------------------------------------
+
+    def release_slot(self, connection):
+        self.cond.acquire()
+        try:
+            connection.active = connection.active - 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    # ----------------------------------------------------------------------------
+
+    def __forget(self, connection):
+        self.cond.acquire()
+        try:
+            connections = self.connections.get(connection.key, [])
+            if connection in connections:
+                connections.remove(connection)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    # ----------------------------------------------------------------------------
+
+    def close(self):
+        """
+        Close every connection, HTTP/2 and fallback.
+        """
+        self.cond.acquire()
+        try:
+            (connections, self.connections) = (self.connections, {})
+        finally:
+            self.cond.release()
+        for conns in connections.values():
+            for connection in conns:
+                connection.channel.close()
+        if hasattr(self.fallback, "close"):
+            self.fallback.close()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Connection and stream counters as a hash, for metrics and logging.
+        """
+        self.cond.acquire()
+        try:
+            return {
+                "connections" : sum([ len(c) for c in self.connections.values() ]),
+                "active"      : sum([ c.active for conns in self.connections.values() for c in conns ]),
+                "streams"     : self.streams,
+                "http11_hosts": [ "%s://%s" % key for key in self.http11.keys() ],
+            }
+        finally:
+            self.cond.release()
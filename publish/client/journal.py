@@ -0,0 +1,480 @@
+"""
+Crash-resumable bulk publishing.
+
+JobJournal is an SQLite file recording, for every book of a bulk import,
+how far it has progressed through the publish steps and what the server
+returned along the way:
+
+    pending -> token -> uploaded -> creating -> created -> done      (or failed)
+
+Each step is recorded as soon as it succeeds, together with the
+upload_token or content_id it produced, so a run that dies is resumed by
+starting it again: finished books are skipped, uploaded books go straight
+to create, and so on.  Several worker threads (or processes sharing the
+file) claim jobs atomically, and a claim held longer than the lease by a
+worker that died is taken over.  While a worker processes a job it renews
+its claim every lease / 3 seconds, and every step it records checks that
+the claim is still its own, so a job taken over from a worker that only
+stalled is not carried on by both.
+
+    journal = JobJournal("import.journal")
+    journal.add_many((row["isbn"], spec_for(row)) for row in feed)
+    JournalRunner(client, journal, workers=8).run()
+    print journal.counts()
+
+Specs are the hashes PublishPipeline takes, plus an optional "update" hash
+of fields to send to update() once the project exists.
+
+create is not idempotent, so a book is marked creating before create is
+sent.  If the server answers with an error the create did not happen and
+the book goes back to uploaded.  But after a timeout, a dropped connection
+or a 5xx without an error report, or a crash, the project may exist.  Such
+a book stays creating and is never created again automatically: it is
+looked up among the account's projects by ISBN (or title, for books without
+one) and carried on with the content_id found.  If none or several match,
+it fails after max_attempts lookups.  Once someone has checked, resolve()
+records the content_id, or that the project does not exist, so that it is
+created on the next run:
+
+    for (job_id, state, error) in journal.failures():
+        ...
+    journal.resolve("9781234567897", content_id=1234567)
+    journal.resolve("9781234567890")
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib2
+import simplejson
+import publish.common.baseobj as baseobj
+import client as pclient
+import pipeline
+import tracing
+
+PENDING  = "pending"
+TOKEN    = "token"
+UPLOADED = "uploaded"
+CREATING = "creating"
+CREATED  = "created"
+DONE     = "done"
+FAILED   = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq          INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id       TEXT NOT NULL UNIQUE,
+    spec         TEXT NOT NULL,
+    state        TEXT NOT NULL,
+    upload_token TEXT,
+    content_id   INTEGER,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    error        TEXT,
+    failed_state TEXT,
+    claimed_by   TEXT,
+    claimed_at   REAL,
+    updated_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, claimed_at);
+"""
+
+class LeaseLost(Exception):
+    """
+    The claim on a job expired and another worker has taken it over.
+    """
+    pass
+
+class CreateUnknown(Exception):
+    """
+    A book whose create may have succeeded could not be matched to exactly
+    one project on the server.
+    """
+    pass
+
+class Job:
+    """
+    A claimed job: its id, spec and progress so far, and the worker claiming it.
+    """
+
+    def __init__(self, row, worker=None):
+        (self.job_id, spec, self.state, self.upload_token, self.content_id, self.attempts) = row
+        self.spec = simplejson.loads(spec)
+        self.worker = worker
+
+class JobJournal:
+    """
+    Durable record of bulk publishing jobs.  Safe to share between threads;
+    each thread gets its own database connection.
+    """
+
+    def __init__(self, path, lease=900, max_attempts=3):
+        """
+        lease:         seconds after which another worker may take over a claimed job
+        max_attempts:  failures after which a job is marked failed and left alone
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        db = self.__db()
+        db.executescript(SCHEMA)
+
+    # ----------------------------------------------------------------------------
+
+    def __db(self):
+        """
+        The calling thread's connection, in autocommit mode so that transactions
+        are explicit.
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    # ----------------------------------------------------------------------------
+
+    def add(self, job_id, spec):
+        """
+        Add a job unless one with the same id is already recorded.
+        """
+        self.add_many([ (job_id, spec) ])
+
+    # ----------------------------------------------------------------------------
+
+    def add_many(self, jobs):
+        """
+        Add (job_id, spec) pairs in one transaction.  Ids already in the journal
+        are ignored, so feeding the same input to a resumed run is harmless.
+        """
+        now = time.time()
+        rows = [ (str(job_id), simplejson.dumps(_serializable(spec)), PENDING, now) for (job_id, spec) in jobs ]
+        db = self.__db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT OR IGNORE INTO jobs (job_id, spec, state, updated_at) VALUES (?, ?, ?, ?)", rows)
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    # ----------------------------------------------------------------------------
+
+    def claim(self, worker):
+        """
+        Atomically claim the oldest unfinished job that is not claimed (or whose
+        claim has expired) for worker.  Returns a Job, or None if there is none.
+        """
+        now = time.time()
+        db = self.__db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT job_id, spec, state, upload_token, content_id, attempts FROM jobs " +
+                             "WHERE state NOT IN (?, ?) AND (claimed_by IS NULL OR claimed_at < ?) " +
+                             "ORDER BY seq LIMIT 1", (DONE, FAILED, now - self.lease)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET claimed_by = ?, claimed_at = ? WHERE job_id = ?", (worker, now, row[0]))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return Job(row, worker)
+
+    # ----------------------------------------------------------------------------
+
+    def touch(self, job):
+        """
+        Renew the claim on job, raising LeaseLost if it is no longer ours.
+        """
+        cursor = self.__db().execute("UPDATE jobs SET claimed_at = ? WHERE job_id = ? AND claimed_by = ?",
+                                     (time.time(), job.job_id, job.worker))
+        if cursor.rowcount == 0:
+            raise LeaseLost("job %s was taken over by another worker" % job.job_id)
+
+    # ----------------------------------------------------------------------------
+
+    def advance(self, job, state, upload_token=None, content_id=None):
+        """
+        Record that job has reached state, along with anything the step returned.
+        Raises LeaseLost, recording nothing, if the claim is no longer ours.
+        """
+        job.state = state
+        if upload_token is not None:
+            job.upload_token = upload_token
+        if content_id is not None:
+            job.content_id = content_id
+        now = time.time()
+        cursor = self.__db().execute("UPDATE jobs SET state = ?, upload_token = ?, content_id = ?, error = NULL, " +
+                                     "updated_at = ?, claimed_at = ? WHERE job_id = ? AND claimed_by = ?",
+                                     (state, job.upload_token, job.content_id, now, now, job.job_id, job.worker))
+        if cursor.rowcount == 0:
+            raise LeaseLost("job %s was taken over by another worker" % job.job_id)
+
+    # ----------------------------------------------------------------------------
+
+    def release(self, job, error=None):
+        """
+        Give up the claim on job.  If error is given the attempt counts as failed,
+        and after max_attempts the job is marked failed.  A job that failed while
+        holding an upload token goes back to pending, since tokens may expire.
+        Raises LeaseLost, changing nothing, if the claim is no longer ours.
+        """
+        now = time.time()
+        db = self.__db()
+        if error is None:
+            cursor = db.execute("UPDATE jobs SET claimed_by = NULL, claimed_at = NULL, updated_at = ? " +
+                                "WHERE job_id = ? AND claimed_by = ?", (now, job.job_id, job.worker))
+            if cursor.rowcount == 0:
+                raise LeaseLost("job %s was taken over by another worker" % job.job_id)
+            return
+        job.attempts = job.attempts + 1
+        state = job.state
+        if state == TOKEN:
+            state = PENDING
+            job.upload_token = None
+        failed_state = None
+        if job.attempts >= self.max_attempts:
+            (state, failed_state) = (FAILED, state)
+        cursor = db.execute("UPDATE jobs SET state = ?, failed_state = ?, upload_token = ?, attempts = ?, error = ?, " +
+                            "claimed_by = NULL, claimed_at = NULL, updated_at = ? WHERE job_id = ? AND claimed_by = ?",
+                            (state, failed_state, job.upload_token, job.attempts, str(error), now, job.job_id, job.worker))
+        if cursor.rowcount == 0:
+            raise LeaseLost("job %s was taken over by another worker" % job.job_id)
+
+    # ----------------------------------------------------------------------------
+
+    def counts(self):
+        """
+        Number of jobs in each state, as a hash.
+        """
+        results = {}
+        for (state, count) in self.__db().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            results[str(state)] = count
+        return results
+
+    # ----------------------------------------------------------------------------
+
+    def failures(self):
+        """
+        (job_id, state, error) for every job that has recorded an error.  For failed
+        jobs, state is the step that failed.
+        """
+        rows = self.__db().execute("SELECT job_id, COALESCE(failed_state, state), error FROM jobs " +
+                                   "WHERE error IS NOT NULL ORDER BY seq")
+        return [ (str(r[0]), str(r[1]), r[2]) for r in rows ]
+
+    # ----------------------------------------------------------------------------
+
+    def retry_failed(self):
+        """
+        Give failed jobs another max_attempts tries, from the step they failed at.
+        """
+        self.__db().execute("UPDATE jobs SET state = failed_state, failed_state = NULL, attempts = 0 " +
+                            "WHERE state = ?", (FAILED,))
+
+    # ----------------------------------------------------------------------------
+
+    def resolve(self, job_id, content_id=None):
+        """
+        Settle a job whose create may or may not have happened, once someone has
+        checked: with content_id, the project exists and the job carries on from
+        created; without, it does not and the job is created again.
+        """
+        if content_id is None:
+            state = UPLOADED
+        else:
+            state = CREATED
+        cursor = self.__db().execute("UPDATE jobs SET state = ?, content_id = ?, failed_state = NULL, attempts = 0, " +
+                                     "error = NULL, updated_at = ? WHERE job_id = ? AND " +
+                                     "(state = ? OR (state = ? AND failed_state = ?))",
+                                     (state, content_id, time.time(), str(job_id), CREATING, FAILED, CREATING))
+        assert cursor.rowcount == 1, "job %s is not waiting to be resolved" % job_id
+
+    # ----------------------------------------------------------------------------
+
+    def content_ids(self):
+        """
+        The content_ids recorded for jobs, as a hash content_id -> job_id.
+        """
+        rows = self.__db().execute("SELECT content_id, job_id FROM jobs WHERE content_id IS NOT NULL")
+        return dict([ (r[0], str(r[1])) for r in rows ])
+
+class JournalRunner:
+    """
+    Works through the jobs of a JobJournal with a pool of threads, resuming
+    each job from the last step recorded.  The client must be logged in.
+    """
+
+    def __init__(self, client, journal, workers=4):
+        self.client = client
+        self.journal = journal
+        self.workers = workers
+        self.finder = ProjectFinder(client)
+
+    def run(self):
+        """
+        Process jobs until none are left to claim, then return journal.counts().
+        """
+        threads = [ threading.Thread(target=tracing.wrap(self.__work)) for i in range(self.workers) ]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        return self.journal.counts()
+
+    def __work(self):
+        worker = "%s:%s:%s" % (socket.gethostname(), os.getpid(), threading.currentThread().getName())
+        while True:
+            job = self.journal.claim(worker)
+            if job is None:
+                return
+            heartbeat = _Heartbeat(self.journal, job)
+            heartbeat.start()
+            try:
+                try:
+                    self.process(job)
+                except LeaseLost:
+                    # the job is another worker's now
+                    pass
+                except Exception, e:
+                    self.journal.release(job, error=e)
+                else:
+                    self.journal.release(job)
+            except LeaseLost:
+                pass
+            finally:
+                heartbeat.stop()
+
+    def process(self, job):
+        """
+        Carry job from its current state to done, recording each step.
+        """
+        spec = job.spec
+        if job.state == PENDING:
+            token = self.client.request_upload_token()["token"]
+            self.journal.advance(job, TOKEN, upload_token=token)
+        if job.state == TOKEN:
+            self.client.upload(pipeline.spec_files(spec), job.upload_token)
+            self.journal.advance(job, UPLOADED)
+        if job.state == UPLOADED:
+            project = pipeline.build_project(spec)
+            self.journal.advance(job, CREATING)
+            try:
+                response = self.client.create(project)
+            except (pclient.ClientException, urllib2.HTTPError), e:
+                # the server reported an error, or refused the request: nothing was created
+                if isinstance(e, urllib2.HTTPError) and e.code >= 500:
+                    raise
+                self.journal.advance(job, UPLOADED)
+                raise
+            self.journal.advance(job, CREATED, content_id=response["content_id"])
+        if job.state == CREATING:
+            self.journal.advance(job, CREATED, content_id=self.find_created(job))
+        if job.state == CREATED:
+            if spec.get("update"):
+                delta = dict(spec["update"])
+                delta["content_id"] = job.content_id
+                self.client.update(delta)
+            self.journal.advance(job, DONE)
+
+    def find_created(self, job):
+        """
+        The content_id of the project job's create may have made, found by its
+        ISBN or title among those no other job has recorded.  Raises
+        CreateUnknown unless there is exactly one.
+        """
+        ds = pipeline.build_project(job.spec).to_datastruct()
+        isbn = (ds.get("isbn") or {}).get("number")
+        title = (ds.get("bibliography") or {}).get("title")
+        recorded = self.journal.content_ids()
+        matches = [ c for c in self.finder.find(isbn, title) if not recorded.has_key(c) ]
+        if len(matches) != 1:
+            raise CreateUnknown("job %s may have been created; %d projects match ISBN %s, title %r" %
+                                (job.job_id, len(matches), isbn, title))
+        return matches[0]
+
+class ProjectFinder:
+    """
+    Finds the account's projects by ISBN, or by title for books without one.
+    Projects are read once and remembered; each search reads only those
+    listed since the last.  Thread-safe.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        # content_id -> (isbn, title)
+        self.seen = {}
+
+    def find(self, isbn=None, title=None):
+        """
+        The content_ids of the projects with this ISBN or, if isbn is None, this title.
+        """
+        self.lock.acquire()
+        try:
+            for content_id in self.client.list_projects():
+                if not self.seen.has_key(content_id):
+                    ds = self.client.read(content_id).to_datastruct()
+                    self.seen[content_id] = ((ds.get("isbn") or {}).get("number"),
+                                             (ds.get("bibliography") or {}).get("title"))
+            if isbn:
+                return [ c for (c, (i, t)) in self.seen.items() if i == isbn ]
+            return [ c for (c, (i, t)) in self.seen.items() if title and t == title ]
+        finally:
+            self.lock.release()
+
+class _Heartbeat:
+    """
+    Renews the claim on a job every lease / 3 seconds, on a thread of its
+    own, while a step such as a long upload runs.
+    """
+
+    def __init__(self, journal, job):
+        self.journal = journal
+        self.job = job
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.journal.lease / 3.0)
+            if self.stopped.isSet():
+                return
+            try:
+                self.journal.touch(self.job)
+            except LeaseLost:
+                # the next step the job records will find out and stop
+                return
+
+def _serializable(spec):
+    """
+    A copy of spec with any BaseData objects converted to datastructures.
+    """
+    results = {}
+    for (k, v) in spec.iteritems():
+        if isinstance(v, baseobj.BaseData):
+            v = v.to_datastruct()
+        results[k] = v
+    return results
@@ -0,0 +1,249 @@
+"""
+Incremental JSON decoding for large API responses.
+
+simplejson needs the whole response body in memory before it can decode
+anything.  The functions here read a file-like object (such as the handle
+returned by urllib2.urlopen) a chunk at a time and produce results as soon
+as the bytes for them have arrived:
+
+    parse(fp)          yields (prefix, event, value) tuples, ijson style
+    items(fp, prefix)  yields each complete value found at prefix
+    load(fp)           decodes the whole document, without the raw copy
+
+A prefix is the dotted path to a value, with "item" standing for any array
+element, ex: "content_ids.item" for each id of {"content_ids": [1, 2, 3]}.
+If the ijson package is installed its tokenizer is used for items(); the
+pure Python parser below is the fallback.  Either way numbers come back as
+int or float, never Decimal.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import decimal
+import re
+import simplejson
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+BUF_SIZE = 16384
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?$')
+_NUMBER_CHARS = re.compile(r'[-+0-9.eE]+')
+_LITERALS = { "true": ("boolean", True), "false": ("boolean", False), "null": ("null", None) }
+_SCALARS = [ "string", "number", "boolean", "null" ]
+
+def _tokens(fp, buf_size):
+    """
+    Yields (kind, value) for each JSON token read from fp.  kind is one of the
+    punctuation characters or string/number/boolean/null.
+    """
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        need_more = pos >= len(buf)
+        if not need_more:
+            c = buf[pos]
+            if c in "{}[]:,":
+                yield (c, None)
+                pos = pos + 1
+                continue
+            elif c == '"':
+                m = _STRING.match(buf, pos)
+                if m is not None:
+                    token = m.group()
+                    if "\\" in token:
+                        yield ("string", simplejson.loads(token))
+                    else:
+                        yield ("string", token[1:-1].decode("utf-8"))
+                    pos = m.end()
+                    continue
+            elif c in "-0123456789":
+                m = _NUMBER_CHARS.match(buf, pos)
+                if m.end() < len(buf) or eof:
+                    token = m.group()
+                    if _NUMBER.match(token) is None:
+                        raise ValueError("invalid number %r" % token)
+                    if "." in token or "e" in token or "E" in token:
+                        yield ("number", float(token))
+                    else:
+                        yield ("number", int(token))
+                    pos = m.end()
+                    continue
+            else:
+                for (word, result) in _LITERALS.iteritems():
+                    if buf.startswith(word, pos):
+                        yield result
+                        pos = pos + len(word)
+                        break
+                else:
+                    if len(buf) - pos >= 5 or eof:
+                        raise ValueError("invalid JSON at %r" % buf[pos:pos+20])
+                    need_more = True
+                if not need_more:
+                    continue
+            need_more = True
+        if eof:
+            if pos < len(buf):
+                raise ValueError("truncated JSON at %r" % buf[pos:pos+20])
+            return
+        # keep the unread tail, and grow reads for tokens that span many chunks
+        buf = buf[pos:]
+        pos = 0
+        chunk = fp.read(max(buf_size, len(buf)))
+        if chunk == "":
+            eof = True
+        buf = buf + chunk
+
+def _join(prefix, key):
+    if prefix == "":
+        return key
+    return "%s.%s" % (prefix, key)
+
+def parse(fp, buf_size=BUF_SIZE):
+    """
+    Yields (prefix, event, value) for the JSON document read from fp.  Events are
+    start_map, map_key, end_map, start_array, end_array, string, number, boolean
+    and null, as in the ijson package.
+    """
+    stack = []  # [ "map" or "array", prefix, prefix of the current map value ]
+    done = False
+    for (kind, value) in _tokens(fp, buf_size):
+        if kind == "," or kind == ":":
+            continue
+        if done:
+            raise ValueError("unexpected %s after the end of the document" % kind)
+        if stack and stack[-1][0] == "map" and stack[-1][2] is None:
+            # between map entries, expecting a key or the end of the map
+            if kind == "}":
+                yield (stack.pop()[1], "end_map", None)
+            elif kind == "string":
+                stack[-1][2] = _join(stack[-1][1], value)
+                yield (stack[-1][1], "map_key", value)
+                continue
+            else:
+                raise ValueError("expected a key, got %s" % kind)
+        elif kind == "]":
+            if not stack or stack[-1][0] != "array":
+                raise ValueError("unexpected ]")
+            yield (stack.pop()[1], "end_array", None)
+        else:
+            if not stack:
+                prefix = ""
+            elif stack[-1][0] == "map":
+                prefix = stack[-1][2]
+            else:
+                prefix = _join(stack[-1][1], "item")
+            if kind == "{":
+                yield (prefix, "start_map", None)
+                stack.append([ "map", prefix, None ])
+                continue
+            elif kind == "[":
+                yield (prefix, "start_array", None)
+                stack.append([ "array", prefix, None ])
+                continue
+            elif kind in _SCALARS:
+                yield (prefix, kind, value)
+            else:
+                raise ValueError("unexpected %s" % kind)
+        # a value just finished, so a containing map wants its next key
+        if stack and stack[-1][0] == "map":
+            stack[-1][2] = None
+        done = not stack
+    if not done:
+        raise ValueError("truncated JSON document")
+
+class _Builder:
+    """
+    Assembles python objects from parse() events.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.keys = []
+        self.value = None
+
+    def event(self, event, value):
+        if event == "map_key":
+            self.keys[-1] = value
+        elif event == "start_map" or event == "start_array":
+            if event == "start_map":
+                obj = {}
+            else:
+                obj = []
+            self.__add(obj)
+            self.stack.append(obj)
+            self.keys.append(None)
+        elif event == "end_map" or event == "end_array":
+            self.stack.pop()
+            self.keys.pop()
+        else:
+            self.__add(value)
+        return len(self.stack) == 0
+
+    def __add(self, obj):
+        if not self.stack:
+            self.value = obj
+        elif type(self.stack[-1]) == type([]):
+            self.stack[-1].append(obj)
+        else:
+            self.stack[-1][self.keys[-1]] = obj
+
+def _events(fp, buf_size):
+    """
+    parse(fp), from ijson if it is installed, with its Decimals made floats.
+    """
+    if ijson is None:
+        return parse(fp, buf_size)
+    return _floats(ijson.parse(fp))
+
+def _floats(events):
+    for (prefix, event, value) in events:
+        if isinstance(value, decimal.Decimal):
+            value = float(value)
+        yield (prefix, event, value)
+
+def items(fp, prefix, buf_size=BUF_SIZE, required=False):
+    """
+    Yields every complete value found at prefix, ex: items(fp, "content_ids.item").
+    If required, raises KeyError at the end of a document without the value,
+    or the array for an "item" prefix, ex: with no content_ids at all.
+    """
+    container = prefix
+    while container == "item" or container.endswith(".item"):
+        container = container[:-5]
+    found = container == ""
+    builder = None
+    for (p, event, value) in _events(fp, buf_size):
+        if p == container and event != "map_key":
+            found = True
+        if builder is None:
+            if p != prefix or event == "map_key" or event.startswith("end_"):
+                continue
+            builder = _Builder()
+        if builder.event(event, value):
+            yield builder.value
+            builder = None
+    if required and not found:
+        raise KeyError("no %s in the JSON document" % container)
+
+def load(fp, buf_size=BUF_SIZE):
+    """
+    Decode the whole JSON document read from fp.
+    """
+    builder = _Builder()
+    for (prefix, event, value) in parse(fp, buf_size):
+        builder.event(event, value)
+    return builder.value
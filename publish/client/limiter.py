@@ -0,0 +1,176 @@
+"""
+Adaptive concurrency limiting for API requests.
+
+A fixed number of workers is either too few to keep the API busy or enough
+to overload it.  AdaptiveLimiter caps the requests in flight and moves the
+cap with what it observes, in the style of TCP congestion control:
+
+  * while latency stays near its no-load baseline and the cap is actually
+    being used, the cap grows by about one request per round trip
+  * when latency rises past tolerance times the baseline, or a request
+    times out or fails with a 5xx, the cap is cut by the backoff factor
+    (at most once per round trip, so one burst of errors is one cut)
+
+Latency is tracked per API method, since a multi-megabyte upload is not
+slow because a read takes 50 ms.  Methods in UNTIMED (file transfers,
+whose time depends on the file size) count toward the cap but are never
+judged by their latency, only by their errors.
+
+    limiter = AdaptiveLimiter(initial=4, max_limit=64)
+    client = Client(limiter=limiter)
+    ... run many requests from many threads ...
+    print limiter.snapshot()["limit"]
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import threading
+import time
+
+# methods whose latency says more about the payload than about the server load
+UNTIMED = [ "upload", "download" ]
+
+class AdaptiveLimiter:
+    """
+    Thread-safe AIMD limiter on concurrent requests, with a latency gradient.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, backoff=0.7, tolerance=2.0,
+                 short_alpha=0.2, long_alpha=0.02, untimed=None):
+        """
+        initial, min_limit, max_limit:  starting cap and the bounds it moves within
+        backoff:      factor applied to the cap on overload
+        tolerance:    latency above tolerance * baseline counts as overload
+        short_alpha:  weight of each sample in the recent latency average
+        long_alpha:   weight of each sample in the baseline average
+        untimed:      methods left out of the latency signal, by default UNTIMED
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.short_alpha = short_alpha
+        self.long_alpha = long_alpha
+        if untimed is None:
+            untimed = UNTIMED
+        self.untimed = untimed
+        self.limit = float(initial)
+        self.inflight = 0
+        # method -> [ recent latency, baseline ]
+        self.latencies = {}
+        self.last_decrease = 0
+        self.decreases = 0
+        self.drops = 0
+        self.cond = threading.Condition()
+
+    # ----------------------------------------------------------------------------
+
+    def acquire(self, method=None):
+        """
+        Block until a request for the API method may start.  Returns a token
+        to pass to release().
+        """
+        self.cond.acquire()
+        try:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight = self.inflight + 1
+            return (time.time(), self.inflight, method)
+        finally:
+            self.cond.release()
+
+    # ----------------------------------------------------------------------------
+
+    def release(self, token, dropped=False):
+        """
+        Report that the request started with acquire() has finished.  dropped
+        means it timed out or failed in a way that suggests overload (5xx).
+        """
+        (started, inflight_at_start, method) = token
+        now = time.time()
+        latency = now - started
+        self.cond.acquire()
+        try:
+            self.inflight = self.inflight - 1
+            if dropped:
+                self.drops = self.drops + 1
+                self.__decrease(now)
+            elif method not in self.untimed:
+                self.__sample(method, latency, inflight_at_start, now)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    # ----------------------------------------------------------------------------
+
+    def __sample(self, method, latency, inflight_at_start, now):
+        if not self.latencies.has_key(method):
+            self.latencies[method] = [ latency, latency ]
+            return
+        averages = self.latencies[method]
+        (short_latency, baseline) = averages
+        short_latency = short_latency + self.short_alpha * (latency - short_latency)
+        # the baseline follows decreases at once but increases only slowly
+        if latency < baseline:
+            baseline = latency
+        else:
+            baseline = baseline + self.long_alpha * (latency - baseline)
+        averages[0] = short_latency
+        averages[1] = baseline
+        if short_latency > self.tolerance * baseline:
+            self.__decrease(now)
+        elif inflight_at_start >= int(self.limit) / 2:
+            # only grow when the current cap is in use, or it grows without bound
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    # ----------------------------------------------------------------------------
+
+    def __round_trip(self):
+        """
+        The shortest recent latency of any method, how long one round trip takes.
+        """
+        if not self.latencies:
+            return 0
+        return min([ short_latency for (short_latency, baseline) in self.latencies.values() ])
+
+    # ----------------------------------------------------------------------------
+
+    def __decrease(self, now):
+        if now - self.last_decrease < self.__round_trip():
+            return
+        self.last_decrease = now
+        self.decreases = self.decreases + 1
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    # ----------------------------------------------------------------------------
+
+    def get_limit(self):
+        """
+        The current cap on requests in flight.
+        """
+        return int(self.limit)
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Current state as a hash, for metrics and logging.
+        """
+        self.cond.acquire()
+        try:
+            return {
+                "limit"          : int(self.limit),
+                "inflight"       : self.inflight,
+                "latency"        : dict([ (method, averages[0]) for (method, averages) in self.latencies.items() ]),
+                "baseline"       : dict([ (method, averages[1]) for (method, averages) in self.latencies.items() ]),
+                "decreases"      : self.decreases,
+                "drops"          : self.drops,
+            }
+        finally:
+            self.cond.release()
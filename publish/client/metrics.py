@@ -0,0 +1,428 @@
+"""
+Client metrics: what the client is doing, per API method, cheap enough to
+leave on.
+
+A Metrics passed to Client counts each method's requests (login, upload,
+read, create, ...), their latency in a fixed-bucket histogram, bytes sent
+and received, retries (from publish.client.bulk.ThrottledClient) and
+errors by type: the remote error_type of a ClientException, HTTPnnn for
+other HTTP errors, or the exception class for network failures.  It also
+collects, at snapshot time, the counters of the client's transport pool,
+limiter, hedging policy and caches.  Recording a request takes one lock
+and a bisect.
+
+    metrics = Metrics()
+    client = Client(metrics=metrics)
+    ...
+    print metrics.snapshot()["methods"]["read"]["count"]
+
+Snapshots go to sinks, each with a flush(snapshot) method: MemorySink keeps
+the latest, PrometheusSink writes the Prometheus text format to a file (for
+a node exporter's textfile collector; prometheus_text() gives the text
+alone), and StatsdSink pushes counter increments, gauges and mean latency
+over UDP.  A Reporter flushes a Metrics to its sinks every few seconds:
+
+    Reporter(metrics, [ StatsdSink("localhost", 8125) ], interval=10).start()
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import bisect
+import os
+import socket
+import threading
+import time
+
+# upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0 ]
+
+PROMETHEUS_PREFIX = "publish_client"
+
+class Histogram:
+    """
+    Counts of observations per bucket, with their sum.  Not locked; Metrics
+    guards its histograms with its own lock.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)  # the last counts values above every bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def percentile(self, p):
+        """
+        Estimate of the p-th percentile (0-100), interpolated within its bucket, or None.
+        """
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = i > 0 and self.buckets[i - 1] or 0.0
+                if i == len(self.buckets):
+                    return low
+                return low + (self.buckets[i] - low) * (rank - seen) / n
+            seen = seen + n
+        return self.buckets[-1]
+
+class _MethodStats:
+
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.errors = {}  # error type -> count
+
+class Metrics:
+    """
+    Thread-safe per-method request metrics, shareable between clients.
+    """
+
+    def __init__(self, buckets=None):
+        """
+        buckets: upper bounds of the latency histogram buckets in seconds, ascending
+        """
+        if buckets is None:
+            buckets = DEFAULT_BUCKETS
+        self.buckets = list(buckets)
+        self.methods = {}  # method -> _MethodStats
+        self.sources = {}  # name -> object with snapshot()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    # ----------------------------------------------------------------------------
+
+    def __stats(self, method):
+        # call with lock held
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = _MethodStats(self.buckets)
+        return stats
+
+    # ----------------------------------------------------------------------------
+
+    def record_request(self, method, seconds, sent=0, received=0):
+        self.lock.acquire()
+        try:
+            stats = self.__stats(method)
+            stats.latency.observe(seconds)
+            stats.bytes_sent = stats.bytes_sent + sent
+            stats.bytes_received = stats.bytes_received + received
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def record_error(self, method, error_type):
+        self.lock.acquire()
+        try:
+            errors = self.__stats(method).errors
+            errors[error_type] = errors.get(error_type, 0) + 1
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def record_retry(self, method, error=None):
+        self.lock.acquire()
+        try:
+            stats = self.__stats(method)
+            stats.retries = stats.retries + 1
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def add_source(self, name, source):
+        """
+        Include source.snapshot(), a hash, in every snapshot under name, ex:
+        a PooledTransport as "transport".  Client adds its own parts itself.
+        """
+        self.lock.acquire()
+        try:
+            self.sources[name] = source
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Everything recorded so far as a hash, suitable for JSON:
+        { "time", "uptime", "methods": { method: { "count", "seconds_sum",
+        "buckets": [ [ upper bound, count ], ... ], "p50", "p99", "bytes_sent",
+        "bytes_received", "retries", "errors": { type: count } } },
+        "sources": { name: { counter: value } } }
+        """
+        self.lock.acquire()
+        try:
+            methods = {}
+            for (method, stats) in self.methods.iteritems():
+                latency = stats.latency
+                methods[method] = {
+                    "count"          : latency.count,
+                    "seconds_sum"    : latency.sum,
+                    "buckets"        : [ [ b, n ] for (b, n) in zip(self.buckets + [ None ], latency.counts) ],
+                    "p50"            : latency.percentile(50),
+                    "p99"            : latency.percentile(99),
+                    "bytes_sent"     : stats.bytes_sent,
+                    "bytes_received" : stats.bytes_received,
+                    "retries"        : stats.retries,
+                    "errors"         : dict(stats.errors),
+                }
+            sources = self.sources.items()
+        finally:
+            self.lock.release()
+        snapshots = {}
+        for (name, source) in sources:
+            snapshots[name] = source.snapshot()
+        now = time.time()
+        return { "time": now, "uptime": now - self.started, "methods": methods, "sources": snapshots }
+
+class MeteredResponse:
+    """
+    Wraps a transport response, counting the bytes read and recording the
+    request once the body has been read to the end or closed.
+    """
+
+    def __init__(self, metrics, method, response, started, sent):
+        self.metrics = metrics
+        self.method = method
+        self.response = response
+        self.started = started
+        self.sent = sent
+        self.received = 0
+        self.done = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.received = self.received + len(data)
+        if not data or size is None or size < 0:
+            self.__finish()
+        return data
+
+    def close(self):
+        self.response.close()
+        self.__finish()
+
+    def __finish(self):
+        if not self.done:
+            self.done = True
+            self.metrics.record_request(self.method, time.time() - self.started, self.sent, self.received)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+def _numbers(value, prefix=""):
+    """
+    The numeric leaves of a snapshot hash, as (dotted name, number) pairs.
+    """
+    pairs = []
+    if type(value) == type({}):
+        for (k, v) in sorted(value.items()):
+            pairs.extend(_numbers(v, prefix and "%s.%s" % (prefix, k) or str(k)))
+    elif type(value) == type(True):
+        pairs.append((prefix, int(value)))
+    elif type(value) in [ type(0), type(0L), type(0.0) ]:
+        pairs.append((prefix, value))
+    return pairs
+
+def _prometheus_name(name):
+    return "".join([ (c.isalnum() and c or "_") for c in name ])
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def prometheus_text(snapshot, prefix=PROMETHEUS_PREFIX):
+    """
+    A snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    methods = sorted(snapshot["methods"].items())
+    def metric(name, kind, help):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+    metric("request_seconds", "histogram", "Latency of API requests by method.")
+    for (method, stats) in methods:
+        label = _prometheus_label(method)
+        cumulative = 0
+        for (bound, n) in stats["buckets"]:
+            cumulative = cumulative + n
+            le = bound is None and "+Inf" or repr(bound)
+            lines.append('%s_request_seconds_bucket{method="%s",le="%s"} %d' % (prefix, label, le, cumulative))
+        lines.append('%s_request_seconds_sum{method="%s"} %r' % (prefix, label, stats["seconds_sum"]))
+        lines.append('%s_request_seconds_count{method="%s"} %d' % (prefix, label, stats["count"]))
+    for (field, help) in [ ("bytes_sent", "Request bytes sent by method."),
+                           ("bytes_received", "Response bytes received by method."),
+                           ("retries", "Retried calls by method.") ]:
+        metric("%s_total" % field, "counter", help)
+        for (method, stats) in methods:
+            lines.append('%s_%s_total{method="%s"} %d' % (prefix, field, _prometheus_label(method), stats[field]))
+    metric("errors_total", "counter", "Failed requests by method and error type.")
+    for (method, stats) in methods:
+        for (error_type, n) in sorted(stats["errors"].items()):
+            lines.append('%s_errors_total{method="%s",type="%s"} %d' % (
+                prefix, _prometheus_label(method), _prometheus_label(error_type), n))
+    for (name, value) in _numbers(snapshot["sources"]):
+        gauge = "%s_%s" % (prefix, _prometheus_name(name))
+        lines.append("# TYPE %s gauge" % gauge)
+        lines.append("%s %r" % (gauge, value))
+    return "\n".join(lines) + "\n"
+
+class MemorySink:
+    """
+    Keeps the latest snapshot flushed to it.
+    """
+
+    def __init__(self):
+        self.last = None
+        self.flushes = 0
+
+    def flush(self, snapshot):
+        self.last = snapshot
+        self.flushes = self.flushes + 1
+
+class PrometheusSink:
+    """
+    Writes each snapshot to path in the Prometheus text format, replacing the
+    file atomically, as a node exporter's textfile collector expects.
+    """
+
+    def __init__(self, path, prefix=PROMETHEUS_PREFIX):
+        self.path = path
+        self.prefix = prefix
+
+    def flush(self, snapshot):
+        temp = "%s.%s.tmp" % (self.path, os.getpid())
+        fd = open(temp, "w")
+        try:
+            fd.write(prometheus_text(snapshot, self.prefix))
+        finally:
+            fd.close()
+        os.rename(temp, self.path)
+
+class StatsdSink:
+    """
+    Pushes each snapshot to a StatsD server over UDP: counters as the
+    increase since the last flush, the sources' numbers as gauges, and each
+    method's mean latency over the interval as a timing.  Sends are fire and
+    forget; a missing server costs nothing.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="publish.client", max_packet=512):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.max_packet = max_packet
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.last = {}  # counter name -> value at the last flush
+
+    # ----------------------------------------------------------------------------
+
+    def lines(self, snapshot):
+        """
+        The StatsD lines for a snapshot, updating the counters last sent.
+        """
+        lines = []
+        for (method, stats) in sorted(snapshot["methods"].items()):
+            counters = [ ("requests.%s" % method, stats["count"]), ("bytes_sent.%s" % method, stats["bytes_sent"]),
+                         ("bytes_received.%s" % method, stats["bytes_received"]),
+                         ("retries.%s" % method, stats["retries"]) ]
+            for (error_type, n) in stats["errors"].items():
+                counters.append(("errors.%s.%s" % (method, error_type), n))
+            requests = stats["count"] - self.last.get(counters[0][0], 0)
+            for (key, value) in counters:
+                delta = value - self.last.get(key, 0)
+                self.last[key] = value
+                if delta:
+                    lines.append("%s.%s:%d|c" % (self.prefix, key, delta))
+            key = "seconds_sum.%s" % method
+            seconds = stats["seconds_sum"] - self.last.get(key, 0)
+            self.last[key] = stats["seconds_sum"]
+            if requests:
+                lines.append("%s.latency.%s:%.3f|ms" % (self.prefix, method, seconds * 1000 / requests))
+        for (name, value) in _numbers(snapshot["sources"]):
+            lines.append("%s.%s:%s|g" % (self.prefix, name, value))
+        return lines
+
+    # ----------------------------------------------------------------------------
+
+    def flush(self, snapshot):
+        packet = ""
+        for line in self.lines(snapshot):
+            if packet and len(packet) + len(line) + 1 > self.max_packet:
+                self.__send(packet)
+                packet = ""
+            packet = packet and packet + "\n" + line or line
+        if packet:
+            self.__send(packet)
+
+    # ----------------------------------------------------------------------------
+
+    def __send(self, packet):
+        try:
+            self.sock.sendto(packet, self.address)
+        except socket.error:
+            pass
+
+class Reporter:
+    """
+    Flushes snapshots of metrics to sinks every interval seconds, on a
+    background thread, and once more when stopped.
+    """
+
+    def __init__(self, metrics, sinks, interval=10.0):
+        self.metrics = metrics
+        self.sinks = sinks
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    # ----------------------------------------------------------------------------
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    # ----------------------------------------------------------------------------
+
+    def __run(self):
+        while not self.stopping.isSet():
+            self.stopping.wait(self.interval)
+            self.flush()
+
+    # ----------------------------------------------------------------------------
+
+    def flush(self):
+        snapshot = self.metrics.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.flush(snapshot)
+            except (IOError, OSError, socket.error):
+                # a sink that cannot be written to must not stop the others
+                pass
+
+    # ----------------------------------------------------------------------------
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,331 @@
+"""
+Pipelined publishing of many books.
+
+Publishing one book is request_upload_token -> upload -> create.  Doing that
+serially for every book leaves the network idle while projects are built and
+the API idle while files upload.  PublishPipeline runs each stage on its own
+pool of threads, connected by bounded queues:
+
+    tokens   token_workers threads keep up to token_prefetch tokens ready for
+             the books read so far, and stop once every book has one
+    upload   upload_workers threads pair a book with a token and upload its files
+    create   create_workers threads create the project once its files have landed
+
+A slow stage fills the queue in front of it, which in turn stalls the stages
+feeding it, so memory stays bounded and throughput approaches that of the
+slowest stage.  Each book spec is a hash:
+
+    {
+        "project" : publish.common.project.Project() or a hash for one,
+        "files"   : { "cover": "/path/cover.pdf", "contents": "/path/interior.pdf" },
+        "key"     : optional caller identifier, passed through to the result
+    }
+
+If the project has no file_info, one is filled in from the uploaded file names.
+
+    pipeline = PublishPipeline(client, upload_workers=4)
+    for result in pipeline.run(specs):
+        print result.index, result.content_id, result.error
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os.path
+import threading
+import Queue
+import publish.common.project as cproject
+import tracing
+
+# marks the end of the work for one consumer thread
+_DONE = object()
+
+class PublishResult:
+    """
+    The outcome for one book spec.  index is the position of the spec in the
+    input.  On failure, stage names the step that failed and error holds the
+    exception; otherwise content_id and response are those returned by create.
+    """
+
+    def __init__(self, index, spec, response=None, stage=None, error=None):
+        self.index = index
+        self.spec = spec
+        self.key = spec.get("key")
+        self.response = response
+        self.stage = stage
+        self.error = error
+        self.content_id = None
+        if type(response) == type({}):
+            self.content_id = response.get("content_id")
+
+    def ok(self):
+        return self.error is None
+
+def spec_files(spec):
+    """
+    The list of file names to upload for a book spec, covers first.
+    """
+    files = spec.get("files", {})
+    results = []
+    for what in [ "cover", "contents" ]:
+        value = files.get(what, [])
+        if type(value) != type([]):
+            value = [ value ]
+        results.extend(value)
+    return results
+
+def build_project(spec):
+    """
+    The Project to create for a book spec, with file_info filled in from the
+    spec's files if the project does not already describe them.
+    """
+    proj = spec["project"]
+    if type(proj) == type({}):
+        proj = cproject.Project(proj)
+    file_info = proj.get("file_info")
+    if file_info is None or (not file_info.get("cover") and not file_info.get("contents")):
+        files = spec.get("files", {})
+        details = {}
+        for what in [ "cover", "contents" ]:
+            value = files.get(what, [])
+            if type(value) != type([]):
+                value = [ value ]
+            details[what] = [ cproject.FileDetails({ "mimetype": "application/pdf", "filename": os.path.basename(f) }) for f in value ]
+        proj.set("file_info", cproject.FileInfo(details))
+    return proj
+
+class PublishPipeline:
+    """
+    Overlaps token requests, uploads and creates across many books.
+    The client must already be logged in.
+    """
+
+    def __init__(self, client, token_workers=1, upload_workers=4, create_workers=2,
+                 token_prefetch=None, queue_size=None):
+        """
+        token_workers:   threads requesting upload tokens
+        upload_workers:  threads uploading files, usually the bottleneck
+        create_workers:  threads calling create
+        token_prefetch:  tokens to keep ready, at most one per book read (default: 2 per upload worker)
+        queue_size:      bound on books waiting between stages (default: 2 per worker)
+        """
+        self.client = client
+        self.token_workers = token_workers
+        self.upload_workers = upload_workers
+        self.create_workers = create_workers
+        if token_prefetch is None:
+            token_prefetch = 2 * upload_workers
+        self.token_prefetch = token_prefetch
+        self.queue_size = queue_size
+
+    # ----------------------------------------------------------------------------
+
+    def run(self, specs):
+        """
+        Publish every spec in the iterable, yielding a PublishResult for each as
+        soon as it completes (not necessarily in input order).  specs is consumed
+        lazily, only as fast as the uploads progress.  Each call has state of its
+        own, so one pipeline may run several at once.
+        """
+        return _Run(self, specs).results()
+
+class _Run:
+    """
+    The queues, threads and counters of one PublishPipeline.run() call.
+    """
+
+    def __init__(self, pipeline, specs):
+        self.client = pipeline.client
+        self.token_workers = pipeline.token_workers
+        self.upload_workers = pipeline.upload_workers
+        self.create_workers = pipeline.create_workers
+        self.specs = specs
+        qsize = pipeline.queue_size
+        if qsize is None:
+            qsize = 2 * max(self.upload_workers, self.create_workers)
+        self.stop = threading.Event()
+        self.pending = Queue.Queue(qsize)
+        self.tokens = Queue.Queue(pipeline.token_prefetch)
+        self.uploaded = Queue.Queue(qsize)
+        self.results_queue = Queue.Queue(qsize)
+        self.lock = threading.Lock()
+        self.uploaders_left = self.upload_workers
+        self.creators_left = self.create_workers
+        # books read from specs that no token has been requested for yet
+        self.unserved = 0
+        self.fed_all = False
+        self.wanted = threading.Condition(self.lock)
+        self.feed_error = None
+
+    # ----------------------------------------------------------------------------
+
+    def results(self):
+        threads = [ threading.Thread(target=tracing.wrap(self.__feed)) ]
+        threads.extend([ threading.Thread(target=tracing.wrap(self.__request_tokens)) for i in range(self.token_workers) ])
+        threads.extend([ threading.Thread(target=tracing.wrap(self.__upload)) for i in range(self.upload_workers) ])
+        threads.extend([ threading.Thread(target=tracing.wrap(self.__create)) for i in range(self.create_workers) ])
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        try:
+            while True:
+                result = self.__get(self.results_queue)
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            self.stop.set()
+            for queue in [ self.tokens, self.pending, self.uploaded, self.results_queue ]:
+                self.__drain(queue)
+        if self.feed_error is not None:
+            raise self.feed_error
+
+    # ----------------------------------------------------------------------------
+
+    def __feed(self):
+        """
+        Move specs from the caller's iterable into the bounded pending queue,
+        asking the token workers for a token for each.
+        """
+        try:
+            try:
+                for (index, spec) in enumerate(self.specs):
+                    if not self.__put(self.pending, (index, spec)):
+                        return
+                    self.wanted.acquire()
+                    try:
+                        self.unserved = self.unserved + 1
+                        self.wanted.notify()
+                    finally:
+                        self.wanted.release()
+            except Exception, e:
+                self.feed_error = e
+        finally:
+            self.wanted.acquire()
+            try:
+                self.fed_all = True
+                self.wanted.notifyAll()
+            finally:
+                self.wanted.release()
+            for i in range(self.upload_workers):
+                self.__put(self.pending, _DONE)
+
+    # ----------------------------------------------------------------------------
+
+    def __request_tokens(self):
+        """
+        Request a token for each book read from specs, ahead of its upload as
+        far as the token queue allows, and stop once every book has one.  A
+        failed request is queued too, so the book that draws it reports the error.
+        """
+        while True:
+            self.wanted.acquire()
+            try:
+                while self.unserved == 0 and not self.fed_all and not self.stop.isSet():
+                    self.wanted.wait(0.5)
+                if self.unserved == 0 or self.stop.isSet():
+                    return
+                self.unserved = self.unserved - 1
+            finally:
+                self.wanted.release()
+            try:
+                token = self.client.request_upload_token()["token"]
+            except Exception, e:
+                token = e
+            if not self.__put(self.tokens, token):
+                return
+
+    # ----------------------------------------------------------------------------
+
+    def __upload(self):
+        while True:
+            item = self.__get(self.pending)
+            if item is _DONE:
+                break
+            (index, spec) = item
+            token = self.__get(self.tokens)
+            if token is _DONE:
+                break
+            if isinstance(token, Exception):
+                self.__put(self.results_queue, PublishResult(index, spec, stage="request_upload_token", error=token))
+                continue
+            try:
+                self.client.upload(spec_files(spec), token)
+            except Exception, e:
+                self.__put(self.results_queue, PublishResult(index, spec, stage="upload", error=e))
+                continue
+            if not self.__put(self.uploaded, (index, spec)):
+                break
+        self.lock.acquire()
+        try:
+            self.uploaders_left = self.uploaders_left - 1
+            last = self.uploaders_left == 0
+        finally:
+            self.lock.release()
+        if last:
+            for i in range(self.create_workers):
+                self.__put(self.uploaded, _DONE)
+
+    # ----------------------------------------------------------------------------
+
+    def __create(self):
+        while True:
+            item = self.__get(self.uploaded)
+            if item is _DONE:
+                break
+            (index, spec) = item
+            try:
+                response = self.client.create(build_project(spec))
+            except Exception, e:
+                self.__put(self.results_queue, PublishResult(index, spec, stage="create", error=e))
+                continue
+            self.__put(self.results_queue, PublishResult(index, spec, response=response))
+        self.lock.acquire()
+        try:
+            self.creators_left = self.creators_left - 1
+            last = self.creators_left == 0
+        finally:
+            self.lock.release()
+        if last:
+            self.__put(self.results_queue, _DONE)
+
+    # ----------------------------------------------------------------------------
+
+    def __put(self, queue, item):
+        """
+        Blocking put that gives up, returning False, if the run is stopped.
+        """
+        while not self.stop.isSet():
+            try:
+                queue.put(item, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    # ----------------------------------------------------------------------------
+
+    def __get(self, queue):
+        """
+        Blocking get that returns _DONE if the run is stopped.
+        """
+        while not self.stop.isSet():
+            try:
+                return queue.get(True, 0.5)
+            except Queue.Empty:
+                pass
+        return _DONE
+
+    # ----------------------------------------------------------------------------
+
+    def __drain(self, queue):
+        try:
+            while True:
+                queue.get_nowait()
+        except Queue.Empty:
+            pass
@@ -0,0 +1,470 @@
+"""
+Local preflight of PDF files, before they are uploaded.
+
+get_base_cost needs a page count, and a PDF that is damaged or of the wrong
+page size is only rejected after a full upload.  preflight() reads the
+page count and page sizes of a PDF locally, memory-mapping the file and
+looking only for the page tree, so it costs about as much as reading the
+file once, however many pages it has:
+
+    result = preflight("interior.pdf")
+    if result.ok() and not check_project(result, proj):
+        cost = client.get_base_cost(proj.to_json(), result.page_count)
+
+The page count is the /Count of the root of the page tree, found in the
+file or, for PDF 1.5 files, in its compressed object streams.  Page sizes
+are the distinct /TrimBox sizes of the file, or its /MediaBox sizes if it
+has no trim boxes, in points; trim_sizes names the PhysicalAttributes
+trim sizes that every page size matches, with or without bleed.  Page
+rotation is not taken into account.  Boxes given as indirect references
+are not seen.
+
+preflight_many() checks many files on a pool of processes, yielding the
+results in input order.  With a PreflightCache, files already checked are
+recognized by their SHA-1, and files unchanged since (same path, size and
+modification time) are not even hashed again; the cache can be kept in a
+file between runs:
+
+    cache = PreflightCache("~/.lulu_preflight")
+    for result in preflight_many(paths, cache=cache):
+        if not result.ok():
+            print result.path, "; ".join(result.errors)
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+import zlib
+import simplejson
+
+POINTS_PER_INCH = 72.0
+
+# PhysicalAttributes trim size -> (width, height) in inches
+TRIM_SIZES = {
+    "US_LETTER"     : (8.5, 11.0),
+    "US_TRADE"      : (6.0, 9.0),
+    "COMIC"         : (6.625, 10.25),
+    "POCKET"        : (4.25, 6.875),
+    "LANDSCAPE"     : (9.0, 7.0),
+    "SQUARE"        : (7.5, 7.5),
+    "SIZE_825x1075" : (8.25, 10.75),
+    "ROYAL"         : (6.14, 9.21),
+    "CROWN_QUARTO"  : (7.44, 9.68),
+    "A4"            : (8.27, 11.69),
+    "LARGE_SQUARE"  : (8.5, 8.5),
+    "A5"            : (5.83, 8.27),
+    "DIGEST"        : (5.5, 8.5),
+}
+
+# added to each dimension of a page set up with bleed, in inches
+BLEED = 0.25
+
+# how far a page size may be from a trim size and still match, in points
+TOLERANCE = 2.0
+
+HEADER_RE = re.compile(r"%PDF-(\d\.\d)")
+PAGES_RE = re.compile(r"/Type\s*/Pages\b")
+PAGE_RE = re.compile(r"/Type\s*/Page\b(?!s)")
+COUNT_RE = re.compile(r"/Count\s+(\d+)")
+NUMBER = r"\s*(-?[\d.]+)"
+BOX_RE = re.compile(r"/(MediaBox|TrimBox)\s*\[" + NUMBER * 4 + r"\s*\]")
+OBJSTM_RE = re.compile(r"/Type\s*/ObjStm\b")
+STREAM_RE = re.compile(r"stream\r?\n")
+
+class PreflightResult:
+    """
+    What preflight found in one file.  sha1 is the hex digest of its
+    contents; page_sizes the distinct (width, height) page sizes in points;
+    errors the reasons it cannot be printed as is, empty if it looks fine.
+    """
+
+    def __init__(self, path, sha1=None, size=0):
+        self.path = path
+        self.sha1 = sha1
+        self.size = size
+        self.version = None
+        self.page_count = None
+        self.page_sizes = []
+        self.trim_sizes = []
+        self.encrypted = False
+        self.errors = []
+
+    def ok(self):
+        return len(self.errors) == 0
+
+    def to_datastruct(self):
+        return {
+            "sha1"       : self.sha1,
+            "size"       : self.size,
+            "version"    : self.version,
+            "page_count" : self.page_count,
+            "page_sizes" : [ list(s) for s in self.page_sizes ],
+            "trim_sizes" : self.trim_sizes,
+            "encrypted"  : self.encrypted,
+            "errors"     : self.errors,
+        }
+
+    def from_datastruct(self, data):
+        """
+        Fill in a result from to_datastruct() output, keeping our path.
+        """
+        for (k, v) in data.iteritems():
+            setattr(self, k, v)
+        self.page_sizes = [ tuple(s) for s in self.page_sizes ]
+        return self
+
+    def __str__(self):
+        if not self.ok():
+            return "%s: %s" % (self.path, "; ".join(self.errors))
+        return "%s: %s pages, %s" % (self.path, self.page_count, ", ".join(self.trim_sizes) or "no standard trim size")
+
+def matching_trim_sizes(page_sizes, tolerance=TOLERANCE):
+    """
+    The trim sizes that every page size matches, with or without bleed, sorted.
+    """
+    results = []
+    if not page_sizes:
+        return results
+    for (name, (width, height)) in TRIM_SIZES.iteritems():
+        ok = True
+        for (w, h) in page_sizes:
+            trimmed = _near(w, h, width, height, tolerance)
+            bled = _near(w, h, width + BLEED, height + BLEED, tolerance)
+            if not (trimmed or bled):
+                ok = False
+                break
+        if ok:
+            results.append(name)
+    results.sort()
+    return results
+
+def _near(w, h, width, height, tolerance):
+    return abs(w - width * POINTS_PER_INCH) <= tolerance and abs(h - height * POINTS_PER_INCH) <= tolerance
+
+def _enclosing_dict(data, pos):
+    """
+    The (start, end) of the innermost << >> dictionary around pos, or None.
+    """
+    (depth, i) = (0, pos)
+    while True:
+        opening = data.rfind("<<", 0, i)
+        closing = data.rfind(">>", 0, i)
+        if opening == -1:
+            return None
+        if closing > opening:
+            (depth, i) = (depth + 1, closing)
+        elif depth == 0:
+            start = opening
+            break
+        else:
+            (depth, i) = (depth - 1, opening)
+    (depth, i) = (0, pos)
+    while True:
+        opening = data.find("<<", i)
+        closing = data.find(">>", i)
+        if closing == -1:
+            return None
+        if opening != -1 and opening < closing:
+            (depth, i) = (depth + 1, opening + 2)
+        elif depth == 0:
+            return (start, closing + 2)
+        else:
+            (depth, i) = (depth - 1, closing + 2)
+
+def _object_streams(data):
+    """
+    Yield the decompressed contents of the FlateDecode object streams of a PDF.
+    """
+    for match in OBJSTM_RE.finditer(data):
+        bounds = _enclosing_dict(data, match.start())
+        if bounds is None:
+            continue
+        start = data.find("stream", bounds[1], bounds[1] + 16)
+        if start == -1 or "/FlateDecode" not in data[bounds[0]:bounds[1]]:
+            continue
+        stream = STREAM_RE.match(data, start)
+        if stream is None:
+            continue
+        try:
+            # anything after the end of the zlib stream (ex: endstream) is ignored
+            yield zlib.decompressobj().decompress(data[stream.end():stream.end() + _stream_length(data, bounds, stream)])
+        except zlib.error:
+            continue
+
+def _stream_length(data, bounds, stream):
+    """
+    The /Length of a stream if given directly, else up to its endstream.
+    """
+    length = re.search(r"/Length\s+(\d+)(?!\s+\d+\s+R)", data[bounds[0]:bounds[1]])
+    if length is not None:
+        return int(length.group(1))
+    end = data.find("endstream", stream.end())
+    if end == -1:
+        return len(data) - stream.end()
+    return end - stream.end()
+
+def _scan(data, found):
+    """
+    Add the page tree counts, page objects and boxes in data to found.
+    """
+    for match in PAGES_RE.finditer(data):
+        bounds = _enclosing_dict(data, match.start())
+        if bounds is None:
+            continue
+        count = COUNT_RE.search(data, bounds[0], bounds[1])
+        if count is not None:
+            found["counts"].append(int(count.group(1)))
+    found["pages"] = found["pages"] + len(PAGE_RE.findall(data))
+    for match in BOX_RE.finditer(data):
+        try:
+            (x1, y1, x2, y2) = [ float(match.group(i)) for i in range(2, 6) ]
+        except ValueError:
+            continue
+        found[match.group(1)].add((round(abs(x2 - x1), 1), round(abs(y2 - y1), 1)))
+
+def inspect(data, result, tolerance=TOLERANCE):
+    """
+    Fill in result from the contents of a PDF, a string or an mmap.
+    """
+    header = HEADER_RE.search(data[:1024])
+    if header is None:
+        result.errors.append("not a PDF file")
+        return result
+    result.version = header.group(1)
+    if data.rfind("%%EOF", max(0, len(data) - 2048)) == -1:
+        result.errors.append("truncated: no %%EOF at the end of the file")
+    result.encrypted = re.search(r"/Encrypt\s", data[max(0, len(data) - 4096):]) is not None
+    if result.encrypted:
+        result.errors.append("encrypted")
+    found = { "counts": [], "pages": 0, "MediaBox": set(), "TrimBox": set() }
+    _scan(data, found)
+    for stream in _object_streams(data):
+        _scan(stream, found)
+    if found["counts"]:
+        # the root of the page tree counts every page
+        result.page_count = max(found["counts"])
+    elif found["pages"]:
+        result.page_count = found["pages"]
+    else:
+        result.errors.append("no pages found")
+    sizes = found["TrimBox"] or found["MediaBox"]
+    result.page_sizes = sorted(sizes)
+    if not sizes:
+        result.errors.append("no page sizes found")
+    else:
+        result.trim_sizes = matching_trim_sizes(result.page_sizes, tolerance)
+    return result
+
+def _open(path):
+    """
+    (file, mmap) of a file, or (file, None) for an empty one.
+    """
+    fd = open(path, "rb")
+    if os.fstat(fd.fileno()).st_size == 0:
+        return (fd, None)
+    return (fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+def file_sha1(path):
+    """
+    The hex SHA-1 of a file's contents.
+    """
+    (fd, data) = _open(path)
+    try:
+        if data is None:
+            return hashlib.sha1("").hexdigest()
+        try:
+            return hashlib.sha1(data).hexdigest()
+        finally:
+            data.close()
+    finally:
+        fd.close()
+
+def preflight(path, tolerance=TOLERANCE):
+    """
+    Check one PDF file, returning a PreflightResult.
+    """
+    result = PreflightResult(path)
+    try:
+        (fd, data) = _open(path)
+    except (IOError, OSError), e:
+        result.errors.append(str(e))
+        return result
+    try:
+        if data is None:
+            result.sha1 = hashlib.sha1("").hexdigest()
+            result.errors.append("empty file")
+            return result
+        try:
+            result.size = len(data)
+            result.sha1 = hashlib.sha1(data).hexdigest()
+            return inspect(data, result, tolerance)
+        finally:
+            data.close()
+    finally:
+        fd.close()
+
+def check_project(result, project):
+    """
+    Problems in printing the file of result as project (a Project or a
+    hash), besides its own errors: a page size not matching the project's
+    trim size.
+    """
+    if hasattr(project, "to_datastruct"):
+        project = project.to_datastruct()
+    trim_size = (project.get("physical_attributes") or {}).get("trim_size")
+    if trim_size is None or not TRIM_SIZES.has_key(trim_size) or not result.page_sizes:
+        return []
+    if trim_size in result.trim_sizes:
+        return []
+    sizes = ", ".join([ "%.2f x %.2f in" % (w / POINTS_PER_INCH, h / POINTS_PER_INCH) for (w, h) in result.page_sizes ])
+    return [ "%s: pages are %s, not %s (%.2f x %.2f in)" % ((result.path, sizes, trim_size) + TRIM_SIZES[trim_size]) ]
+
+class PreflightCache:
+    """
+    Thread-safe cache of PreflightResults by file SHA-1, optionally kept in
+    a file, one JSON object per line, which is read back on construction.
+    """
+
+    def __init__(self, path=None):
+        self.path = path and os.path.expanduser(path)
+        self.results = {} # sha1 -> result datastruct
+        self.files = {}   # (path, size, mtime) -> sha1
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.path and os.path.exists(self.path):
+            fd = open(self.path)
+            try:
+                for line in fd:
+                    if line.strip():
+                        self.__add(simplejson.loads(line))
+            finally:
+                fd.close()
+
+    # ----------------------------------------------------------------------------
+
+    def __add(self, entry):
+        self.results[entry["result"]["sha1"]] = entry["result"]
+        if entry.get("path"):
+            self.files[(entry["path"], entry["size"], entry["mtime"])] = entry["result"]["sha1"]
+
+    # ----------------------------------------------------------------------------
+
+    def known_sha1(self, path):
+        """
+        The SHA-1 of path if it is unchanged since it was last cached, else None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        self.lock.acquire()
+        try:
+            return self.files.get((os.path.abspath(path), st.st_size, st.st_mtime))
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def get(self, path, sha1):
+        """
+        The cached result for a file with contents sha1, as a PreflightResult for path, or None.
+        """
+        self.lock.acquire()
+        try:
+            data = self.results.get(sha1)
+            if data is None:
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+        finally:
+            self.lock.release()
+        return PreflightResult(path).from_datastruct(data)
+
+    # ----------------------------------------------------------------------------
+
+    def put(self, result):
+        if result.sha1 is None:
+            return
+        entry = { "result": result.to_datastruct(), "path": None, "size": None, "mtime": None }
+        try:
+            st = os.stat(result.path)
+            (entry["path"], entry["size"], entry["mtime"]) = (os.path.abspath(result.path), st.st_size, st.st_mtime)
+        except OSError:
+            pass
+        self.lock.acquire()
+        try:
+            self.__add(entry)
+            if self.path:
+                fd = open(self.path, "a")
+                try:
+                    fd.write(simplejson.dumps(entry) + "\n")
+                finally:
+                    fd.close()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Counts, for metrics and logging.
+        """
+        return { "entries": len(self.results), "hits": self.hits, "misses": self.misses }
+
+def _hash_one(path):
+    try:
+        return file_sha1(path)
+    except (IOError, OSError):
+        return None
+
+def _preflight_one(args):
+    return preflight(*args)
+
+def preflight_many(paths, processes=None, cache=None, tolerance=TOLERANCE):
+    """
+    Check many PDF files on a pool of processes (by default one per core),
+    yielding a PreflightResult per path in input order.  Files found in
+    cache are hashed but not checked again; files unchanged since they were
+    cached are not even hashed.
+    """
+    paths = list(paths)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = [ None ] * len(paths)
+        if cache is not None:
+            unknown = []
+            for (i, path) in enumerate(paths):
+                sha1 = cache.known_sha1(path)
+                if sha1 is not None:
+                    results[i] = cache.get(path, sha1)
+                if results[i] is None:
+                    unknown.append(i)
+            hashes = pool.imap(_hash_one, [ paths[i] for i in unknown ])
+            for (i, sha1) in zip(unknown, hashes):
+                if sha1 is not None:
+                    results[i] = cache.get(paths[i], sha1)
+        todo = [ i for i in range(len(paths)) if results[i] is None ]
+        checked = pool.imap(_preflight_one, [ (paths[i], tolerance) for i in todo ])
+        for (i, result) in enumerate(results):
+            if result is None:
+                result = checked.next()
+                if cache is not None:
+                    cache.put(result)
+            yield result
+    finally:
+        pool.close()
+        pool.join()
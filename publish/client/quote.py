@@ -0,0 +1,187 @@
+"""
+Caching and batching of get_base_cost quotes.
+
+The base cost of a book depends only on its physical properties and page
+count, so quotes are cached under a canonical key built from project_type,
+physical_attributes and page_count, for ttl seconds:
+
+    client = Client(quote_cache=QuoteCache(ttl=3600))
+
+get_base_costs() quotes many variants at once, concurrently, making one
+request per distinct key, and returns a table with one row per variant:
+
+    table = client.get_base_costs(variants(proj,
+                                           trim_sizes=[ "US_TRADE", "A5" ],
+                                           binding_types=[ "perfect", "coil" ],
+                                           page_counts=[ 100, 200, 300 ]))
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import copy
+import threading
+import time
+import simplejson
+import publish.common.baseobj as baseobj
+import publish.common.project as cproject
+
+# physical attributes in the order table rows list them
+PHYSICAL_FIELDS = [ "binding_type", "trim_size", "paper_type", "color" ]
+
+def _datastruct(project):
+    """
+    The hash of a Project, a project hash or a project JSON string.
+    """
+    if isinstance(project, baseobj.BaseData):
+        return project.to_datastruct()
+    if type(project) in [ type(""), type(u"") ]:
+        return simplejson.loads(project)
+    return project
+
+def quote_key(project, page_count):
+    """
+    Canonical string for the parts of a project that determine its base cost.
+    project may be a Project, a project hash or a project JSON string.
+    """
+    ds = _datastruct(project)
+    physical = ds.get("physical_attributes") or {}
+    key = {
+        "project_type"        : ds.get("project_type"),
+        "physical_attributes" : dict([ (k, physical.get(k)) for k in PHYSICAL_FIELDS ]),
+        "page_count"          : page_count,
+    }
+    return simplejson.dumps(key, sort_keys=True)
+
+class QuoteCache:
+    """
+    Thread-safe cache of quotes by canonical key, with expiry after ttl seconds
+    and at most max_entries entries (the oldest are dropped first).
+    """
+
+    def __init__(self, ttl=3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # key -> (expires, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        The cached quote for key, or None.  A copy is returned, so callers may
+        modify it.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+            return copy.deepcopy(entry[1])
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            if len(self.entries) >= self.max_entries and not self.entries.has_key(key):
+                self.__evict()
+            self.entries[key] = (time.time() + self.ttl, copy.deepcopy(value))
+        finally:
+            self.lock.release()
+
+    def __evict(self):
+        """
+        Drop expired entries, and if that is not enough, the oldest tenth.
+        """
+        now = time.time()
+        for (key, entry) in self.entries.items():
+            if entry[0] < now:
+                del self.entries[key]
+        if len(self.entries) >= self.max_entries:
+            oldest = sorted(self.entries.items(), key=lambda item: item[1][0])
+            for (key, entry) in oldest[:max(1, self.max_entries / 10)]:
+                del self.entries[key]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+        finally:
+            self.lock.release()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return None
+        return float(self.hits) / total
+
+    def snapshot(self):
+        """
+        Cache counters as a hash, for metrics and logging.
+        """
+        return {
+            "entries"  : len(self.entries),
+            "hits"     : self.hits,
+            "misses"   : self.misses,
+            "hit_rate" : self.hit_rate(),
+        }
+
+def variants(project, project_types=None, binding_types=None, trim_sizes=None,
+             paper_types=None, colors=None, page_counts=None):
+    """
+    Yield (Project, page_count) for every combination of the given values,
+    each a copy of project with those values set.  Arguments left as None
+    keep the project's own value.
+    """
+    if page_counts is None:
+        page_counts = [ None ]
+    axes = [
+        ("project_type", project_types),
+        ("binding_type", binding_types),
+        ("trim_size", trim_sizes),
+        ("paper_type", paper_types),
+        ("color", colors),
+    ]
+    combos = [ {} ]
+    for (field, values) in axes:
+        if values is None:
+            continue
+        combos = [ _merged(combo, field, v) for combo in combos for v in values ]
+    base = project.to_datastruct()
+    for combo in combos:
+        ds = copy.deepcopy(base)
+        for (field, value) in combo.iteritems():
+            if field == "project_type":
+                ds["project_type"] = value
+            else:
+                ds.setdefault("physical_attributes", {})[field] = value
+        variant = cproject.Project(ds)
+        for page_count in page_counts:
+            yield (variant, page_count)
+
+def _merged(combo, field, value):
+    result = combo.copy()
+    result[field] = value
+    return result
+
+def table_row(project, page_count, cost=None, error=None):
+    """
+    One row of a get_base_costs table: the quoted properties, then the quote.
+    project may be a Project, a project hash or a project JSON string.
+    """
+    ds = _datastruct(project)
+    physical = ds.get("physical_attributes") or {}
+    row = { "project_type": ds.get("project_type"), "page_count": page_count, "cost": cost, "error": error }
+    for field in PHYSICAL_FIELDS:
+        row[field] = physical.get(field)
+    return row
@@ -0,0 +1,378 @@
+"""
+Recording and replaying the client's HTTP exchanges, for performance
+regression tests that run without the Lulu servers.
+
+RecordingTransport wraps another transport and writes every request and
+its response to a gzipped file, one JSON object per line: the method, URL,
+form fields, status, headers, body and how long the exchange took.
+Credentials (auth_token, auth_user, api_key, username, password, the
+authToken returned by login, and cookie and authorization headers of the
+response) are scrubbed before anything is written.
+Bodies larger than max_body, such as downloaded files, are kept only as
+their size, and multipart upload bodies are not kept at all.
+
+    transport = RecordingTransport(PooledTransport(), "catalog.rec.gz")
+    client = Client(transport=transport)
+    ... run the workload against the real servers ...
+    transport.close()
+
+ReplayTransport answers the same requests from the file, with no network:
+
+    client = Client(transport=ReplayTransport("catalog.rec.gz"))
+
+Requests are matched on method, URL path, form fields (with credentials
+masked) and Range header; the same request made several times gets the
+recorded responses in turn, starting over when they run out.  Bodies kept
+only as a size are replayed as that many filler bytes.  By default
+responses come back at full speed, measuring the client alone; with
+latency=1.0 each takes as long as it did when recorded (0.5 for half as
+long, and so on).
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import base64
+import cgi
+import gzip
+import httplib
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+from StringIO import StringIO
+import simplejson
+import transport as ctransport
+
+# form fields, response fields and response headers (lower case) never written to a recording
+SCRUBBED_FIELDS = [ "auth_token", "auth_user", "api_key", "username", "password" ]
+SCRUBBED_RESPONSE_FIELDS = [ "authToken" ]
+SCRUBBED_HEADERS = [ "set-cookie", "set-cookie2", "cookie", "authorization", "proxy-authorization",
+                     "x-auth-token", "x-api-key" ]
+SCRUBBED = "*"
+
+# request headers that take part in matching
+MATCHED_HEADERS = [ "range" ]
+
+FILLER = "0123456789abcdef" * 4096
+
+class ReplayError(Exception):
+    """
+    A request with no recorded exchange to replay.
+    """
+    pass
+
+def _scrub_form(body):
+    """
+    The fields of a form body as a sorted list of pairs, with credentials masked.
+    """
+    fields = []
+    for (name, value) in cgi.parse_qsl(body, keep_blank_values=True):
+        if name in SCRUBBED_FIELDS:
+            value = SCRUBBED
+        fields.append((name, value))
+    fields.sort()
+    return fields
+
+def _scrub_body(data):
+    """
+    A JSON response body with credentials masked; other bodies are returned as they are.
+    """
+    if not [ f for f in SCRUBBED_RESPONSE_FIELDS if f in data ]:
+        return data
+    try:
+        value = simplejson.loads(data)
+    except ValueError:
+        return data
+    if type(value) != type({}):
+        return data
+    for name in SCRUBBED_RESPONSE_FIELDS:
+        if value.has_key(name):
+            value[name] = SCRUBBED
+    return simplejson.dumps(value)
+
+def _scrub_headers(headers):
+    """
+    A list of response header pairs with credentials masked.
+    """
+    results = []
+    for (name, value) in headers:
+        if name.lower() in SCRUBBED_HEADERS:
+            value = SCRUBBED
+        results.append((name, value))
+    return results
+
+def _request_key(url, body, headers):
+    """
+    What a request is matched on: (method, path and query, form fields, matched headers).
+    """
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    if query:
+        path = path + "?" + query
+    if body is None:
+        (method, form) = ("GET", None)
+    elif ctransport.is_streaming(body):
+        (method, form) = ("POST", None)
+    else:
+        (method, form) = ("POST", _scrub_form(body))
+    matched = []
+    for (name, value) in (headers or {}).items():
+        if name.lower() in MATCHED_HEADERS:
+            matched.append((name.lower(), value))
+    matched.sort()
+    return (method, path, form, matched)
+
+def _key_string(key):
+    return simplejson.dumps(key)
+
+def open_recording(path, mode="rb"):
+    """
+    Open a recording file, gzipped if its name ends in .gz.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class _RecordedBody:
+    """
+    Passes a response body through to the caller, writing the exchange to the
+    recording once the body has been read to the end or closed.
+    """
+
+    def __init__(self, recorder, entry, response, started):
+        self.recorder = recorder
+        self.entry = entry
+        self.response = response
+        self.started = started
+        self.chunks = []
+        self.size = 0
+        self.done = False
+
+    def read(self, size=-1):
+        if self.done:
+            return ""
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.size = self.size + len(data)
+        if self.size <= self.recorder.max_body:
+            self.chunks.append(data)
+        elif self.chunks:
+            self.chunks = []
+        if not data or size is None or size < 0:
+            self.__finish()
+        return data
+
+    def close(self):
+        self.response.close()
+        self.__finish()
+
+    def __finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.entry["seconds"] = round(time.time() - self.started, 6)
+        self.recorder.write_body(self.entry, "".join(self.chunks), self.size)
+
+class RecordingTransport:
+    """
+    Sends requests through transport, recording each exchange to path.
+    Thread-safe.  close() it when done, to finish the file.
+    """
+
+    def __init__(self, transport, path, max_body=65536):
+        """
+        transport: the transport that makes the real requests, ex: a PooledTransport
+        path:      the recording to write, gzipped if the name ends in .gz
+        max_body:  response bodies longer than this are recorded as their size only
+        """
+        self.transport = transport
+        self.max_body = max_body
+        self.fd = open_recording(path, "wb")
+        self.lock = threading.Lock()
+        self.count = 0
+
+    # ----------------------------------------------------------------------------
+
+    def request(self, url, body=None, headers=None):
+        (method, path, form, matched) = _request_key(url, body, headers)
+        entry = {
+            "method"  : method,
+            "path"    : path,
+            "form"    : form,
+            "headers" : matched,
+        }
+        started = time.time()
+        try:
+            response = self.transport.request(url, body, headers)
+        except urllib2.HTTPError, he:
+            entry["ttfb"] = entry["seconds"] = round(time.time() - started, 6)
+            entry["status"] = he.code
+            entry["response_headers"] = _scrub_headers(he.info() and he.info().items() or [])
+            data = he.read()
+            self.write_body(entry, data, len(data))
+            raise urllib2.HTTPError(url, he.code, he.msg, he.info(), StringIO(data))
+        except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+            entry["ttfb"] = entry["seconds"] = round(time.time() - started, 6)
+            entry["error"] = str(e)
+            self.write(entry)
+            raise
+        entry["ttfb"] = round(time.time() - started, 6)
+        entry["status"] = response.getcode()
+        entry["response_headers"] = _scrub_headers(response.info().items())
+        return ctransport.Response(url, response.getcode(), getattr(response, "msg", ""),
+                                   _RecordedBody(self, entry, response, started), response.info())
+
+    # ----------------------------------------------------------------------------
+
+    def write_body(self, entry, data, size):
+        """
+        Record an exchange whose response body was data, or only its size if larger than max_body.
+        """
+        if size > self.max_body:
+            entry["body_size"] = size
+        else:
+            data = _scrub_body(data)
+            try:
+                entry["body"] = data.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["body_base64"] = base64.b64encode(data)
+        self.write(entry)
+
+    # ----------------------------------------------------------------------------
+
+    def write(self, entry):
+        line = simplejson.dumps(entry, separators=(",", ":")) + "\n"
+        self.lock.acquire()
+        try:
+            self.fd.write(line)
+            self.count = self.count + 1
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def close(self):
+        """
+        Finish the recording, and close the wrapped transport if it can be.
+        """
+        self.lock.acquire()
+        try:
+            self.fd.close()
+        finally:
+            self.lock.release()
+        if hasattr(self.transport, "close"):
+            self.transport.close()
+
+class _ReplayBody:
+    """
+    A recorded body, or filler of its recorded size, optionally read out over
+    the time its transfer took.
+    """
+
+    def __init__(self, data, size, seconds):
+        self.data = data
+        self.size = size
+        self.offset = 0
+        self.seconds = seconds
+        self.started = time.time()
+
+    def read(self, size=-1):
+        remaining = self.size - self.offset
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if self.data is not None:
+            data = self.data[self.offset:self.offset + size]
+        else:
+            data = (FILLER * (size / len(FILLER) + 1))[:size]
+        self.offset = self.offset + size
+        if self.seconds and self.size:
+            ahead = self.seconds * self.offset / float(self.size) - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        return data
+
+    def close(self):
+        self.offset = self.size
+
+class ReplayTransport:
+    """
+    Answers requests from a recording made by RecordingTransport.  Thread-safe.
+    """
+
+    def __init__(self, path, latency=0.0):
+        """
+        path:    the recording
+        latency: fraction of each recorded exchange's time to reproduce, 0 for full speed
+        """
+        self.latency = latency
+        self.exchanges = {}  # key string -> [ entry ]
+        self.next = {}       # key string -> index of the next entry to replay
+        self.lock = threading.Lock()
+        fd = open_recording(path, "rb")
+        try:
+            for line in fd:
+                if not line.strip():
+                    continue
+                entry = simplejson.loads(line)
+                key = (entry["method"], entry["path"], entry["form"], entry["headers"])
+                self.exchanges.setdefault(_key_string(key), []).append(entry)
+        finally:
+            fd.close()
+
+    # ----------------------------------------------------------------------------
+
+    def __entry(self, key):
+        key = _key_string(key)
+        self.lock.acquire()
+        try:
+            entries = self.exchanges.get(key)
+            if not entries:
+                return None
+            i = self.next.get(key, 0)
+            self.next[key] = (i + 1) % len(entries)
+            return entries[i]
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def request(self, url, body=None, headers=None):
+        key = _request_key(url, body, headers)
+        if ctransport.is_streaming(body):
+            # the client's cost of encoding the upload is part of what is measured
+            if hasattr(body, "read"):
+                while body.read(65536):
+                    pass
+            else:
+                for data in body:
+                    pass
+        entry = self.__entry(key)
+        if entry is None:
+            raise ReplayError("no recorded response for %s %s" % (key[0], key[1]))
+        ttfb = entry.get("ttfb", 0) * self.latency
+        if ttfb > 0:
+            time.sleep(ttfb)
+        if entry.has_key("error"):
+            raise urllib2.URLError(entry["error"])
+        if entry.has_key("body_size"):
+            (data, size) = (None, entry["body_size"])
+        else:
+            if entry.has_key("body_base64"):
+                data = base64.b64decode(entry["body_base64"])
+            else:
+                data = entry.get("body", "").encode("utf-8")
+            size = len(data)
+        transfer = max(entry.get("seconds", 0) - entry.get("ttfb", 0), 0) * self.latency
+        status = entry["status"]
+        response = ctransport.Response(url, status, httplib.responses.get(status, ""),
+                                       _ReplayBody(data, size, transfer),
+                                       ctransport.make_headers(entry.get("response_headers")))
+        return ctransport.check_status(url, response)
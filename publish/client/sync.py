@@ -0,0 +1,126 @@
+"""
+Incremental synchronization of a local Catalog with the Publish API.
+
+A full mirror needs list_projects() plus a read() per project.  SyncEngine
+keeps that state in a publish.common.catalog.Catalog between runs and, on
+each sync(), only reads what may have changed:
+
+  * ids the server lists that the catalog lacks are read and reported "added"
+  * ids the catalog holds that the server no longer lists are "removed"
+  * stored projects not confirmed for revalidate_after seconds are re-read,
+    oldest first and at most max_revalidations per run, and reported
+    "modified" when their fingerprint differs from the stored copy
+
+The API does not expose modification times or entity tags, so the
+revalidation schedule is what bounds staleness of edits made elsewhere.
+
+    engine = SyncEngine(client, Catalog("catalog.db"), revalidate_after=6*3600)
+    for event in engine.sync():
+        print event.kind, event.content_id
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import httplib
+import socket
+import time
+import urllib2
+import client as pclient
+
+ADDED    = "added"
+REMOVED  = "removed"
+MODIFIED = "modified"
+ERROR    = "error"
+
+class SyncEvent:
+    """
+    One change found by SyncEngine.sync().  project is the new server state for
+    added and modified events; error is the exception for error events.
+    """
+
+    def __init__(self, kind, content_id, project=None, error=None):
+        self.kind = kind
+        self.content_id = content_id
+        self.project = project
+        self.error = error
+
+    def __str__(self):
+        return "%s %s" % (self.kind, self.content_id)
+
+class SyncEngine:
+    """
+    Keeps a Catalog in line with the projects of the logged in account.
+    """
+
+    def __init__(self, client, catalog, revalidate_after=86400, max_revalidations=None):
+        """
+        client:             a logged in publish.client.client.Client
+        catalog:            the publish.common.catalog.Catalog holding the local state
+        revalidate_after:   seconds after which a stored project is re-read, or None
+                            to never re-read projects that are still listed
+        max_revalidations:  cap on re-reads per sync() run, None for no cap
+        """
+        self.client = client
+        self.catalog = catalog
+        self.revalidate_after = revalidate_after
+        self.max_revalidations = max_revalidations
+
+    def sync(self):
+        """
+        Bring the catalog up to date, yielding a SyncEvent for each change as it
+        is applied.  The catalog is only updated as far as the events consumed.
+        """
+        started = time.time()
+        server_ids = {}
+        for content_id in self.client.list_projects(lazy=True):
+            server_ids[content_id] = 1
+        local_ids = {}
+        for content_id in self.catalog.content_ids():
+            local_ids[content_id] = 1
+
+        for content_id in local_ids.iterkeys():
+            if not server_ids.has_key(content_id):
+                self.catalog.delete(content_id)
+                self.client.forget_server_state(content_id)
+                yield SyncEvent(REMOVED, content_id)
+
+        added = [ content_id for content_id in server_ids.iterkeys() if not local_ids.has_key(content_id) ]
+        added.sort()
+        for content_id in added:
+            event = self.__fetch(content_id, ADDED, None)
+            if event is not None:
+                yield event
+
+        if self.revalidate_after is None:
+            return
+        # measured from the start, so projects added above are not read twice
+        stale = self.catalog.stale_ids(started - self.revalidate_after, self.max_revalidations)
+        fingerprints = self.catalog.fingerprints()
+        for content_id in stale:
+            if not server_ids.has_key(content_id):
+                continue
+            event = self.__fetch(content_id, MODIFIED, fingerprints.get(content_id))
+            if event is not None:
+                yield event
+
+    def __fetch(self, content_id, kind, known_fingerprint):
+        """
+        Read a project and store it.  Returns the event to report, or None if the
+        project matched known_fingerprint.  A read that fails, remotely or on the
+        network, is an error event for that project and the sync goes on.
+        """
+        try:
+            project = self.client.read(content_id)
+        except (pclient.ClientException, urllib2.URLError, socket.error, httplib.HTTPException), e:
+            return SyncEvent(ERROR, content_id, error=e)
+        if known_fingerprint is not None and project.fingerprint() == known_fingerprint:
+            self.catalog.mark_checked([ content_id ])
+            return None
+        self.catalog.put(project)
+        return SyncEvent(kind, content_id, project=project)
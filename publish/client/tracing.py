@@ -0,0 +1,350 @@
+"""
+Tracing: where the time of a publish goes, as nested spans.
+
+With a tracer set, the client opens a span around login, each API call
+(__submit), upload, download_file and multipart_encode, and the pooled
+transport adds a child span for each phase of a request: dns, connect,
+tls, write (the request and its body), ttfb (waiting for the response
+headers) and read (the response body); JSON decoding is a decode span.
+Work run on other threads by run_parallel, hedging, DownloadManager and
+PublishPipeline stays under the span that started it.
+
+The interface follows OpenTelemetry's: tracer.start_span(name, attributes)
+returns a span with set_attribute, add_event, record_exception, set_status
+and end, usable in a with statement.  The default tracer does nothing and
+costs next to nothing.  RecordingTracer keeps finished spans in memory and
+prints them as a tree, and OpenTelemetryTracer passes spans to an
+OpenTelemetry tracer when the opentelemetry package is installed:
+
+    tracer = RecordingTracer()
+    client = Client(tracer=tracer)
+    client.login()
+    client.upload("book.pdf", token)
+    print tracer.format()
+
+set_tracer() sets the tracer used when there is no current span, ex: for
+code that calls a transport directly.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import random
+import threading
+import time
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+STATUS_UNSET = "unset"
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+_local = threading.local()
+
+def _current():
+    return getattr(_local, "span", None)
+
+def _set_current(span):
+    _local.span = span
+
+class NoopSpan:
+    """
+    A span that records nothing.
+    """
+
+    tracer = None
+
+    def is_recording(self):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, error):
+        pass
+
+    def set_status(self, status, description=None):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        return False
+
+NOOP_SPAN = NoopSpan()
+
+def current_span():
+    """
+    The span current in this thread, or NOOP_SPAN if there is none.
+    """
+    return _current() or NOOP_SPAN
+
+class NoopTracer:
+    """
+    The default tracer: every span is NOOP_SPAN.
+    """
+
+    def start_span(self, name, attributes=None, current=True):
+        return NOOP_SPAN
+
+_tracer = NoopTracer()
+
+def set_tracer(tracer):
+    """
+    Set the tracer used when no span is current; None restores the no-op tracer.
+    """
+    global _tracer
+    if tracer is None:
+        tracer = NoopTracer()
+    _tracer = tracer
+
+def get_tracer():
+    return _tracer
+
+def start_span(name, attributes=None, current=True):
+    """
+    Start a span as a child of the current one, with the current span's
+    tracer, or the global tracer if there is none.  With current, the span
+    is current in this thread until it ends.
+    """
+    parent = _current()
+    if parent is not None:
+        return parent.tracer.start_span(name, attributes, current)
+    return _tracer.start_span(name, attributes, current)
+
+def wrap(fn):
+    """
+    fn, made to run under the span current now, whichever thread calls it.
+    """
+    parent = _current()
+    if parent is None:
+        return fn
+    def wrapper(*args, **kwargs):
+        previous = _current()
+        _set_current(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _set_current(previous)
+    return wrapper
+
+class _BaseSpan:
+    """
+    Making a span current in its thread, restoring the one before when it ends.
+    """
+
+    def _activate(self):
+        self.previous = _current()
+        _set_current(self)
+
+    def _deactivate(self):
+        if _current() is self:
+            _set_current(self.previous)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        if value is not None:
+            self.record_exception(value)
+        self.end()
+        return False
+
+class RecordedSpan(_BaseSpan):
+    """
+    A span of a RecordingTracer.
+    """
+
+    def __init__(self, tracer, name, parent, attributes, current):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = "%016x" % random.getrandbits(64)
+        if parent is not None:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        else:
+            self.trace_id = "%032x" % random.getrandbits(128)
+            self.parent_id = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = STATUS_UNSET
+        self.description = None
+        self.thread = threading.currentThread().getName()
+        self.start = time.time()
+        self.finish = None
+        self.previous = None
+        self.current = current
+        if current:
+            self._activate()
+
+    def is_recording(self):
+        return self.finish is None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name, attributes=None):
+        self.events.append((time.time(), name, dict(attributes or {})))
+
+    def record_exception(self, error):
+        self.add_event("exception", { "exception.type": error.__class__.__name__,
+                                      "exception.message": str(error) })
+        self.set_status(STATUS_ERROR, str(error))
+
+    def set_status(self, status, description=None):
+        self.status = status
+        self.description = description
+
+    def end(self):
+        if self.finish is not None:
+            return
+        self.finish = time.time()
+        if self.current:
+            self._deactivate()
+        self.tracer.finished(self)
+
+    def duration(self):
+        return (self.finish or time.time()) - self.start
+
+class RecordingTracer:
+    """
+    Keeps up to max_spans finished spans in memory, for tests and for
+    finding where the time of a slow call went.  Thread-safe.
+    """
+
+    def __init__(self, max_spans=10000):
+        self.max_spans = max_spans
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start_span(self, name, attributes=None, current=True):
+        return RecordedSpan(self, name, _current(), attributes, current)
+
+    def finished(self, span):
+        self.lock.acquire()
+        try:
+            self.spans.append(span)
+            if len(self.spans) > self.max_spans:
+                del self.spans[:len(self.spans) - self.max_spans]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.spans = []
+        finally:
+            self.lock.release()
+
+    def format(self):
+        """
+        The finished spans as indented trees, one line per span with its
+        duration in milliseconds and attributes.
+        """
+        self.lock.acquire()
+        try:
+            spans = list(self.spans)
+        finally:
+            self.lock.release()
+        children = {}
+        ids = dict([ (s.span_id, s) for s in spans ])
+        roots = []
+        for span in spans:
+            if span.parent_id in ids:
+                children.setdefault(span.parent_id, []).append(span)
+            else:
+                roots.append(span)
+        lines = []
+        def add(span, depth):
+            attributes = " ".join([ "%s=%s" % item for item in sorted(span.attributes.items()) ])
+            status = span.status == STATUS_ERROR and " ERROR" or ""
+            lines.append("%s%-*s %9.2fms%s %s" % ("  " * depth, max(1, 24 - 2 * depth), span.name,
+                                                 span.duration() * 1000, status, attributes))
+            for child in sorted(children.get(span.span_id, []), key=lambda s: s.start):
+                add(child, depth + 1)
+        for span in sorted(roots, key=lambda s: s.start):
+            add(span, 0)
+        return "\n".join(lines)
+
+class _OtelSpan(_BaseSpan):
+    """
+    A span of an OpenTelemetryTracer, passing everything to the OpenTelemetry span.
+    """
+
+    def __init__(self, tracer, span, current):
+        self.tracer = tracer
+        self.span = span
+        self.previous = None
+        self.current = current
+        if current:
+            self._activate()
+
+    def is_recording(self):
+        return self.span.is_recording()
+
+    def set_attribute(self, key, value):
+        self.span.set_attribute(key, value)
+
+    def set_attributes(self, attributes):
+        for (key, value) in attributes.items():
+            self.span.set_attribute(key, value)
+
+    def add_event(self, name, attributes=None):
+        self.span.add_event(name, attributes or {})
+
+    def record_exception(self, error):
+        self.span.record_exception(error)
+        self.set_status(STATUS_ERROR, str(error))
+
+    def set_status(self, status, description=None):
+        codes = { STATUS_UNSET: otel_trace.StatusCode.UNSET, STATUS_OK: otel_trace.StatusCode.OK,
+                  STATUS_ERROR: otel_trace.StatusCode.ERROR }
+        self.span.set_status(otel_trace.Status(codes[status], description))
+
+    def end(self):
+        self.span.end()
+        if self.current:
+            self._deactivate()
+
+class OpenTelemetryTracer:
+    """
+    Sends spans to an OpenTelemetry tracer, by default the global one for
+    this library.  Spans started inside an OpenTelemetryTracer span are its
+    children in OpenTelemetry too.
+    """
+
+    def __init__(self, tracer=None):
+        if otel_trace is None:
+            raise Exception("OpenTelemetryTracer requires the opentelemetry-api package")
+        if tracer is None:
+            tracer = otel_trace.get_tracer("publish.client")
+        self.tracer = tracer
+
+    def start_span(self, name, attributes=None, current=True):
+        parent = _current()
+        context = None
+        if isinstance(parent, _OtelSpan):
+            context = otel_trace.set_span_in_context(parent.span)
+        span = self.tracer.start_span(name, context=context, attributes=attributes)
+        return _OtelSpan(self, span, current)
@@ -0,0 +1,481 @@
+"""
+Transports: how Client sends an HTTP request and gets its response.
+
+A transport has one method, request(url, body=None, headers=None), which
+POSTs body (a string, or an iterable of strings such as the generator from
+poster's multipart_encode) or, when body is None, GETs url.  It returns a
+response that reads like a urllib2 response: read(size), close(),
+getcode(), info() and geturl().  Like urllib2, a transport raises
+urllib2.HTTPError for error statuses (with the response body readable from
+the error) and urllib2.URLError, socket.error or httplib.HTTPException for
+network failures, so callers handle errors the same whichever is used.
+
+UrllibTransport   urllib2.urlopen, as the client has always used; a new
+                  connection for every request
+PooledTransport   keeps HTTP/1.1 connections open and reuses them, per
+                  scheme and host; share one between clients to share its pool
+InProcessTransport
+                  calls a Python function instead of using the network, ex:
+                  the stand-in server of publish.bench.server, so that the
+                  client's own overhead can be measured without sockets
+
+Each request is traced (see publish.client.tracing) as an http span and a
+read span for its response body; PooledTransport also traces the phases
+of the request within the http span: dns, connect and tls for a new
+connection, then write and ttfb.
+
+    client = Client(transport=PooledTransport(max_idle=16))
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import errno
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+from StringIO import StringIO
+import poster.streaminghttp as poster_streaming
+import tracing
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+def is_streaming(body):
+    """
+    True if body is sent in pieces (an iterable or file-like object) rather than a string.
+    """
+    return body is not None and type(body) not in [ type(""), type(u"") ]
+
+def make_headers(headers):
+    """
+    An httplib.HTTPMessage holding a hash or list of (name, value) headers.
+    """
+    if type(headers) == type({}):
+        headers = headers.items()
+    lines = [ "%s: %s\r\n" % (name, value) for (name, value) in headers or [] ]
+    return httplib.HTTPMessage(StringIO("".join(lines) + "\r\n"))
+
+class Response:
+    """
+    A response whose body is read from fp, with the methods of a urllib2 response.
+    """
+
+    def __init__(self, url, code, msg, fp, headers):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.fp = fp
+        self.headers = headers
+
+    def read(self, size=-1):
+        if self.fp is None:
+            return ""
+        if size is None or size < 0:
+            return self.fp.read()
+        return self.fp.read(size)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+def check_status(url, response):
+    """
+    Raise urllib2.HTTPError for a response that is not a success, as urllib2 does.
+    """
+    if response.code < 300:
+        return response
+    body = response.read()
+    response.close()
+    raise urllib2.HTTPError(url, response.code, response.msg, response.headers, StringIO(body))
+
+class _TracedBody:
+    """
+    Reads a response body, ending span once it has been read to the end or closed.
+    """
+
+    def __init__(self, fp, span):
+        self.fp = fp
+        self.span = span
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.fp.read()
+        else:
+            data = self.fp.read(size)
+        if not data or size is None or size < 0:
+            self.span.end()
+        return data
+
+    def close(self):
+        self.fp.close()
+        self.span.end()
+
+def traced_response(url, response, span):
+    """
+    response, with its body read under span when tracing.
+    """
+    if not span.is_recording():
+        return response
+    return Response(url, response.getcode(), getattr(response, "msg", ""), _TracedBody(response, span),
+                    response.info())
+
+def start_request_span(url, method):
+    return tracing.start_span("http", { "http.method": method, "http.url": url })
+
+def end_request_span(span, error=None):
+    if error is not None:
+        span.record_exception(error)
+    span.end()
+
+class UrllibTransport:
+    """
+    Requests through urllib2, a new connection each time.  Streaming bodies
+    go through poster's streaming handlers, without installing them globally.
+    """
+
+    def __init__(self):
+        self.streaming_opener = None
+
+    def request(self, url, body=None, headers=None):
+        req = urllib2.Request(url, body, headers or {})
+        span = start_request_span(url, req.get_method())
+        try:
+            response = self.__open(req, body)
+        except Exception, e:
+            end_request_span(span, e)
+            raise
+        span.set_attribute("http.status_code", response.getcode())
+        end_request_span(span)
+        return traced_response(url, response, tracing.start_span("read", current=False))
+
+    def __open(self, req, body):
+        if not is_streaming(body):
+            return urllib2.urlopen(req)
+        if self.streaming_opener is None:
+            handlers = [ poster_streaming.StreamingHTTPHandler, poster_streaming.StreamingHTTPRedirectHandler ]
+            if hasattr(poster_streaming, "StreamingHTTPSHandler"):
+                handlers.append(poster_streaming.StreamingHTTPSHandler)
+            self.streaming_opener = urllib2.build_opener(*handlers)
+        return self.streaming_opener.open(req)
+
+class _PooledBody:
+    """
+    Reads an httplib response, returning its connection to the pool once the
+    body has been read to the end.  Closing early closes the connection.
+    """
+
+    def __init__(self, transport, key, conn, resp):
+        self.transport = transport
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+
+    def read(self, size=None):
+        if self.conn is None:
+            return ""
+        if size is None:
+            data = self.resp.read()
+        else:
+            data = self.resp.read(size)
+        if self.resp.isclosed():
+            self.__finish(True)
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            self.__finish(self.resp.isclosed())
+
+    def __finish(self, complete):
+        (conn, self.conn) = (self.conn, None)
+        if complete and not self.resp.will_close:
+            self.transport._release(self.key, conn)
+        else:
+            conn.close()
+
+# socket errors of a connection the server has closed
+STALE_ERRNOS = [ errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED ]
+
+def _is_stale(error, sent, idempotent):
+    """
+    True if error shows a reused connection closed by the server before any
+    of the response arrived: a reset while sending, or, once the request is
+    sent (only for idempotent requests), a reset or end of stream instead of
+    the status line.  Timeouts never are.
+    """
+    if isinstance(error, socket.error):
+        stale = getattr(error, "errno", None) in STALE_ERRNOS
+    elif isinstance(error, httplib.BadStatusLine):
+        line = error.line or ""
+        stale = sent and (line in [ "", "''" ] or line.startswith("No status line"))
+    else:
+        stale = False
+    return stale and (not sent or idempotent)
+
+class PooledTransport:
+    """
+    Requests over persistent HTTP/1.1 connections, keeping up to max_idle idle
+    connections per scheme and host.  Thread-safe; a connection is used by one
+    request at a time, so concurrent requests open more connections as needed.
+    Redirects are not followed.
+    """
+
+    def __init__(self, max_idle=8, timeout=None):
+        """
+        max_idle: idle connections kept per scheme and host
+        timeout:  socket timeout in seconds, None for the default
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}  # (scheme, netloc) -> [ connection ]
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    # ----------------------------------------------------------------------------
+
+    def __acquire(self, key):
+        """
+        An idle connection for key, or a new one.  Returns (connection, reused).
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key)
+            if idle:
+                self.reused = self.reused + 1
+                return (idle.pop(), True)
+            self.created = self.created + 1
+        finally:
+            self.lock.release()
+        (scheme, netloc) = key
+        if scheme == "https":
+            cls = poster_streaming.StreamingHTTPSConnection
+        else:
+            cls = poster_streaming.StreamingHTTPConnection
+        if self.timeout is None:
+            return (cls(netloc), False)
+        return (cls(netloc, timeout=self.timeout), False)
+
+    # ----------------------------------------------------------------------------
+
+    def _release(self, key, conn):
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    # ----------------------------------------------------------------------------
+
+    def request(self, url, body=None, headers=None):
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        selector = path or "/"
+        if query:
+            selector = selector + "?" + query
+        key = (scheme, netloc)
+        headers = dict(headers or {})
+        method = "GET"
+        if body is not None:
+            method = "POST"
+            if not [ h for h in headers.keys() if h.lower() == "content-type" ]:
+                headers["Content-Type"] = FORM_CONTENT_TYPE
+        span = start_request_span(url, method)
+        try:
+            (conn, resp) = self.__exchange(key, method, selector, body, headers, span)
+        except Exception, e:
+            end_request_span(span, e)
+            raise
+        span.set_attribute("http.status_code", resp.status)
+        end_request_span(span)
+        response = Response(url, resp.status, resp.reason, _PooledBody(self, key, conn, resp), resp.msg)
+        response = traced_response(url, response, tracing.start_span("read", current=False))
+        return check_status(url, response)
+
+    # ----------------------------------------------------------------------------
+
+    def __exchange(self, key, method, selector, body, headers, span):
+        """
+        Send the request and read the response headers, returning (connection, response).
+        """
+        while True:
+            (conn, reused) = self.__acquire(key)
+            span.set_attribute("net.reused", reused)
+            sent = False
+            try:
+                if conn.sock is None:
+                    if span.is_recording():
+                        self.__connect(conn, key[0])
+                    else:
+                        conn.connect()
+                    # headers and body go out in separate writes
+                    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                phase = tracing.start_span("write")
+                try:
+                    conn.request(method, selector, body, headers)
+                finally:
+                    phase.end()
+                sent = True
+                phase = tracing.start_span("ttfb")
+                try:
+                    return (conn, conn.getresponse())
+                finally:
+                    phase.end()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                # the server may have closed an idle connection before it read
+                # the request, which is then sent again on a new connection;
+                # past that point only a GET is, as the server may have acted on it
+                if reused and not is_streaming(body) and _is_stale(e, sent, method == "GET"):
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+
+    # ----------------------------------------------------------------------------
+
+    def __connect(self, conn, scheme):
+        """
+        Open conn's socket as httplib would, but one traced phase at a time:
+        dns, connect and, for https, tls.
+        """
+        phase = tracing.start_span("dns", { "net.peer.name": conn.host })
+        try:
+            addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+        finally:
+            phase.end()
+        phase = tracing.start_span("connect")
+        try:
+            sock = None
+            for (family, socktype, proto, canonname, address) in addresses:
+                sock = socket.socket(family, socktype, proto)
+                if self.timeout is not None:
+                    sock.settimeout(self.timeout)
+                try:
+                    sock.connect(address)
+                    phase.set_attribute("net.peer.ip", address[0])
+                    break
+                except socket.error:
+                    sock.close()
+                    sock = None
+                    if address == addresses[-1][4]:
+                        raise
+        finally:
+            phase.end()
+        if scheme == "https":
+            phase = tracing.start_span("tls")
+            try:
+                context = getattr(conn, "_context", None)
+                if context is not None:
+                    sock = context.wrap_socket(sock, server_hostname=conn.host)
+                else:
+                    sock = ssl.wrap_socket(sock, conn.key_file, conn.cert_file)
+            finally:
+                phase.end()
+        conn.sock = sock
+
+    # ----------------------------------------------------------------------------
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        self.lock.acquire()
+        try:
+            (idle, self.idle) = (self.idle, {})
+        finally:
+            self.lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Pool counters as a hash, for metrics and logging.
+        """
+        self.lock.acquire()
+        try:
+            return {
+                "created" : self.created,
+                "reused"  : self.reused,
+                "idle"    : sum([ len(conns) for conns in self.idle.values() ]),
+            }
+        finally:
+            self.lock.release()
+
+class _IterBody:
+    """
+    File-like reader over a string or an iterable of strings.
+    """
+
+    def __init__(self, body):
+        if type(body) in [ type(""), type(u"") ]:
+            body = [ body ]
+        self.chunks = iter(body)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while self.chunks is not None and (size is None or size < 0 or len(self.buffer) < size):
+            try:
+                self.buffer = self.buffer + self.chunks.next()
+            except StopIteration:
+                self.chunks = None
+        if size is None or size < 0:
+            (data, self.buffer) = (self.buffer, "")
+        else:
+            (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def close(self):
+        self.chunks = None
+        self.buffer = ""
+
+class InProcessTransport:
+    """
+    Hands each request to handler(method, url, headers, body) in the calling
+    thread, with body joined into a string (or None for a GET).  The handler
+    returns (status, headers, body), where headers is a hash or list of pairs
+    and body a string or an iterable of strings.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def request(self, url, body=None, headers=None):
+        method = "GET"
+        if body is not None:
+            method = "POST"
+            if hasattr(body, "read"):
+                body = body.read()
+            elif is_streaming(body):
+                body = "".join(body)
+        (status, response_headers, response_body) = self.handler(method, url, dict(headers or {}), body)
+        response = Response(url, status, httplib.responses.get(status, ""), _IterBody(response_body),
+                            make_headers(response_headers))
+        return check_status(url, response)
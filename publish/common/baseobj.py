@@ -3,6 +3,9 @@
 A recursive object-based JSON serializer/deserializer
 See project.py for examples
 
+For finding where construction time goes, set_profiler(CoercionProfiler())
+counts and times every coercion by field type; publish.bench.micro runs it.
+
 Copyright 2010 Lulu Enterprises
 
 Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
@@ -14,6 +17,126 @@ Unless required by applicable law or agreed to in writing, software distributed
 
 import simplejson
 import exceptions
+import hashlib
+import threading
+import time
+import weakref
+
+# the CoercionProfiler in use, if any; see set_profiler()
+_profiler = None
+
+def set_profiler(profiler):
+    """
+    Have every coercion done by BaseData.set() counted and timed by profiler,
+    a CoercionProfiler, or stop profiling with None.  Off by default, when
+    the only cost is a check of this module's global.
+    """
+    global _profiler
+    _profiler = profiler
+
+def type_name(typ, restrictions):
+    """
+    The name coercions of a field are profiled under, ex: "string",
+    "list<AuthorName>", "Bibliography".
+    """
+    if typ == "list":
+        if type(restrictions) == type(""):
+            return "list<%s>" % restrictions
+        return "list<%s>" % getattr(restrictions, "__name__", restrictions)
+    if type(typ) == type(""):
+        return typ
+    return typ.__name__
+
+class CoercionProfiler:
+    """
+    Counts the coercions done by BaseData.set() and the time they take, per
+    field type.  The time of an object field includes the coercion of its
+    own fields; self_seconds is the time less that of nested coercions.
+    Thread-safe.
+
+        profiler = CoercionProfiler()
+        set_profiler(profiler)
+        project = Project(datastruct)
+        set_profiler(None)
+        print "\n".join(profiler.format())
+    """
+
+    def __init__(self):
+        self.stats = {}  # type name -> [ count, seconds, self seconds, list items ]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    # ----------------------------------------------------------------------------
+
+    def measure(self, name, items, fn, *args):
+        """
+        Time fn(*args), a coercion of a field of type name with items list items.
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(0.0)
+        started = time.time()
+        try:
+            return fn(*args)
+        finally:
+            seconds = time.time() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] = stack[-1] + seconds
+            self.lock.acquire()
+            try:
+                entry = self.stats.get(name)
+                if entry is None:
+                    entry = self.stats[name] = [ 0, 0.0, 0.0, 0 ]
+                entry[0] = entry[0] + 1
+                entry[1] = entry[1] + seconds
+                entry[2] = entry[2] + seconds - nested
+                entry[3] = entry[3] + items
+            finally:
+                self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.stats = {}
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        The counts so far, for metrics and logging: type name -> { count,
+        seconds, self_seconds, items }.
+        """
+        self.lock.acquire()
+        try:
+            result = {}
+            for (name, (count, seconds, self_seconds, items)) in self.stats.iteritems():
+                result[name] = { "count": count, "seconds": seconds, "self_seconds": self_seconds, "items": items }
+            return result
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def format(self):
+        """
+        The counts as lines of a table, the most expensive types first.
+        """
+        stats = self.snapshot()
+        names = stats.keys()
+        names.sort(key=lambda name: -stats[name]["self_seconds"])
+        lines = [ "%-24s %10s %10s %12s %12s %10s" % ("type", "count", "items", "total ms", "self ms", "us each") ]
+        for name in names:
+            entry = stats[name]
+            lines.append("%-24s %10d %10d %12.2f %12.2f %10.2f" % (
+                name, entry["count"], entry["items"], entry["seconds"] * 1000, entry["self_seconds"] * 1000,
+                entry["self_seconds"] * 1000000 / entry["count"]))
+        return lines
 
 class BaseData:
 
@@ -25,6 +148,8 @@ class BaseData:
         """
         self._data = {}
         self._map = self.get_map()
+        self._fingerprint = None
+        self._parents = None
 
         # initialize objects to stock values
         for (k, v) in self._map.iteritems():
@@ -50,6 +175,7 @@ class BaseData:
         Given a json string as data, set the object state to reflect the datastructure contents.
         """
         self._data = {}
+        self._invalidate()
         self.from_datastruct(simplejson.loads(json))
         return self
 
@@ -122,6 +248,20 @@ class BaseData:
  
         More types can be added later.
         """
+        if _profiler is not None:
+            (default, typ, restrictions) = self._map[key]
+            items = 0
+            if type(value) == type([]):
+                items = len(value)
+            return _profiler.measure(type_name(typ, restrictions), items, self.__coerce_value, key, value)
+        return self.__coerce_value(key, value)
+
+    # ----------------------------------------------------------------------------
+
+    def __coerce_value(self, key, value):
+        """
+        The coercion of __coerce_type, without profiling.
+        """
         (default, typ, restrictions) = self._map[key]
         if value is None:
             return None
@@ -180,6 +320,7 @@ class BaseData:
         assert self._map.has_key(key), "no such data member: %s" % key
         value = self.__coerce_type(key, value)
         self._data[key] = value
+        self._invalidate()
 
     # ----------------------------------------------------------------------------
 
@@ -200,6 +341,109 @@ class BaseData:
 
     # ----------------------------------------------------------------------------
 
+    def fingerprint(self):
+        """
+        Return a stable structural hash (hex string) of this object and everything
+        beneath it.  Field order does not matter, list order does.  The value is
+        cached per object and recomputed only for subtrees that were changed through
+        set(), so repeated calls are O(1).  Lists modified in place (e.g. appending
+        to get("pricing")) are not noticed; set() the list again after doing so.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            keys = self._data.keys()
+            keys.sort()
+            for k in keys:
+                value = self._data[k]
+                self._adopt(value)
+                digest.update(str(k))
+                digest.update("\0")
+                digest.update(self.__fingerprint_value(value))
+                digest.update("\0")
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    # ----------------------------------------------------------------------------
+
+    def matches(self, other):
+        """
+        True if other has the same structure and values as this object.
+        Once both fingerprints are cached this is a constant time check.
+        """
+        return isinstance(other, BaseData) and self.fingerprint() == other.fingerprint()
+
+    # ----------------------------------------------------------------------------
+
+    def __fingerprint_value(self, value):
+        """
+        Hashable string form of a single field value.
+        """
+        if isinstance(value, BaseData):
+            return value.fingerprint()
+        elif type(value) == type([]):
+            return "[%s]" % ",".join([ self.__fingerprint_value(x) for x in value ])
+        else:
+            return simplejson.dumps(value, sort_keys=True)
+
+    # ----------------------------------------------------------------------------
+
+    def _adopt(self, value):
+        """
+        Remember that self contains value, so that changes to value can invalidate
+        our cached fingerprint.  Only needed once we have a fingerprint to lose,
+        so this is done when computing it rather than on every set().
+        """
+        if isinstance(value, BaseData):
+            value._add_parent(self)
+        elif type(value) == type([]):
+            for item in value:
+                if isinstance(item, BaseData):
+                    item._add_parent(self)
+
+    # ----------------------------------------------------------------------------
+
+    def _add_parent(self, parent):
+        if self._parents is None:
+            self._parents = weakref.WeakValueDictionary()
+        self._parents[id(parent)] = parent
+
+    # ----------------------------------------------------------------------------
+
+    def _invalidate(self):
+        """
+        Drop the cached fingerprint of this object and of every object containing it.
+        A parent only caches its fingerprint after its children have, so if ours
+        is gone already, so are theirs.
+        """
+        if self._fingerprint is None:
+            return
+        self._fingerprint = None
+        if self._parents is not None:
+            for parent in self._parents.values():
+                parent._invalidate()
+
+    # ----------------------------------------------------------------------------
+
+    def __getstate__(self):
+        """
+        Pickling support; the fingerprint cache and parent links are not saved.
+        """
+        state = self.__dict__.copy()
+        del state["_parents"]
+        state["_fingerprint"] = None
+        return state
+
+    # ----------------------------------------------------------------------------
+
+    def __setstate__(self, state):
+        """
+        Pickling support; parent links are made again with the next fingerprint.
+        """
+        self.__dict__.update(state)
+        self._parents = None
+
+    # ----------------------------------------------------------------------------
+
     def human_diff(self, other):
         """
         Print out the differences between two projects in nice, indented JSON.
@@ -0,0 +1,283 @@
+#!/usr/local/bin/python25
+"""
+A local, indexed mirror of project data.
+
+Catalog keeps projects in an SQLite database keyed by content_id, with
+secondary indexes on the fields people most often search by, so questions
+like "which titles use trim size A5" are answered locally:
+
+    catalog = Catalog("/var/lib/lulu/catalog.db")
+    for content_id in client.list_projects():
+        catalog.put(client.read(content_id))
+    for project in catalog.find(trim_size="A5", project_type="softcover"):
+        print project.get("bibliography").get("title")
+
+find_ids() answers from the indexes alone and is the fastest way to query;
+find() and get() also decode the stored projects.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import sqlite3
+import threading
+import time
+import simplejson
+import project as cproject
+
+# indexed column -> path of keys to the value within a project datastructure
+INDEXED_FIELDS = {
+    "isbn"         : ("isbn", "number"),
+    "title"        : ("bibliography", "title"),
+    "project_type" : ("project_type",),
+    "binding_type" : ("physical_attributes", "binding_type"),
+    "trim_size"    : ("physical_attributes", "trim_size"),
+    "access"       : ("access",),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    content_id   INTEGER PRIMARY KEY,
+    fingerprint  TEXT NOT NULL,
+    isbn         TEXT,
+    title        TEXT COLLATE NOCASE,
+    project_type TEXT,
+    binding_type TEXT,
+    trim_size    TEXT,
+    access       TEXT,
+    stored_at    REAL NOT NULL,
+    checked_at   REAL NOT NULL,
+    body         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS projects_isbn ON projects (isbn);
+CREATE INDEX IF NOT EXISTS projects_title ON projects (title);
+CREATE INDEX IF NOT EXISTS projects_project_type ON projects (project_type);
+CREATE INDEX IF NOT EXISTS projects_binding_type ON projects (binding_type);
+CREATE INDEX IF NOT EXISTS projects_trim_size ON projects (trim_size);
+CREATE INDEX IF NOT EXISTS projects_access ON projects (access);
+"""
+
+# columns added since the first catalogs were written: name -> definition,
+# and the statements to run once they are there
+ADDED_COLUMNS = [
+    ("checked_at", "REAL NOT NULL DEFAULT 0"),
+]
+UPGRADE = """
+CREATE INDEX IF NOT EXISTS projects_checked_at ON projects (checked_at);
+"""
+
+class Catalog:
+    """
+    Persistent store of Project objects by content_id.  The default path keeps
+    the catalog in memory.  A Catalog may be shared between threads.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.__upgrade()
+        self.db.commit()
+
+    # ----------------------------------------------------------------------------
+
+    def __upgrade(self):
+        """
+        Add the columns an older catalog lacks.  Projects stored before
+        checked_at existed count as never checked.
+        """
+        columns = [ row[1] for row in self.db.execute("PRAGMA table_info(projects)") ]
+        for (name, definition) in ADDED_COLUMNS:
+            if name not in columns:
+                self.db.execute("ALTER TABLE projects ADD COLUMN %s %s" % (name, definition))
+        self.db.executescript(UPGRADE)
+
+    # ----------------------------------------------------------------------------
+
+    def put(self, project):
+        """
+        Store (or replace) a project, which must have a content_id.
+        """
+        self.put_many([ project ])
+
+    # ----------------------------------------------------------------------------
+
+    def put_many(self, projects):
+        """
+        Store (or replace) several projects in one transaction.
+        """
+        rows = [ self.__row(p) for p in projects ]
+        self.lock.acquire()
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO projects (content_id, fingerprint, isbn, title, " +
+                                "project_type, binding_type, trim_size, access, stored_at, checked_at, body) " +
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def __row(self, project):
+        assert isinstance(project, cproject.Project), "expected a publish.common.project.Project"
+        content_id = project.get("content_id")
+        assert type(content_id) == int and content_id > 0, "project has no content_id"
+        ds = project.to_datastruct()
+        indexed = [ _lookup(ds, INDEXED_FIELDS[k]) for k in ("isbn", "title", "project_type", "binding_type", "trim_size", "access") ]
+        now = time.time()
+        return tuple([ content_id, project.fingerprint() ] + indexed + [ now, now, simplejson.dumps(ds) ])
+
+    # ----------------------------------------------------------------------------
+
+    def get(self, content_id):
+        """
+        Return the stored Project for content_id, or None.
+        """
+        rows = self.__query("SELECT body FROM projects WHERE content_id = ?", (content_id,))
+        if len(rows) == 0:
+            return None
+        return cproject.Project(simplejson.loads(rows[0][0]))
+
+    # ----------------------------------------------------------------------------
+
+    def delete(self, content_id):
+        """
+        Remove a project from the catalog.
+        """
+        self.lock.acquire()
+        try:
+            self.db.execute("DELETE FROM projects WHERE content_id = ?", (content_id,))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def find_ids(self, **criteria):
+        """
+        Return the sorted content_ids of projects matching all the criteria, which
+        are exact matches on the indexed fields (see INDEXED_FIELDS), ex:
+        find_ids(trim_size="A5", binding_type="perfect").  Titles match without
+        regard to case.  A value of None matches projects where the field is unset.
+        """
+        (where, args) = self.__where(criteria)
+        rows = self.__query("SELECT content_id FROM projects%s ORDER BY content_id" % where, args)
+        return [ r[0] for r in rows ]
+
+    # ----------------------------------------------------------------------------
+
+    def find(self, **criteria):
+        """
+        Like find_ids, but return the Project objects.
+        """
+        (where, args) = self.__where(criteria)
+        rows = self.__query("SELECT body FROM projects%s ORDER BY content_id" % where, args)
+        return [ cproject.Project(simplejson.loads(r[0])) for r in rows ]
+
+    # ----------------------------------------------------------------------------
+
+    def __where(self, criteria):
+        clauses = []
+        args = []
+        for (k, v) in criteria.iteritems():
+            if not INDEXED_FIELDS.has_key(k):
+                raise KeyError("not an indexed field: %s" % k)
+            if v is None:
+                clauses.append("%s IS NULL" % k)
+            else:
+                clauses.append("%s = ?" % k)
+                args.append(v)
+        if len(clauses) == 0:
+            return ("", args)
+        return (" WHERE " + " AND ".join(clauses), args)
+
+    # ----------------------------------------------------------------------------
+
+    def content_ids(self):
+        """
+        All content_ids in the catalog, sorted.
+        """
+        return [ r[0] for r in self.__query("SELECT content_id FROM projects ORDER BY content_id", ()) ]
+
+    # ----------------------------------------------------------------------------
+
+    def fingerprints(self):
+        """
+        A hash of content_id -> fingerprint for every stored project.
+        """
+        results = {}
+        for (content_id, fp) in self.__query("SELECT content_id, fingerprint FROM projects", ()):
+            results[content_id] = str(fp)
+        return results
+
+    # ----------------------------------------------------------------------------
+
+    def mark_checked(self, content_ids, when=None):
+        """
+        Record that the stored copies of these projects were confirmed current
+        with the server at time when (default: now).  put() does this implicitly.
+        """
+        if when is None:
+            when = time.time()
+        self.lock.acquire()
+        try:
+            self.db.executemany("UPDATE projects SET checked_at = ? WHERE content_id = ?",
+                                [ (when, content_id) for content_id in content_ids ])
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def stale_ids(self, checked_before, limit=None):
+        """
+        content_ids of projects last checked before the given time, oldest first.
+        """
+        sql = "SELECT content_id FROM projects WHERE checked_at < ? ORDER BY checked_at"
+        args = (checked_before,)
+        if limit is not None:
+            sql = sql + " LIMIT ?"
+            args = (checked_before, limit)
+        return [ r[0] for r in self.__query(sql, args) ]
+
+    # ----------------------------------------------------------------------------
+
+    def __query(self, sql, args):
+        self.lock.acquire()
+        try:
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def __contains__(self, content_id):
+        return len(self.__query("SELECT 1 FROM projects WHERE content_id = ?", (content_id,))) > 0
+
+    def __len__(self):
+        return self.__query("SELECT COUNT(*) FROM projects", ())[0][0]
+
+    # ----------------------------------------------------------------------------
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.lock.release()
+
+def _lookup(ds, keys):
+    for k in keys:
+        if type(ds) != type({}):
+            return None
+        ds = ds.get(k)
+    return ds
@@ -0,0 +1,238 @@
+#!/usr/local/bin/python25
+"""
+Validating, building and encoding projects on a pool of processes.
+
+Building a Project from a hash, coercing its fields and serializing it with
+to_json() is pure Python, so in one process it runs on one core however
+many threads the network side uses.  ProcessEncoder shards a stream of
+project hashes across worker processes, which validate them with a
+BatchValidator, build the objects and encode them, handing back
+EncodedProjects: the JSON request body, ready for Client.create or
+Client.update, with the project's content_id.
+
+    encoder = ProcessEncoder(processes=4)
+    try:
+        for result in bulk.run_parallel(client.create, encoder.projects(specs, on_error=log), workers=8):
+            ...
+    finally:
+        encoder.close()
+
+Rows are sent to the workers in batches of batch_size, so each batch is
+pickled once each way and its fields are validated together, and results
+come back in input order.  At most window batches are in flight, so a long
+input (ex: publish.common.feed.FeedReader.dicts()) is consumed lazily and
+memory stays bounded.  With processes=0 the work is done in the calling
+process, the same way.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import collections
+import multiprocessing
+import baseobj
+import project as cproject
+import validate as cvalidate
+
+class EncodedProject:
+    """
+    A project already serialized, standing in for the Project in
+    Client.create and Client.update, which only need its JSON.  fingerprint
+    is that of the Project it was encoded from, if the encoder was asked to
+    compute it, so that update(skip_unchanged) can still skip it.
+    """
+
+    def __init__(self, json, content_id=None, fingerprint=None):
+        self.json = json
+        self.content_id = content_id
+        self._fingerprint = fingerprint
+
+    def to_json(self):
+        return self.json
+
+    def get(self, key):
+        assert key == "content_id", "an EncodedProject only has its content_id, not %s" % key
+        return self.content_id
+
+    def fingerprint(self):
+        return self._fingerprint
+
+    def __str__(self):
+        return self.json
+
+class EncodeResult:
+    """
+    The outcome for one input row.  index is its position in the input;
+    value is its EncodedProject, or errors lists the ValidationErrors (with
+    index as their row) that kept it from being encoded.
+    """
+
+    def __init__(self, index, value=None, errors=None):
+        self.index = index
+        self.value = value
+        self.errors = errors or []
+
+    def ok(self):
+        return self.value is not None
+
+# the class and validator of a worker process, set up by _init_worker
+_worker = None
+
+def _make_worker(cls, validate, fingerprint):
+    validator = None
+    if validate:
+        validator = cvalidate.BatchValidator(cls)
+    return (cls, validator, fingerprint)
+
+def _init_worker(cls, validate, fingerprint):
+    global _worker
+    _worker = _make_worker(cls, validate, fingerprint)
+
+def _encode_batch(batch, worker=None):
+    """
+    Encode a batch (start, [ hash or object ]), returning a list with, for
+    each row, (json, content_id, fingerprint, None) or (None, None, None, errors).
+    """
+    (start, rows) = batch
+    (cls, validator, fingerprint) = worker or _worker
+    bad = {}
+    if validator is not None:
+        hashes = [ (i, row) for (i, row) in enumerate(rows) if not isinstance(row, baseobj.BaseData) ]
+        for error in validator.validate([ row for (i, row) in hashes ]):
+            i = hashes[error.row][0]
+            bad.setdefault(i, []).append(cvalidate.ValidationError(start + i, error.path, error.message))
+    results = []
+    for (i, row) in enumerate(rows):
+        if bad.has_key(i):
+            results.append((None, None, None, bad[i]))
+            continue
+        try:
+            if isinstance(row, baseobj.BaseData):
+                obj = row
+            else:
+                obj = cls(row)
+            digest = None
+            if fingerprint:
+                digest = obj.fingerprint()
+            results.append((obj.to_json(), obj.get("content_id"), digest, None))
+        except Exception, e:
+            # set() checks with assert, and a few errors get past the validator
+            results.append((None, None, None, [ cvalidate.ValidationError(start + i, "", str(e)) ]))
+    return results
+
+class ProcessEncoder:
+    """
+    Validates, builds and encodes project hashes on a pool of processes.
+    """
+
+    def __init__(self, processes=None, cls=cproject.Project, batch_size=200, window=None,
+                 validate=True, fingerprint=False):
+        """
+        processes:   worker processes, by default one per core; 0 to work in this process
+        cls:         the BaseData class to build, by default Project
+        batch_size:  rows sent to a worker at a time
+        window:      batches in flight at most, by default twice the processes
+        validate:    check rows with a BatchValidator first, reporting every error found;
+                     turn off for rows validated already, ex: by a FeedReader
+        fingerprint: also compute each project's fingerprint, for update(skip_unchanged)
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.cls = cls
+        self.batch_size = batch_size
+        self.window = window or max(2, 2 * processes)
+        self.pool = None
+        self.worker = None
+        if processes > 0:
+            self.pool = multiprocessing.Pool(processes, _init_worker, (cls, validate, fingerprint))
+        else:
+            self.worker = _make_worker(cls, validate, fingerprint)
+        self.encoded = 0
+        self.rejected = 0
+
+    # ----------------------------------------------------------------------------
+
+    def encode(self, rows):
+        """
+        Yield an EncodeResult for each row of the iterable, in input order.
+        Rows are hashes, as from_datastruct() takes them, or objects of cls.
+        """
+        pending = collections.deque()
+        for batch in self.__batches(rows):
+            if self.pool is None:
+                pending.append((batch[0], _encode_batch(batch, self.worker)))
+            else:
+                pending.append((batch[0], self.pool.apply_async(_encode_batch, (batch,))))
+            while len(pending) >= self.window:
+                for result in self.__results(pending.popleft()):
+                    yield result
+        while pending:
+            for result in self.__results(pending.popleft()):
+                yield result
+
+    # ----------------------------------------------------------------------------
+
+    def projects(self, rows, on_error=None):
+        """
+        Yield the EncodedProject of each row that could be encoded, in input
+        order, calling on_error with each ValidationError of the others.
+        """
+        for result in self.encode(rows):
+            if result.ok():
+                yield result.value
+            elif on_error is not None:
+                for error in result.errors:
+                    on_error(error)
+
+    # ----------------------------------------------------------------------------
+
+    def __batches(self, rows):
+        batch = []
+        start = 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield (start, batch)
+                start = start + len(batch)
+                batch = []
+        if batch:
+            yield (start, batch)
+
+    # ----------------------------------------------------------------------------
+
+    def __results(self, pending):
+        (start, results) = pending
+        if self.pool is not None:
+            results = results.get()
+        for (i, (json, content_id, digest, errors)) in enumerate(results):
+            if errors:
+                self.rejected = self.rejected + 1
+                yield EncodeResult(start + i, errors=errors)
+            else:
+                self.encoded = self.encoded + 1
+                yield EncodeResult(start + i, EncodedProject(json, content_id, digest))
+
+    # ----------------------------------------------------------------------------
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    # ----------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Counts, for metrics and logging.
+        """
+        return { "processes": self.processes, "encoded": self.encoded, "rejected": self.rejected }
@@ -0,0 +1,386 @@
+#!/usr/local/bin/python25
+"""
+Columnar export of project catalogs.
+
+CatalogExporter turns a stream of projects into column batches.  Scalar
+fields go to the "projects" table, with columns named by the dotted paths
+to_flattened_datastruct() uses (ex: bibliography.title).  Each list field
+becomes a child table named by its path (pricing, bibliography.authors,
+bibliography.keywords, ...) with one row per element, linked to its project
+by content_id and index.  Column types come from the get_map() types:
+
+    int                 -> int
+    currency, float     -> float
+    boolean             -> bool
+    choice              -> category (a string from a small set)
+    string, others      -> string
+
+A value that does not convert to its column type (ex: "n/a" in an int
+field) is exported as missing, and counted by column in exporter.invalid.
+
+Projects are consumed lazily and batches are flushed every batch_size
+projects, so memory use does not depend on the catalog size:
+
+    exporter = CatalogExporter(batch_size=5000)
+    export(exporter, projects, CSVWriter("/tmp/catalog"))
+
+ArrowWriter needs pyarrow and to_numpy() needs numpy; neither is required
+for the rest of the module.  ArrowWriter writes category columns as plain
+strings: the Arrow IPC file format allows only one dictionary per column
+for the whole file, and each batch would bring its own.
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import csv
+import os
+import baseobj
+import project as cproject
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAIN_TABLE = "projects"
+
+def _to_int(value):
+    if value is None:
+        return None
+    return int(value)
+
+def _to_float(value):
+    if value is None:
+        return None
+    return float(value)
+
+def _to_bool(value):
+    if value is None:
+        return None
+    return bool(value)
+
+def _to_string(value):
+    if value is None:
+        return None
+    return unicode(value)
+
+COLUMN_TYPES = {
+    "int"      : ("int",      _to_int),
+    "currency" : ("float",    _to_float),
+    "float"    : ("float",    _to_float),
+    "boolean"  : ("bool",     _to_bool),
+    "bool"     : ("bool",     _to_bool),
+    "choice"   : ("category", _to_string),
+    "string"   : ("string",   _to_string),
+}
+
+class ColumnBatch:
+    """
+    A set of rows of one table, stored as one list per column.
+    names is the column order, types maps each name to its column type.
+    """
+
+    def __init__(self, table, names, types):
+        self.table = table
+        self.names = names
+        self.types = types
+        self.columns = {}
+        for name in names:
+            self.columns[name] = []
+
+    def __len__(self):
+        if len(self.names) == 0:
+            return 0
+        return len(self.columns[self.names[0]])
+
+    def rows(self):
+        """
+        The batch as a list of tuples, in column order.
+        """
+        return zip(*[ self.columns[name] for name in self.names ])
+
+class CatalogExporter:
+    """
+    Converts projects, project hashes or read() payloads ({"project": {...}})
+    into ColumnBatch objects.
+    """
+
+    def __init__(self, cls=cproject.Project, batch_size=1000):
+        self.batch_size = batch_size
+        self.invalid = {}  # "table.column" -> values that did not convert, exported as missing
+        self.tables = {}   # table name -> (names, types)
+        self._scalars = [] # (column name, key path, converter)
+        self._lists = []   # (table name, key path, element columns or None, element converter)
+        self.__compile(cls, (), self._scalars, self._lists, MAIN_TABLE)
+        names = [ "content_id" ] + [ c[0] for c in self._scalars if c[0] != "content_id" ]
+        self.tables[MAIN_TABLE] = (names, self.__types(self._scalars))
+
+    # ----------------------------------------------------------------------------
+
+    def __types(self, scalars):
+        types = { "content_id": "int" }
+        for (name, keys, conv, typ) in scalars:
+            types[name] = typ
+        return types
+
+    # ----------------------------------------------------------------------------
+
+    def __compile(self, cls, keys, scalars, lists, table):
+        """
+        Walk the map of cls, sorting fields into scalar columns and child tables.
+        """
+        fmap = cls().get_map()
+        names = fmap.keys()
+        names.sort()
+        for k in names:
+            (default, typ, restrictions) = fmap[k]
+            path = keys + (k,)
+            if typ == "list":
+                if _is_object_type(restrictions):
+                    columns = []
+                    self.__compile(restrictions, (), columns, [], None)
+                    conv = None
+                else:
+                    columns = None
+                    conv = COLUMN_TYPES.get(restrictions, COLUMN_TYPES["string"])
+                child = ".".join(path)
+                lists.append((child, path, columns, conv))
+                if table is not None:
+                    if columns is None:
+                        self.tables[child] = ([ "content_id", "index", "value" ], { "content_id": "int", "index": "int", "value": conv[0] })
+                    else:
+                        types = self.__types(columns)
+                        types["index"] = "int"
+                        self.tables[child] = ([ "content_id", "index" ] + [ c[0] for c in columns ], types)
+            elif _is_object_type(typ):
+                self.__compile(typ, path, scalars, lists, table)
+            else:
+                (coltype, conv) = COLUMN_TYPES.get(typ, COLUMN_TYPES["string"])
+                scalars.append((".".join(path), path, conv, coltype))
+
+    # ----------------------------------------------------------------------------
+
+    def batches(self, projects):
+        """
+        Yields ColumnBatch objects for every table, flushing every batch_size projects.
+        Child tables with no rows in a flush are skipped.
+        """
+        current = self.__new_batches()
+        count = 0
+        for item in projects:
+            self.__add(self.__datastruct(item), current)
+            count = count + 1
+            if count >= self.batch_size:
+                for batch in self.__flush(current):
+                    yield batch
+                current = self.__new_batches()
+                count = 0
+        if count > 0:
+            for batch in self.__flush(current):
+                yield batch
+
+    # ----------------------------------------------------------------------------
+
+    def __new_batches(self):
+        results = {}
+        for (table, (names, types)) in self.tables.iteritems():
+            results[table] = ColumnBatch(table, names, types)
+        return results
+
+    # ----------------------------------------------------------------------------
+
+    def __flush(self, current):
+        tables = current.keys()
+        tables.sort()
+        tables.remove(MAIN_TABLE)
+        for table in [ MAIN_TABLE ] + tables:
+            if len(current[table]) > 0:
+                yield current[table]
+
+    # ----------------------------------------------------------------------------
+
+    def __datastruct(self, item):
+        if isinstance(item, baseobj.BaseData):
+            return item.to_datastruct()
+        if item.has_key("project") and type(item["project"]) == type({}):
+            return item["project"]
+        return item
+
+    # ----------------------------------------------------------------------------
+
+    def __add(self, ds, current):
+        """
+        Append one project datastructure to the batches.
+        """
+        main = current[MAIN_TABLE].columns
+        for (name, keys, conv, typ) in self._scalars:
+            main[name].append(self.__convert(conv, _lookup(ds, keys), MAIN_TABLE, name))
+        content_id = main["content_id"][-1]
+        for (table, keys, columns, conv) in self._lists:
+            values = _lookup(ds, keys)
+            if not values:
+                continue
+            child = current[table].columns
+            for (i, value) in enumerate(values):
+                child["content_id"].append(content_id)
+                child["index"].append(i)
+                if columns is None:
+                    child["value"].append(self.__convert(conv[1], value, table, "value"))
+                else:
+                    if isinstance(value, baseobj.BaseData):
+                        value = value.to_datastruct()
+                    for (name, subkeys, subconv, typ) in columns:
+                        child[name].append(self.__convert(subconv, _lookup(value, subkeys), table, name))
+
+    # ----------------------------------------------------------------------------
+
+    def __convert(self, conv, value, table, name):
+        """
+        conv(value), or None, counted in invalid, if value does not convert.
+        """
+        try:
+            return conv(value)
+        except (ValueError, TypeError):
+            key = "%s.%s" % (table, name)
+            self.invalid[key] = self.invalid.get(key, 0) + 1
+            return None
+
+def _lookup(ds, keys):
+    """
+    Follow a path of keys into nested hashes, returning None where it ends early.
+    """
+    for k in keys:
+        if type(ds) != type({}):
+            return None
+        ds = ds.get(k)
+    return ds
+
+def _is_object_type(typ):
+    try:
+        return issubclass(typ, baseobj.BaseData)
+    except TypeError:
+        return False
+
+def export(exporter, projects, writer):
+    """
+    Stream projects through exporter into writer, then close the writer.
+    Returns the number of rows written per table.
+    """
+    counts = {}
+    try:
+        for batch in exporter.batches(projects):
+            writer.write(batch)
+            counts[batch.table] = counts.get(batch.table, 0) + len(batch)
+    finally:
+        writer.close()
+    return counts
+
+class CSVWriter:
+    """
+    Writes each table to <directory>/<table>.csv, UTF-8 encoded, with a header row.
+    Missing values are written as empty fields.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, batch):
+        if not self.files.has_key(batch.table):
+            fd = open(os.path.join(self.directory, "%s.csv" % batch.table), "wb")
+            writer = csv.writer(fd)
+            writer.writerow(batch.names)
+            self.files[batch.table] = (fd, writer)
+        writer = self.files[batch.table][1]
+        for row in batch.rows():
+            writer.writerow([ _csv_value(v) for v in row ])
+
+    def close(self):
+        for (fd, writer) in self.files.itervalues():
+            fd.close()
+        self.files = {}
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+class ArrowWriter:
+    """
+    Writes each table to <directory>/<table>.arrow in the Arrow IPC file format,
+    one record batch per ColumnBatch.  Requires pyarrow.
+    """
+
+    def __init__(self, directory):
+        if pyarrow is None:
+            raise Exception("ArrowWriter requires the pyarrow package")
+        self.directory = directory
+        self.writers = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, batch):
+        arrays = [ _arrow_array(batch.columns[name], batch.types[name]) for name in batch.names ]
+        if not self.writers.has_key(batch.table):
+            fields = [ pyarrow.field(name, arrays[i].type) for (i, name) in enumerate(batch.names) ]
+            sink = pyarrow.OSFile(os.path.join(self.directory, "%s.arrow" % batch.table), "wb")
+            self.writers[batch.table] = (sink, pyarrow.RecordBatchFileWriter(sink, pyarrow.schema(fields)))
+        self.writers[batch.table][1].write_batch(pyarrow.RecordBatch.from_arrays(arrays, batch.names))
+
+    def close(self):
+        for (sink, writer) in self.writers.itervalues():
+            writer.close()
+            sink.close()
+        self.writers = {}
+
+def _arrow_array(values, coltype):
+    if coltype == "int":
+        return pyarrow.array(values, type=pyarrow.int64())
+    elif coltype == "float":
+        return pyarrow.array(values, type=pyarrow.float64())
+    elif coltype == "bool":
+        return pyarrow.array(values, type=pyarrow.bool_())
+    return pyarrow.array(values, type=pyarrow.string())
+
+NUMPY_TYPES = { "int": "i8", "float": "f8", "bool": "?", "category": "O", "string": "O" }
+NUMPY_FILL = { "int": 0, "float": 0.0, "bool": False, "category": None, "string": None }
+
+def to_numpy(batch):
+    """
+    Convert a ColumnBatch to a numpy masked record array; missing values are masked.
+    Requires numpy.
+    """
+    if numpy is None:
+        raise Exception("to_numpy requires the numpy package")
+    arrays = []
+    masks = []
+    for name in batch.names:
+        coltype = batch.types[name]
+        fill = NUMPY_FILL[coltype]
+        values = batch.columns[name]
+        arrays.append(numpy.array([ _fill(v, fill) for v in values ], dtype=NUMPY_TYPES[coltype]))
+        masks.append(numpy.array([ v is None for v in values ], dtype="?"))
+    dtype = [ (str(name), NUMPY_TYPES[batch.types[name]]) for name in batch.names ]
+    data = numpy.rec.fromarrays(arrays, dtype=dtype)
+    mask = numpy.rec.fromarrays(masks, dtype=[ (str(name), "?") for name in batch.names ])
+    return numpy.ma.array(data, mask=mask)
+
+def _fill(value, fill):
+    if value is None:
+        return fill
+    return value
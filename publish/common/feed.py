@@ -0,0 +1,393 @@
+#!/usr/local/bin/python25
+"""
+Streaming reader for publishing feeds: large CSV or JSONL files with one
+project per row.
+
+CSV headers name dotted paths into the project schema, the same paths
+to_flattened_datastruct() and the catalog exporter use, ex:
+bibliography.title or physical_attributes.trim_size.  A number in a path
+is a list position, so bibliography.authors.0.last_name fills the first
+author.  The header is checked against the get_map() schemas once, and
+each cell is converted to its field's type (int, float, boolean, or
+unicode; a list cell holds a JSON list, ex: ["poetry", "haiku"]).  Empty
+cells are left out.  JSONL rows are nested hashes, as from_datastruct()
+takes them.
+
+Rows are read lazily and handed out in chunks of at most chunk_size,
+checked together with a BatchValidator, so memory use does not depend on
+the size of the feed.  Rows with errors are left out of the chunks and
+reported through on_error:
+
+    reader = FeedReader("catalog.csv", chunk_size=1000, on_error=log_error)
+    for chunk in reader.chunks():
+        print chunk.start, len(chunk.items), len(chunk.errors)
+
+dicts() and projects() yield the validated rows one at a time, as hashes
+or as Project objects, and can be passed straight to the bulk client calls,
+which consume their input lazily:
+
+    for result in client.iter_update_many(reader.dicts(), workers=8):
+        ...
+    for result in bulk.run_parallel(client.create, reader.projects(), workers=8):
+        ...
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import csv
+import gzip
+import simplejson
+import baseobj
+import project as cproject
+import validate as cvalidate
+
+TRUE_STRINGS = [ "true", "t", "yes", "y", "1" ]
+FALSE_STRINGS = [ "false", "f", "no", "n", "0" ]
+
+class FeedError(Exception):
+    """
+    A feed that cannot be read at all, ex: a CSV column not in the schema.
+    """
+    pass
+
+def _to_boolean(value):
+    if value.lower() in TRUE_STRINGS:
+        return True
+    if value.lower() in FALSE_STRINGS:
+        return False
+    raise ValueError("not a boolean: %s" % value)
+
+def _to_list(value):
+    result = simplejson.loads(value)
+    if type(result) != type([]):
+        raise ValueError("not a JSON list: %s" % value)
+    return result
+
+# get_map() type -> conversion of a CSV cell (already decoded to unicode)
+CONVERTERS = {
+    "int"      : int,
+    "currency" : float,
+    "float"    : float,
+    "boolean"  : _to_boolean,
+    "bool"     : _to_boolean,
+    "list"     : _to_list,
+}
+
+def unflatten(row):
+    """
+    Turn { "a.b": "x", "c": "[1, 2]" } into { "a": { "b": "x" }, "c": [1, 2] },
+    without regard to any schema.
+    """
+    results = {}
+    for (path, value) in row.iteritems():
+        if value is None or value == "":
+            continue
+        if value.startswith("["):
+            value = simplejson.loads(value)
+        else:
+            value = value.decode("utf-8")
+        keys = path.split(".")
+        node = results
+        for k in keys[:-1]:
+            node = node.setdefault(k, {})
+        node[keys[-1]] = value
+    return results
+
+def open_feed(path):
+    """
+    Open a feed file, gunzipping it if its name ends in .gz.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+class FeedChunk:
+    """
+    A chunk of a feed.  start is the number of the chunk's first row (rows
+    are numbered from 0, not counting the CSV header); items holds the
+    valid rows, as hashes or objects, and rows their numbers; errors lists
+    the ValidationErrors of the rows left out.
+    """
+
+    def __init__(self, start, rows, items, errors):
+        self.start = start
+        self.rows = rows
+        self.items = items
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.items)
+
+class FeedReader:
+    """
+    Reads a CSV or JSONL feed of projects lazily, in validated chunks.
+    """
+
+    def __init__(self, source, format=None, cls=cproject.Project, chunk_size=1000,
+                 columns=None, encoding="utf-8", on_error=None):
+        """
+        source:     a file name, or an open file (then format is required)
+        format:     "csv" or "jsonl", by default from the file name, ignoring a .gz suffix
+        cls:        the BaseData class of a row, by default Project
+        chunk_size: maximum rows per chunk
+        columns:    optional hash renaming CSV headers to dotted paths; None drops the column
+        encoding:   of CSV cells
+        on_error:   called with each ValidationError of a row left out
+        """
+        if format is None:
+            if not isinstance(source, basestring):
+                raise FeedError("the format of a feed given as a file must be named")
+            name = source.lower()
+            if name.endswith(".gz"):
+                name = name[:-3]
+            format = name.endswith(".csv") and "csv" or "jsonl"
+        if format not in [ "csv", "jsonl" ]:
+            raise FeedError("unknown feed format: %s" % format)
+        self.source = source
+        self.format = format
+        self.cls = cls
+        self.chunk_size = chunk_size
+        self.columns = columns or {}
+        self.encoding = encoding
+        self.on_error = on_error
+        self.validator = cvalidate.BatchValidator(cls)
+        self.rows_read = 0
+        self.rows_rejected = 0
+        self._maps = {}
+
+    # ----------------------------------------------------------------------------
+
+    def chunks(self, objects=False):
+        """
+        Yield a FeedChunk per chunk_size rows, with the valid rows as hashes,
+        or as objects of cls if objects is set.
+        """
+        chunk = []
+        for pair in self.__rows():
+            chunk.append(pair)
+            if len(chunk) >= self.chunk_size:
+                yield self.__check(chunk, objects)
+                chunk = []
+        if chunk:
+            yield self.__check(chunk, objects)
+
+    # ----------------------------------------------------------------------------
+
+    def dicts(self):
+        """
+        Yield each valid row as a hash, ready for update() or from_datastruct().
+        """
+        for chunk in self.chunks():
+            for item in chunk.items:
+                yield item
+
+    # ----------------------------------------------------------------------------
+
+    def projects(self):
+        """
+        Yield each valid row as an object of cls, ready for create().
+        """
+        for chunk in self.chunks(objects=True):
+            for item in chunk.items:
+                yield item
+
+    # ----------------------------------------------------------------------------
+
+    def __rows(self):
+        """
+        Yield (row number, hash, conversion errors) for every row of the feed.
+        """
+        if isinstance(self.source, basestring):
+            fd = open_feed(self.source)
+        else:
+            fd = self.source
+        try:
+            if self.format == "csv":
+                rows = self.__csv_rows(fd)
+            else:
+                rows = self.__jsonl_rows(fd)
+            for row in rows:
+                self.rows_read = self.rows_read + 1
+                yield row
+        finally:
+            if fd is not self.source:
+                fd.close()
+
+    # ----------------------------------------------------------------------------
+
+    def __jsonl_rows(self, fd):
+        row = 0
+        for line in fd:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                yield (row, simplejson.loads(line), [])
+            except ValueError, e:
+                yield (row, {}, [ cvalidate.ValidationError(row, "", "invalid JSON: %s" % e) ])
+            row = row + 1
+
+    # ----------------------------------------------------------------------------
+
+    def __csv_rows(self, fd):
+        reader = csv.reader(fd)
+        try:
+            header = reader.next()
+        except StopIteration:
+            return
+        fields = self.__compile(header)
+        for (row, cells) in enumerate(reader):
+            ds = {}
+            errors = []
+            for (i, cell) in enumerate(cells):
+                if i >= len(fields) or fields[i] is None or cell == "":
+                    continue
+                (path, keys, typ, convert) = fields[i]
+                try:
+                    value = cell.decode(self.encoding)
+                    if convert is not None:
+                        value = convert(value)
+                except ValueError, e:
+                    errors.append(cvalidate.ValidationError(row, path, "cannot convert %r to %s" % (cell, typ), cell))
+                    continue
+                _insert(ds, keys, value)
+            yield (row, ds, errors)
+
+    # ----------------------------------------------------------------------------
+
+    def __compile(self, header):
+        """
+        For each CSV column, (path, keys, type, converter) or None for a dropped
+        column.  keys is the path split up, with list positions as ints.
+        """
+        fields = []
+        unknown = []
+        for name in header:
+            path = self.columns.get(name, name)
+            if path is None:
+                fields.append(None)
+                continue
+            try:
+                (keys, typ) = self.__resolve(path)
+            except FeedError, e:
+                unknown.append(str(e))
+                continue
+            fields.append((path, keys, typ, CONVERTERS.get(typ)))
+        if unknown:
+            raise FeedError("columns not in the schema: %s" % "; ".join(unknown))
+        return fields
+
+    # ----------------------------------------------------------------------------
+
+    def __resolve(self, path):
+        """
+        Find the field a dotted path names, returning (keys, type name).
+        """
+        parts = path.split(".")
+        keys = []
+        cls = self.cls
+        i = 0
+        while i < len(parts):
+            fmap = self.__get_map(cls)
+            if not fmap.has_key(parts[i]):
+                raise FeedError("%s: no such data member: %s" % (path, parts[i]))
+            (default, typ, restrictions) = fmap[parts[i]]
+            keys.append(parts[i])
+            i = i + 1
+            if i == len(parts):
+                break
+            if typ == "list" and parts[i].isdigit():
+                keys.append(int(parts[i]))
+                i = i + 1
+                (typ, restrictions) = (restrictions, None)
+                if i == len(parts):
+                    break
+            if not _is_object_type(typ):
+                raise FeedError("%s: %s is not an object field" % (path, parts[i - 1]))
+            cls = typ
+        if _is_object_type(typ):
+            raise FeedError("%s: %s is an object, name one of its fields" % (path, parts[-1]))
+        return (keys, typ)
+
+    # ----------------------------------------------------------------------------
+
+    def __get_map(self, cls):
+        """
+        get_map() builds default objects each time it is called, so cache the maps.
+        """
+        if not self._maps.has_key(cls):
+            self._maps[cls] = cls().get_map()
+        return self._maps[cls]
+
+    # ----------------------------------------------------------------------------
+
+    def __check(self, chunk, objects):
+        """
+        Validate a list of (row number, hash, conversion errors) as one batch,
+        returning a FeedChunk of the rows without errors.
+        """
+        report = self.validator.validate([ ds for (row, ds, errors) in chunk ])
+        bad = {}
+        for (i, (row, ds, errors)) in enumerate(chunk):
+            if errors:
+                bad[i] = list(errors)
+        for error in report:
+            (row, ds, errors) = chunk[error.row]
+            bad.setdefault(error.row, []).append(
+                cvalidate.ValidationError(row, error.path, error.message, error.value))
+        rows = []
+        items = []
+        for (i, (row, ds, errors)) in enumerate(chunk):
+            if bad.has_key(i):
+                continue
+            rows.append(row)
+            if objects:
+                items.append(self.cls(ds))
+            else:
+                items.append(ds)
+        errors = []
+        keys = bad.keys()
+        keys.sort()
+        for i in keys:
+            errors.extend(bad[i])
+        self.rows_rejected = self.rows_rejected + len(keys)
+        if self.on_error is not None:
+            for error in errors:
+                self.on_error(error)
+        return FeedChunk(chunk[0][0], rows, items, errors)
+
+def _insert(ds, keys, value):
+    """
+    Set value at a path of keys into nested hashes, where int keys are list
+    positions, creating the hashes and list elements on the way.
+    """
+    node = ds
+    for (i, k) in enumerate(keys[:-1]):
+        if type(keys[i + 1]) == type(0):
+            child = node.setdefault(k, [])
+        elif type(k) == type(0):
+            while len(node) <= k:
+                node.append({})
+            child = node[k]
+        else:
+            child = node.setdefault(k, {})
+        node = child
+    k = keys[-1]
+    if type(k) == type(0):
+        while len(node) <= k:
+            node.append(None)
+        node[k] = value
+    else:
+        node[k] = value
+
+def _is_object_type(typ):
+    try:
+        return issubclass(typ, baseobj.BaseData)
+    except TypeError:
+        return False
@@ -0,0 +1,275 @@
+#!/usr/local/bin/python25
+"""
+Batch validation of project datastructures against the BaseData maps.
+
+Checking a feed by constructing a Project per row stops at the first bad
+field, relies on assert (which python -O disables) and builds every object.
+BatchValidator instead walks the get_map() schemas once per batch, checking
+each field across all rows together, and reports every problem found.
+
+    validator = BatchValidator()
+    report = validator.validate([ {"project_type": "ebook"}, {"access": "nope"} ])
+    for error in report:
+        print error.row, error.path, error.message
+
+Copyright 2010 Lulu Enterprises
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import baseobj
+import project as cproject
+
+BASIC_TYPES = [ "currency", "float", "int", "string", "list", "boolean" ]
+
+class ValidationError:
+    """
+    One problem found in one row.  path is the dotted field path within the
+    row, with list positions as numbers, ex: bibliography.authors.0.last_name
+    """
+
+    def __init__(self, row, path, message, value=None):
+        self.row = row
+        self.path = path
+        self.message = message
+        self.value = value
+
+    def to_datastruct(self):
+        return { "row": self.row, "path": self.path, "message": self.message }
+
+    def __str__(self):
+        return "row %s, %s: %s" % (self.row, self.path, self.message)
+
+class ValidationReport:
+    """
+    The result of validating a batch: every error, in row order.
+    """
+
+    def __init__(self, row_count, errors):
+        self.row_count = row_count
+        errors.sort(key=lambda e: (e.row, e.path))
+        self.errors = errors
+
+    def ok(self):
+        """
+        True if no errors were found.
+        """
+        return len(self.errors) == 0
+
+    def bad_rows(self):
+        """
+        Sorted list of row numbers that have at least one error.
+        """
+        rows = {}
+        for e in self.errors:
+            rows[e.row] = 1
+        rows = rows.keys()
+        rows.sort()
+        return rows
+
+    def by_row(self):
+        """
+        Errors grouped in a hash keyed by row number.
+        """
+        results = {}
+        for e in self.errors:
+            results.setdefault(e.row, []).append(e)
+        return results
+
+    def to_datastruct(self):
+        return {
+            "rows"   : self.row_count,
+            "errors" : [ e.to_datastruct() for e in self.errors ]
+        }
+
+    def __len__(self):
+        return len(self.errors)
+
+    def __iter__(self):
+        return iter(self.errors)
+
+class BatchValidator:
+    """
+    Validates lists of project datastructures (or columnar batches) against the
+    map of a BaseData subclass, by default publish.common.project.Project.
+    The rules are the ones BaseData.set() applies when coercing values.
+    """
+
+    def __init__(self, cls=cproject.Project):
+        self.cls = cls
+        self._maps = {}
+
+    # ----------------------------------------------------------------------------
+
+    def validate(self, rows):
+        """
+        Validate a list of hashes, each shaped like the input to from_datastruct.
+        """
+        errors = []
+        items = []
+        for (row, value) in enumerate(rows):
+            if type(value) != type({}):
+                errors.append(ValidationError(row, "", "expected a hash, got %s" % type(value).__name__, value))
+            else:
+                items.append((row, "", value))
+        self.__check_objects(self.cls, items, errors)
+        return ValidationReport(len(rows), errors)
+
+    # ----------------------------------------------------------------------------
+
+    def validate_columns(self, columns):
+        """
+        Validate a columnar batch: a hash mapping dotted field paths (as produced by
+        to_flattened_datastruct, ex: bibliography.title) to equal length lists of values.
+        """
+        row_count = 0
+        for values in columns.itervalues():
+            row_count = max(row_count, len(values))
+        errors = []
+        for (path, values) in columns.iteritems():
+            if len(values) != row_count:
+                errors.append(ValidationError(None, path, "column has %s values, expected %s" % (len(values), row_count)))
+        self.__check_columns(self.cls, "", columns, errors)
+        return ValidationReport(row_count, errors)
+
+    # ----------------------------------------------------------------------------
+
+    def __get_map(self, cls):
+        """
+        get_map() builds default objects each time it is called, so cache the maps.
+        """
+        if not self._maps.has_key(cls):
+            self._maps[cls] = cls().get_map()
+        return self._maps[cls]
+
+    # ----------------------------------------------------------------------------
+
+    def __check_objects(self, cls, items, errors):
+        """
+        items is a list of (row, path, hash) to check against the map of cls.
+        Fields are checked one at a time across all the items.
+        """
+        fmap = self.__get_map(cls)
+        columns = {}
+        for (row, path, value) in items:
+            for (k, v) in value.iteritems():
+                if not fmap.has_key(k):
+                    errors.append(ValidationError(row, _join(path, k), "no such data member: %s" % k, v))
+                else:
+                    columns.setdefault(k, []).append((row, _join(path, k), v))
+        for (k, column) in columns.iteritems():
+            self.__check_field(fmap[k], column, errors)
+
+    # ----------------------------------------------------------------------------
+
+    def __check_columns(self, cls, prefix, columns, errors):
+        """
+        Check a columnar batch (relative dotted path -> values) against the map of cls.
+        """
+        fmap = self.__get_map(cls)
+        nested = {}
+        for (key, values) in columns.iteritems():
+            (head, dot, rest) = key.partition(".")
+            if not fmap.has_key(head):
+                errors.append(ValidationError(None, _join(prefix, key), "no such data member: %s" % head))
+            elif dot:
+                nested.setdefault(head, {})[rest] = values
+            else:
+                column = [ (row, _join(prefix, head), v) for (row, v) in enumerate(values) ]
+                self.__check_field(fmap[head], column, errors)
+        for (head, subcolumns) in nested.iteritems():
+            typ = fmap[head][1]
+            if _is_object_type(typ):
+                self.__check_columns(typ, _join(prefix, head), subcolumns, errors)
+            else:
+                errors.append(ValidationError(None, _join(prefix, head), "%s is not an object field" % head))
+
+    # ----------------------------------------------------------------------------
+
+    def __check_field(self, spec, column, errors):
+        """
+        Check a column of (row, path, value) for one field described by a map entry.
+        None is always accepted, as it is by set().
+        """
+        (default, typ, restrictions) = spec
+        column = [ item for item in column if item[2] is not None ]
+        if len(column) == 0:
+            return
+        if typ == "choice":
+            choices = frozenset(restrictions)
+            for (row, path, value) in column:
+                try:
+                    ok = value in choices
+                except TypeError:
+                    ok = False
+                if not ok:
+                    errors.append(ValidationError(row, path, "Invalid choice %s.  Valid choices include: %s" % (value, ", ".join(restrictions)), value))
+        elif typ == "list":
+            self.__check_lists(restrictions, column, errors)
+        elif typ in BASIC_TYPES:
+            self.__check_basic(typ, column, errors)
+        elif _is_object_type(typ):
+            items = []
+            for (row, path, value) in column:
+                if type(value) == type({}):
+                    items.append((row, path, value))
+                elif not isinstance(value, baseobj.BaseData):
+                    errors.append(ValidationError(row, path, "expected a hash for %s, got %s" % (typ.__name__, type(value).__name__), value))
+            self.__check_objects(typ, items, errors)
+        # other type names are not coerced by BaseData, so anything goes
+
+    # ----------------------------------------------------------------------------
+
+    def __check_lists(self, restrictions, column, errors):
+        """
+        Check a column of list values and then their elements, flattened into one column.
+        """
+        elements = []
+        for (row, path, value) in column:
+            if type(value) != type([]):
+                errors.append(ValidationError(row, path, "%s is not a list" % type(value).__name__, value))
+                continue
+            for (i, item) in enumerate(value):
+                elements.append((row, "%s.%s" % (path, i), item))
+        if restrictions in BASIC_TYPES:
+            if restrictions == "list":
+                self.__check_lists(None, elements, errors)
+            else:
+                self.__check_basic(restrictions, elements, errors)
+        elif _is_object_type(restrictions):
+            self.__check_field([ None, restrictions, 0 ], elements, errors)
+
+    # ----------------------------------------------------------------------------
+
+    def __check_basic(self, typ, column, errors):
+        """
+        Check that every value in a column survives the coercion set() would apply.
+        """
+        if typ == "boolean":
+            return
+        elif typ == "string":
+            convert = unicode
+        elif typ == "int":
+            convert = int
+        else:
+            convert = float
+        for (row, path, value) in column:
+            try:
+                convert(value)
+            except (TypeError, ValueError), e:
+                errors.append(ValidationError(row, path, "cannot convert %r to %s" % (value, typ), value))
+
+def _join(path, key):
+    if path == "":
+        return str(key)
+    return "%s.%s" % (path, key)
+
+def _is_object_type(typ):
+    try:
+        return issubclass(typ, baseobj.BaseData)
+    except TypeError:
+        return False